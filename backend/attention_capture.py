@@ -0,0 +1,107 @@
+import threading
+import weakref
+from types import SimpleNamespace
+from typing import Callable, Dict, Optional, Sequence
+import torch
+
+# Per-thread capture state: a forward pass runs entirely on one executor thread,
+# so hooks shared by every request only act on the forward that asked for them
+_capture = threading.local()
+
+# Layer lists that carry the capture hooks, tracked by identity: a copy of a
+# model (e.g. the int8 copy made by quantize_model) needs hooks of its own, and
+# the hooks it inherits from the original only act on the original's layers
+_hooked_layers: "weakref.WeakSet[torch.nn.ModuleList]" = weakref.WeakSet()
+_hooks_lock = threading.Lock()
+
+class _StopForward(Exception):
+    """Raised by the hook of the last layer to run to skip the remaining layers"""
+
+def encoder_layers(model) -> torch.nn.ModuleList:
+    """The list of transformer layers of an encoder or masked LM model (encoder.layer, transformer.layer, ...)"""
+    num_layers = model.config.num_hidden_layers
+    for module in model.modules():
+        if isinstance(module, torch.nn.ModuleList) and len(module) == num_layers:
+            return module
+    raise ValueError(f"No list of {num_layers} transformer layers found in {type(model).__name__}")
+
+def _attention_weights(output, input_length: int):
+    """The (batch, heads, n, n) attention weights in a layer output (their position differs per model)"""
+    for value in output if isinstance(output, tuple) else (output,):
+        if isinstance(value, torch.Tensor) and value.dim() == 4 and value.size(-1) == value.size(-2) == input_length:
+            return value
+    raise ValueError("Layer output has no attention weights; the model needs eager attention")
+
+def _install_hooks(layers: torch.nn.ModuleList) -> None:
+    def make_hook(layer_idx):
+        def hook(module, args, output):
+            state = getattr(_capture, "state", None)
+            if state is None or state["layers"] is not layers:
+                return
+            stop = state["on_layer"](layer_idx, _attention_weights(output, state["input_length"]))
+            if stop or layer_idx == state["last"]:
+                raise _StopForward()
+        return hook
+
+    with _hooks_lock:
+        if layers in _hooked_layers:
+            return
+        for layer_idx, layer in enumerate(layers):
+            layer.register_forward_hook(make_hook(layer_idx))
+        _hooked_layers.add(layers)
+
+def stream_forward(model, batch: Dict[str, torch.Tensor], on_layer: Callable[[int, torch.Tensor], Optional[bool]],
+                   last_layer: Optional[int] = None) -> None:
+    """
+    Run a model, handing the attention of every layer to on_layer as soon as the layer is done
+
+    Forward hooks on the transformer layers call on_layer(layer_idx, attention)
+    from inside the forward pass, with the (batch, heads, n, n) attention weights
+    of that layer. The forward pass stops after last_layer (the remaining layers
+    and the model head are never run), or as soon as on_layer returns True.
+
+    Args:
+        model: Encoder or masked LM model with eager attention
+        batch: Model inputs of shape (batch, length)
+        on_layer: Called once per layer, in order; return True to stop early
+        last_layer: Last layer to run, the last layer of the model for None
+    """
+    module_list = encoder_layers(model)
+    _install_hooks(module_list)
+    _capture.state = {
+        "layers": module_list,
+        "on_layer": on_layer,
+        "last": len(module_list) - 1 if last_layer is None else last_layer,
+        "input_length": batch["input_ids"].size(1),
+    }
+    try:
+        with torch.no_grad():
+            model(**batch, output_attentions=True)
+    except _StopForward:
+        pass
+    finally:
+        _capture.state = None
+
+def early_exit_forward(model, batch: Dict[str, torch.Tensor], layers: Sequence[int]):
+    """
+    Run a model only up to the deepest requested layer, capturing the attention of the requested layers
+
+    See stream_forward: the remaining layers (and the model head) are never run.
+
+    Args:
+        model: Encoder or masked LM model with eager attention
+        batch: Model inputs of shape (batch, length)
+        layers: Sorted layer indices to capture
+
+    Returns:
+        An output with attentions: one (batch, heads, n, n) tensor per requested layer, in order
+    """
+    wanted = set(layers)
+    captured = {}
+
+    def keep(layer_idx, attention):
+        if layer_idx in wanted:
+            captured[layer_idx] = attention
+
+    stream_forward(model, batch, keep, max(layers))
+    return SimpleNamespace(attentions=tuple(captured[layer] for layer in layers), logits=None)
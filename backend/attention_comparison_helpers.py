@@ -1,11 +1,31 @@
+from typing import Any, Dict
 from fastapi import HTTPException
 from classes import *
 from helpers import *
-from routes.attention import get_attention_matrices
+from routes.attention import compute_attentions, tokens_from_ids
+from inference_executor import run_blocking
+from long_text import ensure_fits
 from routes.tokenize import tokenize_text
 
 
 
+async def compare_attention_pair(request: ComparisonRequest, replaced_text: str) -> Dict[str, Any]:
+    """
+    Compute the attention of the original and the replaced text together:
+    one batched forward pass and one post-processing step for both
+
+    Args:
+        request: The comparison request
+        replaced_text: The text with the selected token replaced
+    """
+    before_data, after_data = await compute_attentions(
+        request.model_name,
+        request.visualization_method,
+        [request.text, replaced_text]
+    )
+    return {"before_attention": before_data, "after_attention": after_data}
+
+
 async def get_attention_comparison_bert(request: ComparisonRequest):
     """
     BERT and DistilBERT implementation of attention comparison
@@ -14,16 +34,8 @@ async def get_attention_comparison_bert(request: ComparisonRequest):
         model_type = "DistilBERT" if "distilbert" in request.model_name.lower() else "BERT"
         print(f"\n=== USING {model_type} ATTENTION COMPARISON IMPLEMENTATION ===")
         
-        # 1. Get the "before" attention data
-        before_attention_request = AttentionRequest(
-            text=request.text, 
-            model_name=request.model_name,
-            visualization_method=request.visualization_method
-        )
-        before_data = (await get_attention_matrices(before_attention_request))["attention_data"]
-        
-        # 2. Tokenize the text
-        tokenizer_response = await tokenize_text(TokenizeRequest(text=request.text, model_name=request.model_name))
+        # 1. Tokenize the text
+        tokenizer_response = await tokenize_text(TokenizeRequest(text=request.text, model_name=request.model_name), x_model_load_wait=None)
         tokens = tokenizer_response["tokens"]
         
         # Print all tokens for debugging
@@ -40,7 +52,7 @@ async def get_attention_comparison_bert(request: ComparisonRequest):
         print(f"\nSelected token at index {request.masked_index}: '{selected_token}'")
         
         # Get the tokenizer for this model
-        _, tokenizer = get_model_and_tokenizer(request.model_name)
+        _, tokenizer = await run_blocking(get_model_and_tokenizer, request.model_name)
         
         # Detect if we're working with a punctuation token
         is_punctuation = selected_token in [".", ",", "!", "?", ":", ";", "-", "'", "\""]
@@ -81,16 +93,8 @@ async def get_attention_comparison_bert(request: ComparisonRequest):
                 print(f"Original text: '{original_text}'")
                 print(f"Replaced text: '{replaced_text}'")
                 
-                # Get the after attention data
-                after_attention_request = AttentionRequest(
-                    text=replaced_text, 
-                    model_name=request.model_name,
-                    visualization_method=request.visualization_method
-                )
-                after_data = (await get_attention_matrices(after_attention_request))["attention_data"]
-                
-                # Return comparison data
-                return {"before_attention": before_data, "after_attention": after_data}
+                # Get the before and after attention data in one batched forward pass
+                return await compare_attention_pair(request, replaced_text)
         
         # HANDLE REGULAR WORDS FOR BERT/DistilBERT
         print(f"\nUsing {model_type} word replacement approach")
@@ -227,17 +231,11 @@ async def get_attention_comparison_bert(request: ComparisonRequest):
             print(f"Simple replacement: '{original_word}' → '{replaced_word}'")
             print(f"Replaced text: '{replaced_text}'")
         
-        # Get the after attention data
-        after_attention_request = AttentionRequest(
-            text=replaced_text, 
-            model_name=request.model_name,
-            visualization_method=request.visualization_method
-        )
-        after_data = (await get_attention_matrices(after_attention_request))["attention_data"]
-        
-        # Return comparison data
-        return {"before_attention": before_data, "after_attention": after_data}
+        # Get the before and after attention data in one batched forward pass
+        return await compare_attention_pair(request, replaced_text)
     
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"{model_type} Attention comparison error: {str(e)}")
         import traceback
@@ -256,20 +254,12 @@ async def get_attention_comparison_roberta(request: ComparisonRequest):
         print(f"Selected token index: {request.masked_index}")
         print(f"Replacement word: '{request.replacement_word}'")
         
-        # Get the "before" attention data
-        before_attention_request = AttentionRequest(
-            text=request.text, 
-            model_name=request.model_name,
-            visualization_method=request.visualization_method
-        )
-        before_data = (await get_attention_matrices(before_attention_request))["attention_data"]
-        
         # Tokenize the text
-        tokenizer_response = await tokenize_text(TokenizeRequest(text=request.text, model_name=request.model_name))
+        tokenizer_response = await tokenize_text(TokenizeRequest(text=request.text, model_name=request.model_name), x_model_load_wait=None)
         tokens = tokenizer_response["tokens"]
         
         # Get the tokenizer 
-        _, tokenizer = get_model_and_tokenizer(request.model_name)
+        _, tokenizer = await run_blocking(get_model_and_tokenizer, request.model_name)
         
         # Log tokens
         print("\nTokens:")
@@ -319,18 +309,12 @@ async def get_attention_comparison_roberta(request: ComparisonRequest):
                 replaced_text = original_text[:pos_to_replace] + request.replacement_word + original_text[pos_to_replace+1:]
                 print(f"Replaced text: '{replaced_text}'")
                 
-                # Get the "after" attention data and return
-                after_request = AttentionRequest(
-                    text=replaced_text, 
-                    model_name=request.model_name,
-                    visualization_method=request.visualization_method
-                )
-                after_data = (await get_attention_matrices(after_request))["attention_data"]
-                return {"before_attention": before_data, "after_attention": after_data}
+                # Get the before and after attention data in one batched forward pass
+                return await compare_attention_pair(request, replaced_text)
         
         # Step 2: Map the token to a word
         print("Mapping selected token to a word:")
-        token_to_word_map = map_roberta_tokens_to_words(tokens, original_text)
+        token_to_word_map = {i: token["wordIndex"] for i, token in enumerate(tokens) if "wordIndex" in token}
         
         # Get the word index for the selected token
         if request.masked_index in token_to_word_map:
@@ -362,15 +346,8 @@ async def get_attention_comparison_roberta(request: ComparisonRequest):
             print(f"Replacing '{original_word}' with '{replaced_word}'")
             print(f"Replaced text: '{replaced_text}'")
             
-            # Get the "after" attention data
-            after_request = AttentionRequest(
-                text=replaced_text, 
-                model_name=request.model_name,
-                visualization_method=request.visualization_method
-            )
-            after_data = (await get_attention_matrices(after_request))["attention_data"]
-            
-            return {"before_attention": before_data, "after_attention": after_data}
+            # Get the before and after attention data in one batched forward pass
+            return await compare_attention_pair(request, replaced_text)
         else:
             # Step 3: Fallback - direct content matching
             print(f"Selected token not found in mapping, using fallback approach")
@@ -436,18 +413,72 @@ async def get_attention_comparison_roberta(request: ComparisonRequest):
                 print(f"Position-based replacement: '{original_word}' → '{replaced_word}'")
                 print(f"Replaced text: '{replaced_text}'")
             
-            # Get the "after" attention data
-            after_request = AttentionRequest(
-                text=replaced_text, 
-                model_name=request.model_name,
-                visualization_method=request.visualization_method
-            )
-            after_data = (await get_attention_matrices(after_request))["attention_data"]
-            
-            return {"before_attention": before_data, "after_attention": after_data}
+            # Get the before and after attention data in one batched forward pass
+            return await compare_attention_pair(request, replaced_text)
         
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"RoBERTa Attention comparison error: {str(e)}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+
+
+async def get_attention_comparison_tokens(request: ComparisonRequest):
+    """
+    Token-level attention comparison for all models.
+
+    Instead of rebuilding the sentence, the sub-token ids of the replacement word
+    are spliced into the encoded input in place of the token at masked_index.
+    The result carries the alignment of the after tokens to the before tokens.
+    """
+    try:
+        print(f"\n=== TOKEN SUBSTITUTION ATTENTION COMPARISON ===")
+        model, tokenizer = await run_blocking(get_model_and_tokenizer, request.model_name)
+        tokens, encoding = await run_blocking(get_encoding, tokenizer, request.model_name, request.text)
+        input_ids = encoding["input_ids"]
+        
+        if request.masked_index < 0 or request.masked_index >= len(input_ids):
+            raise HTTPException(status_code=400, detail=f"Invalid token index {request.masked_index}. Valid range: 0-{len(input_ids)-1}")
+        if input_ids[request.masked_index] in tokenizer.all_special_ids:
+            raise HTTPException(status_code=400, detail=f"Token at index {request.masked_index} is a special token and cannot be replaced")
+        
+        # Encode the replacement like the token it replaces: RoBERTa marks word starts with a leading space
+        word = request.replacement_word.strip()
+        masked_piece = tokenizer.convert_ids_to_tokens(input_ids[request.masked_index])
+        if "roberta" in request.model_name and masked_piece.startswith("Ġ"):
+            word = " " + word
+        replacement_ids = tokenizer(word, add_special_tokens=False)["input_ids"]
+        if not replacement_ids:
+            raise HTTPException(status_code=400, detail=f"Replacement word '{request.replacement_word}' has no tokens")
+        
+        index = request.masked_index
+        after_ids = tuple(input_ids[:index] + replacement_ids + input_ids[index + 1:])
+        # A multi-piece replacement makes the after sequence longer than the text
+        ensure_fits(model, request.model_name, len(after_ids))
+        # Index of the before token that every after token corresponds to
+        alignment = list(range(index)) + [index] * len(replacement_ids) + list(range(index + 1, len(input_ids)))
+        print(f"Replacing token {index} '{masked_piece}' with {tokenizer.convert_ids_to_tokens(replacement_ids)}")
+        
+        # After tokens take the word of the token they are aligned to
+        after_tokens = tokens_from_ids(tokenizer, request.model_name, after_ids)
+        for token, before_index in zip(after_tokens, alignment):
+            if "wordIndex" in tokens[before_index]:
+                token["wordIndex"] = tokens[before_index]["wordIndex"]
+        
+        before_data, after_data = await compute_attentions(
+            request.model_name,
+            request.visualization_method,
+            [request.text, after_ids],
+            known_tokens={after_ids: after_tokens}
+        )
+        return {"before_attention": before_data, "after_attention": after_data, "alignment": alignment}
+    
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Token substitution attention comparison error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,216 @@
+import json
+import struct
+import numpy as np
+from typing import Any, Dict, Optional
+from fastapi import Response
+from attention_sparse import sparsify_attention
+
+# Binary attention payload
+#
+#   offset 0   magic b"ATTN"
+#   offset 4   uint8 format version, followed by 3 reserved zero bytes
+#   offset 8   uint32 (little endian) length of the JSON header
+#   offset 12  UTF-8 JSON header, padded with spaces to a multiple of 8 bytes
+#   then       data section holding the tensors described by the header
+#
+# The header maps every section name ("attention", or "before_attention" /
+# "after_attention" for comparisons) to its tokens, the number of heads per
+# layer, whether the matrices are shared by all heads of a layer, and the
+# location of its tensor in the data section. Tensors are stored C-contiguous
+# and little endian with shape (layers, heads, n, n), or (layers, n, n) when
+# shared by the heads. A matrix that is the same on every layer (flow) is
+# stored once with shape (1, n, n) and the section sets "repeated_layers" to
+# the number of layers it stands for. uint8 tensors carry one float32 scale per row:
+# value = q * scale. Sections of a layer/head selection also list the model
+# "layer_indices" and "head_indices" of their layers and heads. Sparse requests
+# store tensors with "format": "csr": uint32 "indptr" of shape (..., n + 1)
+# starting at 0 for every matrix, uint16 (uint32 for n > 65536) column "indices"
+# and float16 "values" of all matrices in order, and the float16 dropped mass of
+# every row in "residual" of shape (..., n). Optional response metadata that is not attention (e.g.
+# the token alignment of a comparison) is stored under "metadata" in the header.
+ATTENTION_MAGIC = b"ATTN"
+ATTENTION_FORMAT_VERSION = 1
+ATTENTION_MEDIA_TYPES = {
+    "application/x-attention-f16": "float16",
+    "application/x-attention-u8": "uint8",
+}
+
+def negotiate_attention_format(accept: Optional[str]) -> Optional[str]:
+    """
+    Pick the binary attention encoding requested by an Accept header
+
+    Returns:
+        "float16" or "uint8" when a binary media type is preferred, None for JSON
+    """
+    if not accept:
+        return None
+    best_format, best_quality = None, 0.0
+    for media_range in accept.split(","):
+        media_type, *params = [part.strip() for part in media_range.split(";")]
+        quality = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if media_type.lower() == "application/json" and quality > best_quality:
+            best_format, best_quality = None, quality
+        elif media_type.lower() in ATTENTION_MEDIA_TYPES and quality > best_quality:
+            best_format, best_quality = ATTENTION_MEDIA_TYPES[media_type.lower()], quality
+    return best_format
+
+def _quantize_rows(attention: np.ndarray):
+    """Per-row scaled uint8 quantization of non-negative attention; returns (quantized values, float32 row scales)"""
+    attention = np.asarray(attention, dtype=np.float32)
+    scales = np.abs(attention).max(axis=-1) / 255.0
+    safe_scales = np.where(scales > 0, scales, 1.0)
+    quantized = np.rint(np.clip(attention / safe_scales[..., None], 0, 255)).astype(np.uint8)
+    return quantized, scales.astype(np.float32)
+
+def encode_attention_payload(sections: Dict[str, Dict[str, Any]], dtype: str = "float16",
+                             metadata: Optional[Dict[str, Any]] = None, sparse_top_k: Optional[int] = None,
+                             sparse_mass: Optional[float] = None) -> bytes:
+    """
+    Pack attention results into the binary attention payload
+
+    Args:
+        sections: Mapping of section name to an attention result with "tokens",
+            "attention" (array from compute_attention_with_method) and "num_heads"
+        dtype: Tensor encoding, "float16" or "uint8"
+        metadata: Extra JSON-serializable values stored in the header
+        sparse_top_k, sparse_mass: Store sparse CSR rows instead of dense
+            tensors, see attention_sparse.py (dtype is ignored, values are float16)
+
+    Returns:
+        The encoded payload
+    """
+    if dtype not in ATTENTION_MEDIA_TYPES.values():
+        raise ValueError(f"Unknown attention payload dtype: {dtype}")
+    header = {"version": ATTENTION_FORMAT_VERSION, "sections": {}}
+    if metadata:
+        header["metadata"] = metadata
+    blobs = []
+    offset = 0
+
+    def add_blob(array):
+        nonlocal offset
+        data = np.ascontiguousarray(array).astype(array.dtype.newbyteorder("<"), copy=False).tobytes()
+        location = {"offset": offset, "nbytes": len(data)}
+        padding = (-len(data)) % 8
+        blobs.append(data + b"\0" * padding)
+        offset += len(data) + padding
+        return location
+
+    for name, result in sections.items():
+        attention = result["attention"]
+        # A matrix broadcast over the layers (flow) is stored once
+        repeated_layers = len(attention) if attention.ndim == 3 and attention.strides[0] == 0 else None
+        if repeated_layers is not None:
+            attention = attention[:1]
+        tensor = {"dtype": dtype, "shape": list(attention.shape)}
+        if sparse_top_k is not None or sparse_mass is not None:
+            sparse = sparsify_attention(attention, sparse_top_k, sparse_mass)
+            index_dtype = np.uint16 if attention.shape[-1] <= 65536 else np.uint32
+            tensor = {
+                "format": "csr",
+                "dtype": "float16",
+                "index_dtype": np.dtype(index_dtype).name,
+                "shape": list(attention.shape),
+                "indptr": add_blob(sparse["indptr"].astype(np.uint32)),
+                "indices": add_blob(sparse["indices"].astype(index_dtype)),
+                "values": add_blob(sparse["values"].astype(np.float16)),
+                "residual": add_blob(sparse["residual"].astype(np.float16)),
+            }
+        elif dtype == "float16":
+            tensor.update(add_blob(np.asarray(attention, dtype=np.float16)))
+        else:
+            quantized, scales = _quantize_rows(attention)
+            tensor.update(add_blob(quantized))
+            scale_location = add_blob(scales)
+            tensor["scale_offset"] = scale_location["offset"]
+            tensor["scale_nbytes"] = scale_location["nbytes"]
+        header["sections"][name] = {
+            "tokens": result["tokens"],
+            "num_heads": int(result["num_heads"]),
+            "shared_heads": attention.ndim == 3,
+            "tensor": tensor,
+        }
+        if repeated_layers is not None:
+            header["sections"][name]["repeated_layers"] = repeated_layers
+        for indices in ("layer_indices", "head_indices"):
+            if result.get(indices) is not None:
+                header["sections"][name][indices] = list(result[indices])
+
+    header_bytes = json.dumps(header, separators=(",", ":")).encode("utf-8")
+    header_bytes += b" " * ((-len(header_bytes)) % 8)
+    prefix = ATTENTION_MAGIC + struct.pack("<B3xI", ATTENTION_FORMAT_VERSION, len(header_bytes))
+    return b"".join([prefix, header_bytes] + blobs)
+
+def decode_attention_payload(payload: bytes) -> Dict[str, Dict[str, Any]]:
+    """
+    Decode a binary attention payload (reference decoder for clients and benchmarks)
+
+    Returns:
+        Mapping of section name to a dictionary with "tokens", "num_heads",
+        "shared_heads", the float32 "attention" array and, for selections,
+        "layer_indices" and "head_indices"; sparse tensors are returned dense
+        (dropped entries are 0) with the dropped mass per row in "residual".
+        Repeated layers are returned as a read-only broadcast view
+    """
+    if payload[:4] != ATTENTION_MAGIC:
+        raise ValueError("Not an attention payload")
+    version, header_length = struct.unpack_from("<B3xI", payload, 4)
+    if version != ATTENTION_FORMAT_VERSION:
+        raise ValueError(f"Unsupported attention payload version: {version}")
+    header = json.loads(payload[12:12 + header_length])
+    data = memoryview(payload)[12 + header_length:]
+    sections = {}
+
+    def read_blob(location, blob_dtype):
+        blob_dtype = np.dtype(blob_dtype).newbyteorder("<")
+        return np.frombuffer(data, dtype=blob_dtype, count=location["nbytes"] // blob_dtype.itemsize, offset=location["offset"])
+
+    for name, section in header["sections"].items():
+        tensor = section["tensor"]
+        residual = None
+        if tensor.get("format") == "csr":
+            shape = tensor["shape"]
+            num_rows = int(np.prod(shape[:-1]))
+            indptr = read_blob(tensor["indptr"], np.uint32).reshape(-1, shape[-1] + 1)
+            rows = np.repeat(np.arange(num_rows), np.diff(indptr, axis=-1).reshape(-1))
+            attention = np.zeros((num_rows, shape[-1]), dtype=np.float32)
+            attention[rows, read_blob(tensor["indices"], tensor["index_dtype"])] = read_blob(tensor["values"], np.float16)
+            attention = attention.reshape(shape)
+            residual = read_blob(tensor["residual"], np.float16).astype(np.float32).reshape(shape[:-1])
+        else:
+            values = np.frombuffer(data, dtype="<f2" if tensor["dtype"] == "float16" else np.uint8,
+                                   count=int(np.prod(tensor["shape"])), offset=tensor["offset"])
+            attention = values.reshape(tensor["shape"]).astype(np.float32)
+            if tensor["dtype"] == "uint8":
+                scales = np.frombuffer(data, dtype="<f4", count=tensor["scale_nbytes"] // 4, offset=tensor["scale_offset"])
+                attention *= scales.reshape(tensor["shape"][:-1])[..., None]
+        if "repeated_layers" in section:
+            attention = np.broadcast_to(attention, (section["repeated_layers"],) + attention.shape[1:])
+            if residual is not None:
+                residual = np.broadcast_to(residual, (section["repeated_layers"],) + residual.shape[1:])
+        sections[name] = {
+            "tokens": section["tokens"],
+            "num_heads": section["num_heads"],
+            "shared_heads": section["shared_heads"],
+            "attention": attention,
+        }
+        if residual is not None:
+            sections[name]["residual"] = residual
+        for indices in ("layer_indices", "head_indices"):
+            if indices in section:
+                sections[name][indices] = section[indices]
+    return sections
+
+def attention_binary_response(sections: Dict[str, Dict[str, Any]], dtype: str,
+                              metadata: Optional[Dict[str, Any]] = None, sparse_top_k: Optional[int] = None,
+                              sparse_mass: Optional[float] = None) -> Response:
+    """Build the HTTP response for a binary attention payload"""
+    media_type = next(media for media, media_dtype in ATTENTION_MEDIA_TYPES.items() if media_dtype == dtype)
+    return Response(content=encode_attention_payload(sections, dtype, metadata, sparse_top_k, sparse_mass), media_type=media_type)
@@ -0,0 +1,348 @@
+import os
+import numpy as np
+import torch
+from typing import Optional, Sequence
+from fastapi import HTTPException
+
+# Edges with capacity at or below this value are left out of the flow graph,
+# the same cut-off the networkx implementation uses when adding edges.
+CAPACITY_THRESHOLD = 1e-8
+# Residual capacities and excesses below this value are treated as zero.
+FLOW_EPS = 1e-10
+# Upper bound on the number of float64 cells of one (problems, layers, n, n) working
+# array, i.e. on the (source, sink) problems solved per batch.
+MAX_CHUNK_ELEMENTS = int(os.environ.get("FLOW_CHUNK_ELEMENTS", "2000000"))
+# Flow solves one max-flow problem per (input, output) token pair over every
+# layer, so its cost grows with the fourth power of the sequence length (on one
+# core with 12 layers: about 1 s for 24 tokens, 6 s for 40 and 42 s for 64, see
+# benchmarks/bench_attention_flow.py). Deployments can refuse longer sequences
+# by setting FLOW_MAX_TOKENS; 0 (the default) means no limit.
+FLOW_MAX_TOKENS = int(os.environ.get("FLOW_MAX_TOKENS", "0"))
+
+def ensure_flow_fits(num_tokens: int) -> None:
+    """Raise a 400 HTTPException when FLOW_MAX_TOKENS is set and the sequence is longer"""
+    if FLOW_MAX_TOKENS and num_tokens > FLOW_MAX_TOKENS:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Attention flow is limited to {FLOW_MAX_TOKENS} tokens and the text has {num_tokens}; "
+                   f"use rollout, or long_text with a window_size of at most {FLOW_MAX_TOKENS - 2}"
+        )
+
+#############################################
+# Joint Attention Construction
+#############################################
+def compute_joint_attentions(attentions, add_identity: bool = True) -> np.ndarray:
+    """
+    Average the heads of every layer and mix in the residual connection
+
+    Args:
+        attentions: List of attention tensors from the model
+        add_identity: Whether to add identity matrix to each attention layer
+
+    Returns:
+        Array of shape (num_layers, seq_len, seq_len) with row-normalized joint attentions
+    """
+    stacked = torch.stack([att.squeeze(0) for att in attentions]).mean(dim=1).cpu()
+    seq_len = stacked.size(-1)
+    if add_identity:
+        alpha = 0.5
+        stacked = (stacked + torch.eye(seq_len)) * alpha
+    stacked = stacked / (stacked.sum(dim=-1, keepdim=True) + 1e-8)
+    return stacked.numpy().astype(np.float64)
+
+#############################################
+# Capacity Graph Construction Function (for Flow)
+#############################################
+def build_graph(joint_attentions, input_tokens, remove_diag: bool = False, debug: bool = False):
+    """
+    Build the layered capacity representation for attention flow computation
+
+    The flow graph has (n_layers + 1) * seq_len nodes, where node k of layer i
+    has id i * seq_len + k. Edges only connect consecutive layers, so instead of
+    a dense square matrix over all nodes the capacities are kept as one
+    seq_len x seq_len block per layer transition.
+
+    Args:
+        joint_attentions: Joint attention matrices of shape (n_layers, seq_len, seq_len)
+        input_tokens: List of input token text
+        remove_diag: Whether to remove diagonal elements (self-attention)
+        debug: Whether to print debug information
+
+    Returns:
+        Tuple of (capacity blocks of shape (n_layers, seq_len, seq_len), node labels dictionary)
+        where capacity[i][k_from][k_to] is the capacity from node k_from of layer i
+        to node k_to of layer i + 1
+    """
+    n_layers, seq_len, _ = joint_attentions.shape
+    capacity = np.array(joint_attentions, dtype=np.float64)
+    if remove_diag:
+        diagonal = np.arange(seq_len)
+        capacity[:, diagonal, diagonal] = 0.0
+    labels = {k: f"0_{k}_{input_tokens[k]}" for k in range(seq_len)}
+    for i in range(1, n_layers + 1):
+        for k in range(seq_len):
+            labels[i * seq_len + k] = f"L{i}_{k}"
+    if debug:
+        for u, v, cap in zip(*layered_edges(capacity, threshold=0.0)):
+            print(f"[DEBUG] Edge from {labels[u]} to {labels[v]} with capacity: {cap:.6f}")
+    return capacity, labels
+
+def layered_edges(capacity: np.ndarray, threshold: float = CAPACITY_THRESHOLD):
+    """
+    List the edges of a layered capacity representation with capacity above threshold
+
+    Returns:
+        Tuple of (source node ids, target node ids, capacities) as flat arrays
+    """
+    seq_len = capacity.shape[-1]
+    layer, k_from, k_to = np.nonzero(capacity > threshold)
+    return layer * seq_len + k_from, (layer + 1) * seq_len + k_to, capacity[layer, k_from, k_to]
+
+#############################################
+# Layered Max-Flow Engine
+#############################################
+def _forward_preflow(first: np.ndarray, interior: np.ndarray):
+    """
+    Push every source's outflow forward layer by layer, as far as capacities allow.
+
+    The result is a valid preflow that does not depend on the sink, so it is
+    computed once per source and shared by all sinks of that source.
+
+    Returns:
+        Tuple of (flow on interior edges, excess per interior node)
+    """
+    num_sources, seq_len = first.shape
+    num_interior = interior.shape[0]
+    flow = np.zeros((num_sources, num_interior, seq_len, seq_len))
+    excess = np.zeros((num_sources, num_interior + 1, seq_len))
+    incoming = first.copy()
+    for j in range(num_interior):
+        row_capacity = interior[j].sum(axis=-1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(row_capacity > 0, np.minimum(1.0, incoming / row_capacity), 0.0)
+        flow[:, j] = interior[j][None] * ratio[:, :, None]
+        excess[:, j] = incoming - flow[:, j].sum(axis=-1)
+        incoming = flow[:, j].sum(axis=-2)
+    excess[:, num_interior] = incoming
+    return flow, excess
+
+def _active_span(mask: np.ndarray):
+    """First and last node layer with a set entry in a (problems, layers, seq_len) mask"""
+    layers = np.flatnonzero(mask.any(axis=(0, 2)))
+    return layers[0], layers[-1]
+
+def _sink_distances(residual, flow, sink_residual):
+    """
+    Exact distance labels to the sink in the residual graph (global relabeling).
+
+    Nodes that can no longer reach the sink are labeled with infinity. Every
+    breadth-first step only looks at the blocks next to the layers of its frontier.
+    """
+    num_problems, num_layers, seq_len = sink_residual.shape[0], flow.shape[1] + 1, sink_residual.shape[1]
+    dist = np.full((num_problems, num_layers, seq_len), np.inf)
+    frontier = np.zeros((num_problems, num_layers, seq_len), dtype=bool)
+    frontier[:, -1] = sink_residual > FLOW_EPS
+    dist[frontier] = 1
+    level = 1
+    while frontier.any():
+        lo, hi = _active_span(frontier)
+        reached = np.zeros_like(frontier)
+        # Forward residual edges into the frontier (blocks lo-1 .. hi-1)
+        f0, f1 = max(lo - 1, 0), min(hi, num_layers - 1)
+        if f0 < f1:
+            reached[:, f0:f1] |= ((residual[:, f0:f1] > FLOW_EPS) & frontier[:, f0 + 1:f1 + 1, None, :]).any(axis=-1)
+        # Backward residual edges (edges with flow) out of the frontier (blocks lo .. hi)
+        b0, b1 = lo, min(hi + 1, num_layers - 1)
+        if b0 < b1:
+            reached[:, b0 + 1:b1 + 1] |= ((flow[:, b0:b1] > FLOW_EPS) & frontier[:, b0:b1, :, None]).any(axis=-2)
+        frontier = reached & np.isinf(dist)
+        level += 1
+        dist[frontier] = level
+    return dist
+
+def _push_relabel(interior, flow, excess, sink_capacity, bound, relabel_every: int = 6):
+    """
+    Synchronous push-relabel over a batch of independent (source, sink) problems.
+
+    All problems share the interior capacities; they differ in their preflow and
+    in the capacities of the edges into their sink. Every iteration pushes excess
+    along all admissible edges of all problems at once (proportionally to the
+    residual capacities), and nodes that stay overflowing are relabeled.
+    Only the value of the maximum flow is needed, so excess that can no longer
+    reach the sink is simply left where it is.
+
+    Excess starts in the last layers and rarely travels far back, so every
+    iteration only touches the capacity blocks next to the layers that still
+    hold active nodes. Finished problems are frozen and only dropped from the
+    batch once they make up half of it, to avoid copying the arrays every iteration.
+
+    Returns:
+        Array with the maximum flow value of every problem
+    """
+    num_problems = flow.shape[0]
+    num_layers = excess.shape[1]
+    result = np.zeros(num_problems)
+    pending = np.arange(num_problems)
+    residual = interior[None] - flow
+    sink_flow = np.zeros_like(sink_capacity)
+    sink_value = np.zeros(num_problems)
+    height = _sink_distances(residual, flow, sink_capacity)
+    iteration = 0
+    while len(pending):
+        active = (excess > FLOW_EPS) & np.isfinite(height)
+        finished = ~active.any(axis=(1, 2)) | (sink_value >= bound - FLOW_EPS)
+        if finished.any():
+            result[pending[finished]] = sink_value[finished]
+            # Frozen: without excess a problem no longer pushes or changes
+            excess[finished] = 0.0
+            active[finished] = False
+            if finished.all():
+                break
+            if 2 * finished.sum() >= len(pending):
+                keep = ~finished
+                pending = pending[keep]
+                flow, residual, excess, height, active = flow[keep], residual[keep], excess[keep], height[keep], active[keep]
+                sink_capacity, sink_flow, sink_value, bound = sink_capacity[keep], sink_flow[keep], sink_value[keep], bound[keep]
+        iteration += 1
+
+        # Blocks next to the active layers: forward pushes out of layers lo..hi and
+        # backward pushes into layers lo-1..hi-1 use blocks lo-1 .. hi
+        lo, hi = _active_span(active)
+        b0, b1 = max(lo - 1, 0), min(hi + 1, num_layers - 1)
+
+        # Admissible edges: residual capacity left and exactly one level downhill
+        sink_residual = sink_capacity - sink_flow
+        sink_push_capacity = np.where((sink_residual > FLOW_EPS) & (height[:, -1] == 1), sink_residual, 0.0)
+        total = np.zeros_like(excess)
+        total[:, -1] = sink_push_capacity
+        if b0 < b1:
+            block_flow, block_residual = flow[:, b0:b1], residual[:, b0:b1]
+            # Heights are whole numbers; nodes at infinity are never active, so their edges never carry a push
+            height_from, height_to = height[:, b0:b1, :, None], height[:, b0 + 1:b1 + 1, None, :]
+            forward_push_capacity = np.where((block_residual > FLOW_EPS) & (height_from == height_to + 1), block_residual, 0.0)
+            backward_push_capacity = np.where((block_flow > FLOW_EPS) & (height_to == height_from + 1), block_flow, 0.0)
+            forward_out = forward_push_capacity.sum(axis=-1)
+            backward_out = backward_push_capacity.sum(axis=-2)
+            total[:, b0:b1] += forward_out
+            total[:, b0 + 1:b1 + 1] += backward_out
+
+        # Every active node pushes min(excess, capacity) spread over its admissible edges
+        with np.errstate(divide="ignore", invalid="ignore"):
+            ratio = np.where(active & (total > 0), np.minimum(1.0, excess / total), 0.0)
+        sink_push = sink_push_capacity * ratio[:, -1]
+        excess[:, -1] -= sink_push
+        sink_flow += sink_push
+        sink_value += sink_push.sum(axis=-1)
+        if b0 < b1:
+            forward_push = forward_push_capacity * ratio[:, b0:b1, :, None]
+            backward_push = backward_push_capacity * ratio[:, b0 + 1:b1 + 1, None, :]
+            net = forward_push - backward_push
+            block_flow += net
+            block_residual -= net
+            excess[:, b0:b1] -= forward_out * ratio[:, b0:b1] - backward_push.sum(axis=-1)
+            excess[:, b0 + 1:b1 + 1] += forward_push.sum(axis=-2) - backward_out * ratio[:, b0 + 1:b1 + 1]
+
+        if relabel_every and iteration % relabel_every == 0:
+            height = _sink_distances(residual, flow, sink_capacity - sink_flow)
+            continue
+
+        # Relabel nodes that saturated all their admissible edges and still overflow
+        overflowing = active & (excess > FLOW_EPS) & ((ratio < 1.0) | (total == 0))
+        if overflowing.any():
+            lowest = np.full_like(height, np.inf)
+            if b0 < b1:
+                lowest[:, b0:b1] = np.where(block_residual > FLOW_EPS, height[:, b0 + 1:b1 + 1, None, :], np.inf).min(axis=-1)
+                lowest[:, b0 + 1:b1 + 1] = np.minimum(lowest[:, b0 + 1:b1 + 1], np.where(block_flow > FLOW_EPS, height[:, b0:b1, :, None], np.inf).min(axis=-2))
+            lowest[:, -1] = np.where(sink_capacity - sink_flow > FLOW_EPS, 0, lowest[:, -1])
+            height = np.where(overflowing, lowest + 1, height)
+
+    return result
+
+def compute_layered_max_flow(capacity: np.ndarray, sources: Optional[Sequence[int]] = None, debug: bool = False) -> np.ndarray:
+    """
+    Maximum flow from input tokens to every output token of the layered attention graph
+
+    Instead of one max-flow solve per (source, sink) pair, the pairs are solved
+    in batches of up to MAX_CHUNK_ELEMENTS working cells, warm-started from a
+    preflow that is shared by all sinks of a source.
+
+    Args:
+        capacity: Layered capacity blocks of shape (num_layers, seq_len, seq_len), as returned by build_graph
+        sources: Input token indices to compute flow from (all tokens if None)
+        debug: Whether to print debug information
+
+    Returns:
+        Array of shape (len(sources), seq_len) with max-flow values
+    """
+    num_layers, seq_len, _ = capacity.shape
+    if sources is None:
+        sources = range(seq_len)
+    sources = np.asarray(list(sources), dtype=np.int64)
+    capacity = np.where(capacity > CAPACITY_THRESHOLD, capacity, 0.0)
+
+    if num_layers == 1:
+        return capacity[0][sources].copy()
+
+    first = capacity[0]
+    interior = capacity[1:num_layers - 1]
+    last = capacity[num_layers - 1]
+    flow_values = np.zeros((len(sources), seq_len))
+
+    # Every (source, sink) problem holds a (layers, seq_len, seq_len) working set;
+    # solve as many problems per batch as the budget allows
+    per_problem = max(1, num_layers - 2) * seq_len * seq_len
+    chunk = max(1, MAX_CHUNK_ELEMENTS // per_problem)
+    problem_source = np.repeat(np.arange(len(sources)), seq_len)
+    problem_sink = np.tile(np.arange(seq_len), len(sources))
+    for start in range(0, len(problem_source), chunk):
+        chunk_source = problem_source[start:start + chunk]
+        chunk_sink = problem_sink[start:start + chunk]
+        # The preflow is shared by all sinks of a source
+        chunk_sources, position = np.unique(chunk_source, return_inverse=True)
+        shared_flow, shared_excess = _forward_preflow(first[sources[chunk_sources]], interior)
+        sink_capacity = last.T[chunk_sink].copy()
+        bound = np.minimum(first[sources[chunk_source]].sum(axis=-1), sink_capacity.sum(axis=-1))
+        values = _push_relabel(interior, shared_flow[position], shared_excess[position], sink_capacity, bound)
+        flow_values[chunk_source, chunk_sink] = values
+        if debug:
+            print(f"[DEBUG] Layered max flow solved for sources {sources[chunk_sources].tolist()}")
+
+    return flow_values
+
+#############################################
+# Attention Flow Calculation Function (layered engine)
+#############################################
+def compute_attention_flow(attentions, add_identity: bool = True, debug: bool = False, mask_idx=None):
+    """
+    Compute attention flow with the layered max-flow engine
+
+    Drop-in replacement for compute_attention_flow_networkx that returns the
+    same values (within floating point tolerance).
+
+    Args:
+        attentions: List of attention tensors from the model
+        add_identity: Whether to add identity matrix to each attention layer
+        debug: Whether to print debug information
+        mask_idx: Index of token to compute flow from (if None, computes flow for all tokens)
+
+    Returns:
+        Flow matrix or vector depending on mask_idx
+    """
+    joint_attentions = compute_joint_attentions(attentions, add_identity=add_identity)
+    seq_len = joint_attentions.shape[-1]
+    input_tokens = [str(i) for i in range(seq_len)]
+    capacity, _ = build_graph(joint_attentions, input_tokens, remove_diag=False, debug=debug)
+
+    if mask_idx is not None:
+        flow_vector = compute_layered_max_flow(capacity, sources=[mask_idx], debug=debug)[0]
+        flow_vector = flow_vector / (flow_vector.sum() + 1e-8)
+        return flow_vector.reshape(1, seq_len)
+
+    flow_matrix = compute_layered_max_flow(capacity, debug=debug)
+    # Normalize each row to sum to 1.0; rows without any flow are distributed evenly
+    flow_sum = flow_matrix.sum(axis=-1, keepdims=True)
+    flow_matrix = np.where(flow_sum > 0, flow_matrix / np.where(flow_sum > 0, flow_sum, 1.0), 1.0 / seq_len)
+    if debug:
+        print("[DEBUG] Final layered flow matrix:")
+        print(flow_matrix)
+    return flow_matrix
@@ -1,89 +1,79 @@
+import math
 import torch
 import numpy as np
-import networkx as nx
 from typing import List, Dict, Any, Optional, Tuple
+from attention_flow import build_graph, layered_edges, compute_joint_attentions, compute_attention_flow
+from attention_sparse import sparsify_attention, sparse_matrix
 
 #############################################
-# Attention Rollout Calculation Function
+# Attention Rollout Calculation Functions
 #############################################
-def compute_attention_rollout(attentions, add_identity: bool = True, debug: bool = False):
+def _prefix_matmul(matrices: torch.Tensor) -> torch.Tensor:
     """
-    Compute attention rollout from raw attention matrices
-    
+    Inclusive prefix products M_0, M_0 @ M_1, ..., M_0 @ ... @ M_{L-1} of a stack of matrices
+
+    Uses a log-depth scan: every step multiplies all layers at once with the
+    partial product ending `offset` layers earlier.
+    """
+    prefix = matrices.clone()
+    offset = 1
+    while offset < prefix.size(0):
+        prefix[offset:] = prefix[:-offset] @ prefix[offset:]
+        offset *= 2
+    return prefix
+
+def _rollout_transitions(stacked: torch.Tensor, add_identity: bool = True) -> torch.Tensor:
+    """Row-normalized head-mean attention (plus identity) of stacked (num_layers, seq_len, seq_len) matrices"""
+    if add_identity:
+        stacked = stacked + torch.eye(stacked.size(-1))
+    stacked = stacked / (stacked.sum(dim=-1, keepdim=True) + 1e-8)
+    return torch.nan_to_num(stacked, nan=0.0, posinf=0.0, neginf=0.0)
+
+def _normalize_rollout(rollout: torch.Tensor) -> torch.Tensor:
+    """Normalize rollout rows to sum to 1.0 exactly; rows with zero sum are distributed evenly"""
+    rollout_sum = rollout.sum(dim=-1, keepdim=True)
+    even_dist = torch.full_like(rollout, 1.0 / rollout.size(-1))
+    return torch.where(rollout_sum == 0, even_dist, rollout / torch.where(rollout_sum == 0, torch.ones_like(rollout_sum), rollout_sum))
+
+def compute_attention_rollout_per_layer(attentions, add_identity: bool = True, debug: bool = False):
+    """
+    Compute cumulative attention rollout up to every layer
+
     Args:
         attentions: List of attention tensors from the model
         add_identity: Whether to add identity matrix to each attention layer
         debug: Whether to print debug information
-        
+
     Returns:
-        The attention rollout matrix
+        Tensor of shape (num_layers, seq_len, seq_len) where entry i is the rollout through layer i
     """
-    num_layers = len(attentions)
-    seq_len = attentions[0].size(-1)
-    rollout = torch.eye(seq_len)
-    for i, att in enumerate(attentions):
-        att_avg = att.squeeze(0).mean(dim=0)
-        if add_identity:
-            att_aug = att_avg + torch.eye(seq_len)
-        else:
-            att_aug = att_avg
-        att_aug = att_aug / (att_aug.sum(dim=-1, keepdim=True) + 1e-8)
-        att_aug = torch.nan_to_num(att_aug, nan=0.0, posinf=0.0, neginf=0.0)
-        rollout = rollout @ att_aug
-        if debug:
+    stacked = torch.stack([att.squeeze(0) for att in attentions]).mean(dim=1).float().cpu()
+    stacked = _rollout_transitions(stacked, add_identity)
+    rollout = _prefix_matmul(stacked)
+    if debug:
+        for i in range(rollout.size(0)):
             print(f"[DEBUG] Rollout after layer {i+1}:")
-            print(att_aug)
-            print(rollout)
-    
-    # Normalize rollout to ensure it sums to 1.0 exactly
-    rollout_sum = rollout.sum(dim=-1, keepdim=True)
-    # Handle zero sums to avoid division by zero
-    is_zero_sum = (rollout_sum == 0)
-    if is_zero_sum.any():
-        # For rows with zero sum, distribute evenly
-        seq_len = rollout.size(-1)
-        even_dist = torch.ones_like(rollout) / seq_len
-        rollout = torch.where(is_zero_sum, even_dist, rollout / rollout_sum)
-    else:
-        rollout = rollout / rollout_sum
-        
-    return rollout
+            print(stacked[i])
+            print(rollout[i])
 
-#############################################
-# Capacity Graph Construction Function (for Flow)
-#############################################
-def build_graph(joint_attentions, input_tokens, remove_diag: bool = False, debug: bool = False):
+    return _normalize_rollout(rollout)
+
+def rollout_step(product: Optional[torch.Tensor], attention: torch.Tensor, add_identity: bool = True) -> Tuple[torch.Tensor, torch.Tensor]:
     """
-    Build a graph representation for attention flow computation
-    
+    Extend an attention rollout by one layer, to compute it while the layers come in
+
     Args:
-        joint_attentions: Joint attention matrices
-        input_tokens: List of input token text
-        remove_diag: Whether to remove diagonal elements (self-attention)
-        debug: Whether to print debug information
-        
+        product: Unnormalized rollout through the previous layer, None before the first layer
+        attention: Attention tensor of the next layer, shape (1, num_heads, seq_len, seq_len)
+        add_identity: Whether to add identity matrix to the attention
+
     Returns:
-        Tuple of (capacity matrix, node labels dictionary)
+        The unnormalized rollout through this layer (for the next step) and the
+        rollout through this layer as returned by compute_attention_rollout_per_layer
     """
-    n_layers, seq_len, _ = joint_attentions.shape
-    total_nodes = (n_layers + 1) * seq_len
-    capacity = np.zeros((total_nodes, total_nodes))
-    labels = {}
-    for k in range(seq_len):
-        labels[k] = f"0_{k}_{input_tokens[k]}"
-    for i in range(1, n_layers + 1):
-        for k_to in range(seq_len):
-            node_to = i * seq_len + k_to
-            labels[node_to] = f"L{i}_{k_to}"
-            for k_from in range(seq_len):
-                if remove_diag and (k_from == k_to):
-                    continue
-                node_from = (i - 1) * seq_len + k_from
-                cap = joint_attentions[i - 1][k_from][k_to]
-                capacity[node_from][node_to] = cap
-                if debug:
-                    print(f"[DEBUG] Edge from {labels[node_from]} to {labels[node_to]} with capacity: {cap:.6f}")
-    return capacity, labels
+    transition = _rollout_transitions(attention.squeeze(0).mean(dim=0, keepdim=True).float().cpu(), add_identity)[0]
+    product = transition if product is None else product @ transition
+    return product, _normalize_rollout(product)
 
 #############################################
 # Attention Flow Calculation Function (using networkx)
@@ -103,26 +93,17 @@ def compute_attention_flow_networkx(attentions, add_identity: bool = True, debug
     """
     num_layers = len(attentions)
     seq_len = attentions[0].size(-1)
-    joint_attentions = []
-    for att in attentions:
-        att_avg = att.squeeze(0).mean(dim=0)
-        if add_identity:
-            alpha = 0.5
-            att_aug = (att_avg + torch.eye(seq_len)) * alpha
-        else:
-            att_aug = att_avg
-        att_aug = att_aug / (att_aug.sum(dim=-1, keepdim=True) + 1e-8)
-        joint_attentions.append(att_aug.cpu().numpy())
-    joint_attentions = np.stack(joint_attentions, axis=0)
+    joint_attentions = compute_joint_attentions(attentions, add_identity=add_identity)
     input_tokens = [str(i) for i in range(seq_len)]
     capacity, labels = build_graph(joint_attentions, input_tokens, remove_diag=False, debug=debug)
-    total_nodes = capacity.shape[0]
+    import networkx as nx
+
     G = nx.DiGraph()
-    for u in range(total_nodes):
-        for v in range(total_nodes):
-            cap = capacity[u][v]
-            if cap > 1e-8:
-                G.add_edge(u, v, capacity=float(cap))
+    sources, targets, capacities = layered_edges(capacity)
+    G.add_edges_from(
+        (u, v, {"capacity": cap})
+        for u, v, cap in zip(sources.tolist(), targets.tolist(), capacities.tolist())
+    )
     if mask_idx is not None:
         source = mask_idx
         flow_vector = np.zeros(seq_len)
@@ -165,76 +146,141 @@ def compute_attention_flow_networkx(attentions, add_identity: bool = True, debug
 #############################################
 # Process Attention with Selected Method
 #############################################
-def process_attention_with_method(attention_matrices, method: str = "raw", debug: bool = False) -> List[Dict[str, Any]]:
+def compute_attention_with_method(attention_matrices, method: str = "raw", debug: bool = False) -> np.ndarray:
     """
-    Process attention matrices using the specified method
-    
+    Compute the attention to display for the specified method as one stacked array
+
     Args:
         attention_matrices: List of attention tensors from the model
         method: Method to use (raw, rollout, flow)
         debug: Whether to print debug information
-        
+
     Returns:
-        Processed attention data in the same format as the original attention data
+        Array of shape (num_layers, num_heads, seq_len, seq_len) for raw attention, or
+        (num_layers, seq_len, seq_len) for rollout and flow, which are the same for every head
     """
     if method == "raw":
-        # Return raw attention as is
-        return attention_matrices
-    
-    # Convert to list if it's a tuple
-    if isinstance(attention_matrices, tuple):
-        attention_matrices = list(attention_matrices)
-    
-    # Get dimensions
+        return torch.stack([att[0] for att in attention_matrices]).cpu().numpy()
+
     num_layers = len(attention_matrices)
-    
     if method == "rollout":
-        # Calculate rollout attention
-        rollout_matrix = compute_attention_rollout(attention_matrices, add_identity=True, debug=debug)
-        
-        # Create new attention matrices with rollout values
-        new_attention_matrices = []
-        for layer_idx in range(num_layers):
-            # For each layer, we'll use the same rollout matrix for all heads
-            heads = attention_matrices[layer_idx].shape[1]  # Number of heads
-            layer_data = {"layerIndex": layer_idx, "heads": []}
-            
-            for head_idx in range(heads):
-                # Convert rollout matrix to list format for this head
-                attention_matrix = rollout_matrix.cpu().tolist()
-                
-                layer_data["heads"].append({
-                    "headIndex": head_idx,
-                    "attention": attention_matrix
-                })
-            
-            new_attention_matrices.append(layer_data)
-        
-        return new_attention_matrices
-    
+        # Cumulative rollout through each layer
+        return compute_attention_rollout_per_layer(attention_matrices, add_identity=True, debug=debug).numpy()
+
     elif method == "flow":
-        # Calculate flow attention
-        flow_matrix = compute_attention_flow_networkx(attention_matrices, add_identity=True, debug=debug)
-        
-        # Create new attention matrices with flow values
-        new_attention_matrices = []
-        for layer_idx in range(num_layers):
-            # For each layer, we'll use the same flow matrix for all heads
-            heads = attention_matrices[layer_idx].shape[1]  # Number of heads
-            layer_data = {"layerIndex": layer_idx, "heads": []}
-            
-            for head_idx in range(heads):
-                # Convert flow matrix to list format for this head
-                attention_matrix = flow_matrix.tolist()
-                
-                layer_data["heads"].append({
-                    "headIndex": head_idx,
-                    "attention": attention_matrix
-                })
-            
-            new_attention_matrices.append(layer_data)
-        
-        return new_attention_matrices
-    
+        # Flow from the input tokens to the output of the last layer, shown on every layer
+        flow_matrix = compute_attention_flow(attention_matrices, add_identity=True, debug=debug)
+        return np.broadcast_to(flow_matrix, (num_layers,) + flow_matrix.shape)
+
+    else:
+        raise ValueError(f"Unknown attention processing method: {method}")
+
+def build_layers(attention: np.ndarray, num_heads: int, share_heads: bool = False,
+                 layer_indices: Optional[List[int]] = None, head_indices: Optional[List[int]] = None,
+                 sparse_top_k: Optional[int] = None, sparse_mass: Optional[float] = None) -> List[Dict[str, Any]]:
+    """
+    Build the response layers from an array returned by compute_attention_with_method
+
+    Head-independent matrices are converted to lists once. With share_heads the
+    matrix is sent once on the layer and the heads only carry their index;
+    otherwise every head references the same list so the response keeps its
+    per-head layout.
+
+    Args:
+        attention: Array of shape (num_layers, num_heads, seq_len, seq_len) or (num_layers, seq_len, seq_len)
+        num_heads: Number of heads per layer
+        share_heads: Whether to send one shared matrix per layer
+        layer_indices: Model layer index of every layer of attention, 0..num_layers-1 for None
+        head_indices: Model head index of every head, 0..num_heads-1 for None
+        sparse_top_k: Send the matrices as "sparse" CSR rows with at most this many entries, see attention_sparse.py
+        sparse_mass: Send the matrices as "sparse" CSR rows with the entries that make up this share of each row
+
+    Returns:
+        List of layer dictionaries in the attention response format
+    """
+    layer_indices = layer_indices if layer_indices is not None else range(len(attention))
+    head_indices = head_indices if head_indices is not None else range(num_heads)
+    # A matrix broadcast over the layers (flow) only needs to be converted once
+    repeated = attention.ndim == 3 and isinstance(attention, np.ndarray) and attention.strides[0] == 0
+    if sparse_top_k is not None or sparse_mass is not None:
+        field = "sparse"
+        sparse = sparsify_attention(attention[:1] if repeated else attention, sparse_top_k, sparse_mass)
+        convert = lambda *index: sparse_matrix(sparse, *index)
     else:
-        raise ValueError(f"Unknown attention processing method: {method}") 
\ No newline at end of file
+        field = "attention"
+        convert = lambda *index: attention[index].tolist()
+
+    layers = []
+    if attention.ndim == 4:
+        for position, layer_idx in enumerate(layer_indices):
+            layers.append({
+                "layerIndex": layer_idx,
+                "heads": [
+                    {"headIndex": head_idx, field: convert(position, head_position)}
+                    for head_position, head_idx in enumerate(head_indices)
+                ]
+            })
+        return layers
+
+    shared_matrix = convert(0) if repeated else None
+    for position, layer_idx in enumerate(layer_indices):
+        attention_matrix = shared_matrix if repeated else convert(position)
+        if share_heads:
+            layers.append({
+                "layerIndex": layer_idx,
+                field: attention_matrix,
+                "heads": [{"headIndex": head_idx} for head_idx in head_indices]
+            })
+        else:
+            layers.append({
+                "layerIndex": layer_idx,
+                "heads": [{"headIndex": head_idx, field: attention_matrix} for head_idx in head_indices]
+            })
+    return layers
+
+#############################################
+# Per-head Attention Statistics
+#############################################
+HEAD_METRICS = (
+    "entropy",             # Mean row entropy in nats (at most log(seq_len))
+    "normalized_entropy",  # Mean row entropy divided by log(seq_len): 0 focused, 1 uniform
+    "mean_distance",       # Mean distance |i - j| in tokens between a token and what it attends to
+    "cls_mass",            # Mean attention on the first token ([CLS] / <s>)
+    "sep_mass",            # Mean attention on the last token ([SEP] / </s>)
+    "self_mass",           # Mean attention of a token on itself (diagonal)
+    "prev_mass",           # Mean attention on the previous token
+    "next_mass",           # Mean attention on the next token
+    "max_value",           # Mean of the largest value of each row (concentration)
+)
+
+def compute_head_statistics(attentions: torch.Tensor) -> torch.Tensor:
+    """
+    Summary metrics of every attention head, in one vectorized pass over all layers and heads
+
+    Args:
+        attentions: Stacked attention of shape (num_layers, num_heads, seq_len, seq_len)
+
+    Returns:
+        Tensor of shape (num_layers, num_heads, len(HEAD_METRICS)), metrics in HEAD_METRICS order
+    """
+    attentions = attentions.float()
+    seq_len = attentions.size(-1)
+    positions = torch.arange(seq_len)
+    distance = (positions[:, None] - positions[None, :]).abs().float()
+    entropy = -(attentions * attentions.clamp_min(1e-12).log()).sum(dim=-1).mean(dim=-1)
+
+    def mean_diagonal(offset):
+        diagonal = attentions.diagonal(offset=offset, dim1=-2, dim2=-1)
+        return diagonal.mean(dim=-1) if diagonal.size(-1) else torch.zeros(attentions.shape[:2])
+
+    return torch.stack([
+        entropy,
+        entropy / math.log(seq_len) if seq_len > 1 else torch.zeros_like(entropy),
+        (attentions * distance).sum(dim=-1).mean(dim=-1),
+        attentions[..., 0].mean(dim=-1),
+        attentions[..., -1].mean(dim=-1),
+        mean_diagonal(0),
+        mean_diagonal(-1),
+        mean_diagonal(1),
+        attentions.max(dim=-1).values.mean(dim=-1),
+    ], dim=-1)
@@ -0,0 +1,76 @@
+import numpy as np
+from typing import Any, Dict, Optional
+from fastapi import HTTPException
+
+# Sparse attention output: every row keeps its largest entries, at most top_k of
+# them and only as many as it takes to reach `mass` of the row's attention.
+# Rows are stored CSR-style (indptr/indices/values, columns in ascending order)
+# with the dropped attention mass of every row in `residual`.
+
+def validate_sparse_options(top_k: Optional[int], mass: Optional[float]) -> None:
+    """Reject invalid sparse options (400)"""
+    if top_k is not None and top_k < 1:
+        raise HTTPException(status_code=400, detail="sparse_top_k must be at least 1")
+    if mass is not None and not 0 < mass <= 1:
+        raise HTTPException(status_code=400, detail="sparse_mass must be greater than 0 and at most 1")
+
+def sparsify_attention(attention: np.ndarray, top_k: Optional[int] = None, mass: Optional[float] = None) -> Dict[str, Any]:
+    """
+    Keep the largest entries of every attention row, in one vectorized pass
+
+    Args:
+        attention: Array of shape (..., seq_len, seq_len), e.g. from compute_attention_with_method
+        top_k: Most entries kept per row, no limit for None
+        mass: Stop keeping entries of a row once they add up to this share of the
+            row's attention (0-1), no limit for None
+
+    Returns:
+        Dictionary with, for every matrix of the leading dimensions, CSR arrays
+        that start at 0 for each matrix: "indptr" (..., seq_len + 1), "residual"
+        (..., seq_len), and the flat "indices"/"values" of all matrices in order,
+        split by "offsets" (one more than the number of matrices)
+    """
+    seq_len = attention.shape[-1]
+    rows = np.asarray(attention, dtype=np.float32).reshape(-1, seq_len)
+    row_sums = rows.sum(axis=-1)
+    if top_k is not None and top_k < seq_len:
+        # Only the top_k candidates of every row need to be ranked
+        candidates = np.argpartition(-rows, top_k - 1, axis=-1)[:, :top_k]
+    else:
+        candidates = np.broadcast_to(np.arange(seq_len), rows.shape)
+    candidate_values = np.take_along_axis(rows, candidates, axis=-1)
+    ranking = np.argsort(-candidate_values, axis=-1, kind="stable")
+    order = np.take_along_axis(candidates, ranking, axis=-1)
+    ranked = np.take_along_axis(candidate_values, ranking, axis=-1)
+    keep_ranked = np.ones_like(ranked, dtype=bool)
+    if mass is not None:
+        # An entry is kept while the mass before it is still short of the target
+        mass_before = np.cumsum(ranked, axis=-1) - ranked
+        keep_ranked &= mass_before < mass * row_sums[:, None]
+    keep = np.zeros_like(rows, dtype=bool)
+    np.put_along_axis(keep, order, keep_ranked, axis=-1)
+
+    counts = keep.sum(axis=-1)
+    matrix_shape = attention.shape[:-2]
+    counts_per_matrix = counts.reshape(-1, seq_len)
+    indptr = np.zeros((counts_per_matrix.shape[0], seq_len + 1), dtype=np.int64)
+    np.cumsum(counts_per_matrix, axis=-1, out=indptr[:, 1:])
+    offsets = np.concatenate([[0], np.cumsum(indptr[:, -1])])
+    return {
+        "indptr": indptr.reshape(matrix_shape + (seq_len + 1,)),
+        "indices": np.nonzero(keep)[1].astype(np.int32),
+        "values": rows[keep],
+        "residual": (row_sums - np.where(keep_ranked, ranked, 0).sum(axis=-1)).reshape(matrix_shape + (seq_len,)),
+        "offsets": offsets,
+    }
+
+def sparse_matrix(sparse: Dict[str, Any], *index: int) -> Dict[str, Any]:
+    """The JSON CSR form of one matrix of a sparsify_attention result, e.g. sparse_matrix(sparse, layer, head)"""
+    flat_index = int(np.ravel_multi_index(index, sparse["indptr"].shape[:-1])) if index else 0
+    start, end = sparse["offsets"][flat_index], sparse["offsets"][flat_index + 1]
+    return {
+        "indptr": sparse["indptr"][index].tolist(),
+        "indices": sparse["indices"][start:end].tolist(),
+        "values": sparse["values"][start:end].tolist(),
+        "residual": sparse["residual"][index].tolist(),
+    }
@@ -0,0 +1,105 @@
+"""
+Compare the JSON attention response with the binary attention payloads.
+
+Measures response size and encode/decode time for raw attention of a
+bert-base sized model (12 layers x 12 heads) at several sentence lengths,
+dense and as sparse rows that keep the --sparse-top-k largest entries
+(max abs err then includes the dropped entries).
+
+Usage (from the backend directory):
+    python benchmarks/bench_attention_encoding.py --lengths 16 64 128
+    python benchmarks/bench_attention_encoding.py --lengths 128 256 --sparse-top-k 8
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from attention_encoding import encode_attention_payload, decode_attention_payload
+from attention_processing import build_layers
+from classes import AttentionResponse
+
+
+def timed(fn, *args, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn(*args)
+        best = min(best, time.perf_counter() - start)
+    return result, best
+
+
+def encode_json(result, sparse_top_k=None):
+    attention_data = {"tokens": result["tokens"], "layers": build_layers(result["attention"], result["num_heads"], sparse_top_k=sparse_top_k)}
+    response = AttentionResponse.model_validate({"attention_data": attention_data})
+    return response.model_dump_json(exclude_none=True).encode("utf-8")
+
+
+def decode_json(payload):
+    data = json.loads(payload)["attention_data"]
+    return np.array([[head["attention"] for head in layer["heads"]] for layer in data["layers"]], dtype=np.float32)
+
+
+def decode_sparse_json(payload):
+    data = json.loads(payload)["attention_data"]
+    seq_len = len(data["tokens"])
+    matrices = []
+    for layer in data["layers"]:
+        for head in layer["heads"]:
+            sparse = head["sparse"]
+            rows = np.repeat(np.arange(seq_len), np.diff(sparse["indptr"]))
+            matrix = np.zeros((seq_len, seq_len), dtype=np.float32)
+            matrix[rows, sparse["indices"]] = sparse["values"]
+            matrices.append(matrix)
+    return np.array(matrices).reshape(len(data["layers"]), -1, seq_len, seq_len)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lengths", type=int, nargs="+", default=[16, 64, 128])
+    parser.add_argument("--layers", type=int, default=12)
+    parser.add_argument("--heads", type=int, default=12)
+    parser.add_argument("--sparse-top-k", type=int, default=8)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    print(f"{'seq_len':>8} {'format':>8} {'bytes':>12} {'encode (ms)':>12} {'decode (ms)':>12} {'max abs err':>12}")
+    for seq_len in args.lengths:
+        logits = rng.normal(size=(args.layers, args.heads, seq_len, seq_len)) * 3
+        attention = np.exp(logits - logits.max(axis=-1, keepdims=True))
+        attention = (attention / attention.sum(axis=-1, keepdims=True)).astype(np.float32)
+        result = {
+            "tokens": [{"text": f"tok{i}", "index": i} for i in range(seq_len)],
+            "attention": attention,
+            "num_heads": args.heads,
+        }
+
+        payload, encode_time = timed(encode_json, result)
+        decoded, decode_time = timed(decode_json, payload)
+        error = np.abs(decoded - attention).max()
+        print(f"{seq_len:>8} {'json':>8} {len(payload):>12,} {encode_time * 1000:>12.1f} {decode_time * 1000:>12.1f} {error:>12.2e}")
+
+        for dtype in ("float16", "uint8"):
+            payload, encode_time = timed(encode_attention_payload, {"attention": result}, dtype)
+            decoded, decode_time = timed(decode_attention_payload, payload)
+            error = np.abs(decoded["attention"]["attention"] - attention).max()
+            print(f"{seq_len:>8} {dtype:>8} {len(payload):>12,} {encode_time * 1000:>12.1f} {decode_time * 1000:>12.1f} {error:>12.2e}")
+
+        payload, encode_time = timed(encode_json, result, args.sparse_top_k)
+        decoded, decode_time = timed(decode_sparse_json, payload)
+        error = np.abs(decoded - attention).max()
+        print(f"{seq_len:>8} {'json-csr':>8} {len(payload):>12,} {encode_time * 1000:>12.1f} {decode_time * 1000:>12.1f} {error:>12.2e}")
+
+        payload, encode_time = timed(encode_attention_payload, {"attention": result}, "float16", None, args.sparse_top_k)
+        decoded, decode_time = timed(decode_attention_payload, payload)
+        error = np.abs(decoded["attention"]["attention"] - attention).max()
+        print(f"{seq_len:>8} {'f16-csr':>8} {len(payload):>12,} {encode_time * 1000:>12.1f} {decode_time * 1000:>12.1f} {error:>12.2e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark eager inference against bucketed traced/compiled graphs on CPU.
+
+Runs the encoder of a model with attentions (as /attention does) on random
+sequence lengths between --min-length and --max-length, one request at a time,
+through the inference backends in bucketed_inference.py. Graphs are built for
+every bucket before timing; the build time is reported separately. Reports
+p50/p99 latency overall and per length band, and the largest attention
+difference against the eager backend.
+
+Usage (from the backend directory):
+    python benchmarks/bench_bucketed_inference.py --model bert-base-uncased --requests 200
+    python benchmarks/bench_bucketed_inference.py --backends eager traced compiled
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import numpy as np
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from bucketed_inference import run_forward, bucketed_forward, LENGTH_BUCKETS
+from helpers import get_model_and_tokenizer
+
+
+def make_batch(tokenizer, length, rng):
+    special = set(tokenizer.all_special_ids)
+    vocabulary = [i for i in range(min(tokenizer.vocab_size, 30000)) if i not in special]
+    start_id = tokenizer.cls_token_id if tokenizer.cls_token_id is not None else tokenizer.bos_token_id
+    end_id = tokenizer.sep_token_id if tokenizer.sep_token_id is not None else tokenizer.eos_token_id
+    input_ids = torch.tensor([[start_id] + rng.choices(vocabulary, k=length - 2) + [end_id]])
+    batch = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+    if "token_type_ids" in tokenizer.model_input_names:
+        batch["token_type_ids"] = torch.zeros_like(input_ids)
+    return batch
+
+
+def attentions_of(encoder, batch, pad_token_id, backend):
+    length = batch["input_ids"].size(1)
+    outputs = run_forward(encoder, batch, pad_token_id, output_attentions=True, backend=backend)
+    return torch.cat([att[:, :, :length, :length] for att in outputs.attentions])
+
+
+def percentile(values, q):
+    return float(np.percentile(values, q)) * 1e3
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="bert-base-uncased")
+    parser.add_argument("--backends", nargs="+", default=["eager", "traced"], choices=["eager", "traced", "compiled"])
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--min-length", type=int, default=8)
+    parser.add_argument("--max-length", type=int, default=256)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    model, tokenizer = get_model_and_tokenizer(args.model)
+    encoder = model.base_model
+    pad_token_id = tokenizer.pad_token_id or 0
+    rng = random.Random(args.seed)
+    lengths = [rng.randint(args.min_length, args.max_length) for _ in range(args.requests)]
+    batches = [make_batch(tokenizer, length, rng) for length in lengths]
+    bands = [(low, min(high, args.max_length)) for low, high in zip([args.min_length] + [bucket + 1 for bucket in LENGTH_BUCKETS], LENGTH_BUCKETS)
+             if low <= args.max_length]
+
+    print(f"{args.model}, {args.requests} requests with lengths {args.min_length}-{args.max_length}, "
+          f"buckets {LENGTH_BUCKETS}, {torch.get_num_threads()} threads")
+    reference = [attentions_of(encoder, batch, pad_token_id, "eager") for batch in batches]
+    for backend in args.backends:
+        if backend != "eager":
+            built, start = bucketed_forward.graphs_built, time.perf_counter()
+            for low, high in bands:
+                attentions_of(encoder, make_batch(tokenizer, high, rng), pad_token_id, backend)
+            print(f"{backend}: built {bucketed_forward.graphs_built - built} graphs in {time.perf_counter() - start:.1f}s")
+
+        times, max_err = [], 0.0
+        for batch, expected in zip(batches, reference):
+            start = time.perf_counter()
+            attentions = attentions_of(encoder, batch, pad_token_id, backend)
+            times.append(time.perf_counter() - start)
+            max_err = max(max_err, (attentions - expected).abs().max().item())
+        times = np.array(times)
+        print(f"{backend}: p50 {percentile(times, 50):.1f} ms, p99 {percentile(times, 99):.1f} ms, "
+              f"max attention diff vs eager {max_err:.2e}")
+        for low, high in bands:
+            band = times[[low <= length <= high for length in lengths]]
+            if len(band):
+                print(f"  lengths {low:>3}-{high:<3} ({len(band):>3} requests): p50 {percentile(band, 50):7.1f} ms, p99 {percentile(band, 99):7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Measure the cold import time of main:app and check it against a budget.
+
+Every run imports main in a fresh interpreter, so nothing is cached in
+sys.modules. Also reports the slowest top-level imports (python -X importtime)
+and fails when heavy libraries that should only be loaded on first use
+(transformers, nltk, networkx) are imported by main.
+
+Usage (from the backend directory):
+    python benchmarks/bench_import_time.py --runs 5 --budget 3.0
+
+Exits with status 1 when the median import time exceeds the budget
+(IMPORT_TIME_BUDGET_S, default 3 seconds) or a lazy library was imported.
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+LAZY_MODULES = ["transformers", "nltk", "networkx"]
+
+IMPORT_SCRIPT = """
+import sys, time
+start = time.perf_counter()
+import main
+elapsed = time.perf_counter() - start
+print(elapsed, ",".join(name for name in {lazy!r} if name in sys.modules), sep=";")
+"""
+
+
+def import_once():
+    output = subprocess.run(
+        [sys.executable, "-c", IMPORT_SCRIPT.format(lazy=LAZY_MODULES)],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True,
+    ).stdout.strip().splitlines()
+    elapsed, loaded = output[-1].split(";")
+    return float(elapsed), [name for name in loaded.split(",") if name]
+
+
+def slowest_imports(count):
+    stderr = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=BACKEND_DIR, capture_output=True, text=True, check=True,
+    ).stderr
+    rows = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line.split("|")
+        if cumulative.strip().isdigit() and name.startswith("   ") and not name.startswith("     "):
+            # Direct imports of main (one level of indentation)
+            rows.append((int(cumulative), name.strip()))
+    return sorted(rows, reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=float(os.environ.get("IMPORT_TIME_BUDGET_S", "3.0")),
+                        help="maximum median import time in seconds")
+    parser.add_argument("--top", type=int, default=8, help="number of slowest imports to show")
+    args = parser.parse_args()
+
+    times, eager = [], set()
+    for _ in range(args.runs):
+        elapsed, loaded = import_once()
+        times.append(elapsed)
+        eager.update(loaded)
+    median = statistics.median(times)
+
+    print(f"import main: median {median:.2f}s, min {min(times):.2f}s, max {max(times):.2f}s over {args.runs} runs")
+    print("slowest direct imports of main:")
+    for cumulative, name in slowest_imports(args.top):
+        print(f"  {cumulative / 1e6:6.2f}s  {name}")
+
+    failed = False
+    if eager:
+        print(f"FAIL: imported at startup instead of on first use: {sorted(eager)}")
+        failed = True
+    if median > args.budget:
+        print(f"FAIL: median import time {median:.2f}s exceeds the budget of {args.budget:.2f}s")
+        failed = True
+    if not failed:
+        print(f"OK: within the budget of {args.budget:.2f}s")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Accuracy report and benchmark of the int8 (dynamically quantized) inference mode.
+
+Loads a model in fp32 and its int8 copy through the model registry and reports:
+  - accuracy: the difference between the fp32 and int8 attention matrices
+    (max/mean absolute error and how often each row attends most to the same
+    token), and the agreement of the masked LM predictions when every word
+    token of the sample sentences is masked in turn (top-1 agreement and
+    top-k overlap)
+  - latency: median and p90 of the encoder forward pass (with attentions) at
+    several sequence lengths
+  - memory: the registry footprint of both variants
+
+Usage (from the backend directory):
+    python benchmarks/bench_int8_quantization.py --model bert-base-uncased --lengths 16 64 128
+"""
+import argparse
+import os
+import statistics
+import sys
+import time
+
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from helpers import get_model_and_tokenizer
+from model_registry import model_footprint
+
+SENTENCES = [
+    "The cat sat on the mat.",
+    "The quick brown fox jumps over the lazy dog.",
+    "She went to the bank to deposit her paycheck before noon.",
+    "Attention patterns change when a single word in the sentence is replaced.",
+    "Researchers trained the model on a large corpus of English text.",
+]
+
+
+def attention_accuracy(fp32, int8, tokenizer):
+    max_err, errors, agreement = 0.0, [], []
+    for sentence in SENTENCES:
+        inputs = tokenizer(sentence, return_tensors="pt")
+        with torch.no_grad():
+            reference = torch.cat(fp32.base_model(**inputs, output_attentions=True).attentions)
+            quantized = torch.cat(int8.base_model(**inputs, output_attentions=True).attentions)
+        diff = (reference - quantized).abs()
+        max_err = max(max_err, diff.max().item())
+        errors.append(diff.mean().item())
+        agreement.append((reference.argmax(-1) == quantized.argmax(-1)).float().mean().item())
+    return max_err, statistics.mean(errors), statistics.mean(agreement)
+
+
+def prediction_accuracy(fp32, int8, tokenizer, top_k):
+    top1, overlap = [], []
+    for sentence in SENTENCES:
+        input_ids = tokenizer(sentence, return_tensors="pt")["input_ids"]
+        special = set(tokenizer.all_special_ids)
+        for position in range(input_ids.shape[1]):
+            if input_ids[0, position].item() in special:
+                continue
+            masked = input_ids.clone()
+            masked[0, position] = tokenizer.mask_token_id
+            with torch.no_grad():
+                reference = fp32(input_ids=masked).logits[0, position].topk(top_k).indices.tolist()
+                quantized = int8(input_ids=masked).logits[0, position].topk(top_k).indices.tolist()
+            top1.append(reference[0] == quantized[0])
+            overlap.append(len(set(reference) & set(quantized)) / top_k)
+    return statistics.mean(top1), statistics.mean(overlap), len(top1)
+
+
+def forward_latency(model, tokenizer, seq_len, runs):
+    ids = tokenizer(" ".join(SENTENCES), add_special_tokens=False)["input_ids"]
+    ids = (ids * (seq_len // len(ids) + 1))[:seq_len - 2]
+    input_ids = torch.tensor([[tokenizer.cls_token_id or tokenizer.bos_token_id] + ids + [tokenizer.sep_token_id or tokenizer.eos_token_id]])
+    times = []
+    with torch.no_grad():
+        model.base_model(input_ids=input_ids, output_attentions=True)
+        for _ in range(runs):
+            start = time.perf_counter()
+            model.base_model(input_ids=input_ids, output_attentions=True)
+            times.append(time.perf_counter() - start)
+    times.sort()
+    return statistics.median(times), times[int(0.9 * (len(times) - 1))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--model", default="bert-base-uncased")
+    parser.add_argument("--lengths", type=int, nargs="+", default=[16, 64, 128])
+    parser.add_argument("--runs", type=int, default=20)
+    parser.add_argument("--top-k", type=int, default=5)
+    args = parser.parse_args()
+
+    fp32, tokenizer = get_model_and_tokenizer(args.model, precision="fp32")
+    int8, _ = get_model_and_tokenizer(args.model, precision="int8")
+    fp32 = fp32.cpu()
+
+    print(f"accuracy of int8 vs fp32 ({args.model}, {len(SENTENCES)} sentences)")
+    max_err, mean_err, argmax_agreement = attention_accuracy(fp32, int8, tokenizer)
+    print(f"  attention: max abs err {max_err:.4f}, mean abs err {mean_err:.5f}, same most-attended token {argmax_agreement:.1%}")
+    top1, overlap, masked = prediction_accuracy(fp32, int8, tokenizer, args.top_k)
+    print(f"  masked LM ({masked} masked tokens): top-1 agreement {top1:.1%}, top-{args.top_k} overlap {overlap:.1%}")
+
+    fp32_bytes, int8_bytes = model_footprint(fp32), model_footprint(int8)
+    print(f"memory: fp32 {fp32_bytes / 2**20:.1f} MB, int8 {int8_bytes / 2**20:.1f} MB ({int8_bytes / fp32_bytes:.0%})")
+
+    print(f"encoder latency with attentions (median / p90 over {args.runs} runs, {torch.get_num_threads()} threads)")
+    print(f"{'seq_len':>8} {'fp32 (ms)':>16} {'int8 (ms)':>16} {'speedup':>8}")
+    for seq_len in args.lengths:
+        fp32_median, fp32_p90 = forward_latency(fp32, tokenizer, seq_len, args.runs)
+        int8_median, int8_p90 = forward_latency(int8, tokenizer, seq_len, args.runs)
+        print(f"{seq_len:>8} {fp32_median * 1e3:>7.1f} / {fp32_p90 * 1e3:>6.1f} {int8_median * 1e3:>7.1f} / {int8_p90 * 1e3:>6.1f} "
+              f"{fp32_median / int8_median:>7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
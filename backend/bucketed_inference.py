@@ -0,0 +1,208 @@
+import os
+import threading
+import time
+import warnings
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional, Tuple
+import torch
+from attention_capture import early_exit_forward
+
+# Inference backends: "eager" runs every batch at its exact length; "traced"
+# (torch.jit.trace) and "compiled" (torch.compile) pad batches to a length
+# bucket and run one graph per (model, bucket, batch size bucket). Padding is
+# masked out and trimmed, so the attentions match the eager ones.
+INFERENCE_BACKENDS = ("eager", "traced", "compiled")
+INFERENCE_BACKEND = os.environ.get("INFERENCE_BACKEND", "eager")
+LENGTH_BUCKETS = sorted(int(length) for length in os.environ.get("LENGTH_BUCKETS", "16,32,64,128,256,512").split(",") if length.strip())
+
+def bucket_length(length: int, buckets: List[int] = LENGTH_BUCKETS) -> int:
+    """The smallest bucket that fits length, or length itself when it exceeds every bucket"""
+    for bucket in buckets:
+        if bucket >= length:
+            return bucket
+    return length
+
+def bucket_batch_size(batch_size: int) -> int:
+    """Batch sizes are rounded up to a power of two so few graphs cover every batch"""
+    return 1 << (batch_size - 1).bit_length()
+
+def pad_batch(batch: Dict[str, torch.Tensor], length: int, batch_size: int, pad_token_id: int) -> Dict[str, torch.Tensor]:
+    """
+    Pad a right-padded batch to (batch_size, length)
+
+    input_ids are padded with the pad token, everything else with zeros, so the
+    extra positions are masked out and the extra rows only see padding.
+    """
+    padded = {}
+    for name, values in batch.items():
+        pad_value = pad_token_id if name == "input_ids" else 0
+        padded[name] = torch.nn.functional.pad(
+            values, (0, length - values.size(1), 0, batch_size - values.size(0)), value=pad_value
+        )
+    return padded
+
+class _GraphModule(torch.nn.Module):
+    """Model forward with tensor-only outputs, so it can be traced: (logits?, *attentions)"""
+
+    def __init__(self, model, output_attentions: bool):
+        super().__init__()
+        self.model = model
+        self.output_attentions = output_attentions
+        # Masked LM models return logits, encoders (model.base_model) do not
+        self.has_logits = model.get_output_embeddings() is not None
+
+    def forward(self, input_ids, attention_mask, token_type_ids=None):
+        inputs = {"input_ids": input_ids, "attention_mask": attention_mask}
+        if token_type_ids is not None:
+            inputs["token_type_ids"] = token_type_ids
+        outputs = self.model(**inputs, output_attentions=self.output_attentions, return_dict=True)
+        attentions = tuple(outputs.attentions) if self.output_attentions else ()
+        return ((outputs.logits,) if self.has_logits else ()) + attentions
+
+class BucketedForward:
+    """
+    Runs padded batches through traced or compiled graphs, one per
+    (model, output_attentions, input names, length bucket, batch size bucket)
+
+    Graphs are built on first use (or at warm-up). Every graph references its
+    model, so they are kept until drop_model releases them; the model registry
+    calls it when it evicts a model.
+    """
+
+    def __init__(self, buckets: List[int] = LENGTH_BUCKETS):
+        self.buckets = buckets
+        # Keyed by id(model): the graphs keep their model alive, so it cannot be a weak key
+        self._graphs: Dict[int, Dict[tuple, Any]] = {}
+        self._lock = threading.Lock()
+        self.graphs_built = 0
+        self.build_seconds = 0.0
+        self.calls = 0
+        self.real_tokens = 0
+        self.padded_tokens = 0
+
+    def _graph(self, model, backend: str, output_attentions: bool, batch: Dict[str, torch.Tensor]):
+        key = (backend, output_attentions, tuple(sorted(batch)), tuple(batch["input_ids"].shape))
+        graph = self._graphs.get(id(model), {}).get(key)
+        if graph is not None:
+            return graph
+        with self._lock:
+            graphs = self._graphs.setdefault(id(model), {})
+            graph = graphs.get(key)
+            if graph is not None:
+                return graph
+            start = time.perf_counter()
+            module = _GraphModule(model, output_attentions)
+            with torch.no_grad():
+                if backend == "traced":
+                    with warnings.catch_warnings():
+                        # Recent torch versions warn that torch.jit is deprecated
+                        warnings.simplefilter("ignore", FutureWarning)
+                        traced = torch.jit.trace(module, example_kwarg_inputs=batch, strict=False, check_trace=False)
+                    # TorchScript profiles the first runs of a graph and optimizes it afterwards
+                    for _ in range(2):
+                        traced(**batch)
+                    graph = (traced, module.has_logits)
+                else:
+                    # Every graph is a separate specialization of the same code, allow enough of them
+                    torch._dynamo.config.cache_size_limit = max(torch._dynamo.config.cache_size_limit, 256)
+                    compiled = torch.compile(module, dynamic=False)
+                    compiled(**batch)
+                    graph = (compiled, module.has_logits)
+            graphs[key] = graph
+            self.graphs_built += 1
+            self.build_seconds += time.perf_counter() - start
+            print(f"Built {backend} graph for batch shape {tuple(batch['input_ids'].shape)} in {time.perf_counter() - start:.2f}s")
+            return graph
+
+    def drop_model(self, model) -> int:
+        """
+        Release the graphs of a model and of its encoder (model.base_model), so
+        the model can be freed; returns the number of graphs dropped
+        """
+        owners = {id(model), id(getattr(model, "base_model", model))}
+        with self._lock:
+            dropped = sum(len(self._graphs.pop(owner, {})) for owner in owners)
+        if dropped:
+            print(f"Dropped {dropped} inference graphs of an evicted model")
+        return dropped
+
+    def bucket_for(self, model, length: int) -> Optional[int]:
+        """
+        Bucket length for a sequence length, capped at the model's positions
+        (minus two, for RoBERTa's position offset), or None when it does not fit
+        """
+        bucket = bucket_length(length, self.buckets)
+        max_positions = getattr(model.config, "max_position_embeddings", None)
+        if max_positions:
+            bucket = min(bucket, max_positions - 2)
+        return bucket if bucket >= length and length <= self.buckets[-1] else None
+
+    def __call__(self, model, batch: Dict[str, torch.Tensor], pad_token_id: int, output_attentions: bool, backend: str):
+        """
+        Run a right-padded batch through the graph of its bucket
+
+        Returns:
+            An output with logits and/or attentions for the original batch rows,
+            still padded to the bucket length (split_outputs trims it), or None
+            when the batch is longer than every bucket
+        """
+        rows, length = batch["input_ids"].shape
+        bucket = self.bucket_for(model, length)
+        if bucket is None:
+            return None
+        padded = pad_batch(batch, bucket, bucket_batch_size(rows), pad_token_id)
+        graph, has_logits = self._graph(model, backend, output_attentions, padded)
+        with torch.no_grad():
+            outputs = graph(**padded)
+        self.calls += 1
+        self.real_tokens += int(batch["attention_mask"].sum())
+        self.padded_tokens += padded["input_ids"].numel()
+        logits = outputs[0][:rows] if has_logits else None
+        attentions = tuple(att[:rows] for att in outputs[1 if has_logits else 0:]) if output_attentions else None
+        return SimpleNamespace(logits=logits, attentions=attentions)
+
+    def stats(self) -> Dict[str, Any]:
+        """Graph count and build time, and the share of computed tokens that were padding"""
+        return {
+            "default_backend": INFERENCE_BACKEND,
+            "length_buckets": self.buckets,
+            "graphs": sum(len(graphs) for graphs in self._graphs.values()),
+            "graphs_built": self.graphs_built,
+            "build_seconds": round(self.build_seconds, 3),
+            "calls": self.calls,
+            "padding_ratio": 1 - self.real_tokens / self.padded_tokens if self.padded_tokens else 0.0,
+        }
+
+bucketed_forward = BucketedForward()
+
+def run_forward(model, batch: Dict[str, torch.Tensor], pad_token_id: int, output_attentions: bool = False,
+                backend: Optional[str] = None, layers: Optional[Tuple[int, ...]] = None):
+    """
+    Forward pass of a right-padded batch (with attention_mask) with the given backend
+
+    Args:
+        model: Model to run
+        batch: Model inputs of shape (batch, length) on the model's device
+        pad_token_id: Token id used to pad input_ids to the bucket length
+        output_attentions: Whether to return attentions
+        backend: "eager", "traced" or "compiled"; INFERENCE_BACKEND for None
+        layers: Only capture the attention of these (sorted) layers and stop after
+            the deepest one; always runs eagerly
+
+    Returns:
+        Model output with logits and/or attentions; bucketed backends return
+        them padded to the bucket length. Sequences longer than every bucket
+        run eagerly.
+    """
+    backend = backend or INFERENCE_BACKEND
+    if backend not in INFERENCE_BACKENDS:
+        raise ValueError(f"Unsupported inference backend {backend}, expected one of {INFERENCE_BACKENDS}")
+    if layers is not None:
+        return early_exit_forward(model, batch, layers)
+    if backend != "eager":
+        outputs = bucketed_forward(model, batch, pad_token_id, output_attentions, backend)
+        if outputs is not None:
+            return outputs
+    # Eager forward at the exact length (also for sequences longer than every bucket)
+    with torch.no_grad():
+        return model(**batch, output_attentions=output_attentions)
@@ -1,17 +1,36 @@
-from typing import List, Optional
+from typing import List, Literal, Optional
 from pydantic import BaseModel
 
 class TokenizeRequest(BaseModel):
     text: str
     model_name: str = "bert-base-uncased"
+    long_text: Optional[bool] = False  # Also return the windows of the long-text mode
+    window_size: Optional[int] = None  # Content tokens per window, None: LONG_TEXT_WINDOW
+    window_overlap: Optional[int] = None  # Tokens shared by consecutive windows, None: LONG_TEXT_OVERLAP
     debug: Optional[bool] = False
 
 class Token(BaseModel):
     text: str
     index: int
+    wordIndex: Optional[int] = None  # Index of the word in text.split(), None for special tokens
+
+class TextWindow(BaseModel):
+    index: int
+    start: int  # First token of the window (index into tokens)
+    end: int  # Token after the last token of the window
+    token_indices: List[int]  # Index into tokens of every position of the window, special tokens included
 
 class TokenizeResponse(BaseModel):
     tokens: List[Token]
+    windows: Optional[List[TextWindow]] = None  # long_text only
+
+class TokenizeBatchRequest(BaseModel):
+    texts: List[str]
+    model_name: str = "bert-base-uncased"
+    debug: Optional[bool] = False
+
+class TokenizeBatchResponse(BaseModel):
+    results: List[TokenizeResponse]  # One entry per text, in request order
 
 class TokenPrediction(BaseModel):
     token: str
@@ -26,6 +45,10 @@ class MaskPredictionRequest(BaseModel):
     mask_index: int
     model_name: str = "bert-base-uncased"
     top_k: int = 10
+    precision: Optional[Literal["fp32", "int8"]] = None  # None: the model's default (INT8_MODELS)
+    inference_backend: Optional[Literal["eager", "traced", "compiled"]] = None  # None: INFERENCE_BACKEND
+    long_text: Optional[bool] = False  # Crop texts longer than the model accepts around the mask
+    window_size: Optional[int] = None  # Content tokens kept around the mask, None: as many as fit
     debug: Optional[bool] = False
 
 class MaskPredictionResponse(BaseModel):
@@ -35,30 +58,70 @@ class AttentionRequest(BaseModel):
     text: str
     model_name: str = "bert-base-uncased"
     visualization_method: str = "raw"  # Options: "raw", "rollout", "flow"
+    share_heads: Optional[bool] = False  # Send one matrix per layer for head-independent methods
+    precision: Optional[Literal["fp32", "int8"]] = None  # None: the model's default (INT8_MODELS)
+    inference_backend: Optional[Literal["eager", "traced", "compiled"]] = None  # None: INFERENCE_BACKEND
+    layers: Optional[List[int]] = None  # Layer indices to return (negative counts from the end), None: all
+    heads: Optional[List[int]] = None  # Head indices to return (raw method), None: all
+    long_text: Optional[bool] = False  # Split texts into overlapping windows, see long_text.py
+    window_size: Optional[int] = None  # Content tokens per window, None: LONG_TEXT_WINDOW
+    window_overlap: Optional[int] = None  # Tokens shared by consecutive windows, None: LONG_TEXT_OVERLAP
+    sparse_top_k: Optional[int] = None  # Send sparse rows with at most this many entries
+    sparse_mass: Optional[float] = None  # Send sparse rows with the entries that make up this share (0-1) of each row
     debug: Optional[bool] = False
 
+class SparseMatrix(BaseModel):
+    indptr: List[int]  # Row i is indices/values[indptr[i]:indptr[i + 1]]
+    indices: List[int]  # Column of every kept entry, ascending within a row
+    values: List[float]
+    residual: List[float]  # Attention mass of every row that was dropped
+
 class AttentionHead(BaseModel):
     headIndex: int
-    attention: List[List[float]]
+    attention: Optional[List[List[float]]] = None  # None when the layer's shared matrix applies
+    sparse: Optional[SparseMatrix] = None  # Instead of attention for sparse requests
 
 class Layer(BaseModel):
     layerIndex: int
     heads: List[AttentionHead]
+    attention: Optional[List[List[float]]] = None  # Matrix shared by all heads (share_heads)
+    sparse: Optional[SparseMatrix] = None  # Shared matrix of sparse requests
+
+class AttentionWindow(TextWindow):
+    layers: List[Layer]  # Attention between the window's positions (token_indices)
 
 class AttentionData(BaseModel):
     tokens: List[Token]
-    layers: List[Layer]
+    layers: List[Layer]  # Empty for long_text, see windows
+    windows: Optional[List[AttentionWindow]] = None  # long_text only
 
 class AttentionResponse(BaseModel):
     attention_data: AttentionData
 
+class AttentionSummaryRequest(BaseModel):
+    text: str
+    model_name: str = "bert-base-uncased"
+    precision: Optional[Literal["fp32", "int8"]] = None  # None: the model's default (INT8_MODELS)
+    inference_backend: Optional[Literal["eager", "traced", "compiled"]] = None  # None: INFERENCE_BACKEND
+    debug: Optional[bool] = False
+
+class AttentionSummaryResponse(BaseModel):
+    num_tokens: int
+    num_layers: int
+    num_heads: int
+    metrics: List[str]  # Names of the metrics, see HEAD_METRICS in attention_processing.py
+    values: List[List[List[float]]]  # values[layer][head][metric]
+
 class ComparisonRequest(BaseModel):
     text: str
     masked_index: int
     replacement_word: str
     model_name: str = "bert-base-uncased"
     visualization_method: str = "raw"  # Options: "raw", "rollout", "flow"
+    share_heads: Optional[bool] = False
+    substitution: Optional[str] = "text"  # "text": rebuild the sentence, "token": splice token ids at masked_index
 
 class AttentionComparisonResponse(BaseModel):
     before_attention: AttentionData
     after_attention: AttentionData
+    alignment: Optional[List[int]] = None  # Before token index of every after token ("token" substitution)
@@ -0,0 +1,150 @@
+import functools
+import os
+from typing import List, Optional, Sequence, Tuple
+
+# Part-of-speech tags of function words: determiners, prepositions, conjunctions, etc.
+FUNCTION_POS_TAGS = frozenset({'DT', 'IN', 'CC', 'MD', 'PRP', 'PRP$', 'WDT', 'WP', 'WP$', 'WRB', 'TO', 'EX'})
+PUNCTUATION = frozenset(".,;:!?-'\"`()[]{}")
+
+# NLTK data used for function word classification; each entry lists
+# alternatives (NLTK >= 3.9 ships the tagger as averaged_perceptron_tagger_eng).
+# It is verified at startup and never downloaded at import time. Install it
+# ahead of time (see the Dockerfile) or set NLTK_DOWNLOAD=1 to download
+# missing data at startup.
+NLTK_RESOURCES = [
+    ("corpora/stopwords",),
+    ("taggers/averaged_perceptron_tagger_eng", "taggers/averaged_perceptron_tagger"),
+]
+NLTK_DOWNLOAD = os.environ.get("NLTK_DOWNLOAD", "0") == "1"
+
+def verify_nltk_data(download: bool = NLTK_DOWNLOAD) -> List[str]:
+    """
+    Check that the NLTK data for function word classification is installed
+
+    Args:
+        download: Download missing data (needs network access)
+
+    Returns:
+        The missing resources; without them is_function_word falls back to heuristics
+    """
+    import nltk
+
+    def missing_resources():
+        missing = []
+        for alternatives in NLTK_RESOURCES:
+            found = False
+            for path in alternatives:
+                try:
+                    nltk.data.find(path)
+                    found = True
+                    break
+                except LookupError:
+                    pass
+            if not found:
+                missing.append(alternatives[0])
+        return missing
+
+    missing = missing_resources()
+    if missing and download:
+        for path in missing:
+            nltk.download(path.split("/")[-1])
+        missing = missing_resources()
+    if missing:
+        print(f"Warning: missing NLTK data {missing}; function word detection falls back to heuristics")
+    return missing
+
+@functools.lru_cache(maxsize=None)
+def english_stopwords() -> frozenset:
+    """NLTK's English stopwords, loaded once"""
+    from nltk.corpus import stopwords
+    try:
+        return frozenset(stopwords.words('english'))
+    except LookupError:
+        print("Warning: NLTK stopwords not found, only POS tags and word length identify function words")
+        return frozenset()
+
+@functools.lru_cache(maxsize=None)
+def pos_tagger():
+    """NLTK's perceptron tagger, loaded once (nltk.pos_tag may reload it on every call), or None when its data is missing"""
+    from nltk.tag import PerceptronTagger
+    try:
+        return PerceptronTagger()
+    except LookupError:
+        print("Warning: NLTK POS tagger data not found, using the length heuristic for function words")
+        return None
+
+def _classify_by_lexicon(word: str) -> Tuple[Optional[bool], str]:
+    """
+    Classify a word without POS tagging
+
+    Returns:
+        (True/False when decided, None when the word needs tagging; the cleaned word)
+    """
+    # Basic punctuation check
+    if all(c in PUNCTUATION for c in word):
+        return True, word
+
+    # Clean and lowercase the word
+    word = word.lower().strip()
+
+    # Empty words and very short words (1-2 chars) are usually function words
+    if len(word) <= 2:
+        return True, word
+
+    # Check if it's in NLTK's stopwords (common function words)
+    if word in english_stopwords():
+        return True, word
+    return None, word
+
+@functools.lru_cache(maxsize=65536)
+def is_function_word(word: str) -> bool:
+    """
+    Determine if a word is a function word using NLTK's part-of-speech tagging and stopwords.
+    Function words include determiners, prepositions, conjunctions, auxiliary verbs, etc.
+    Results are memoized per word.
+    """
+    decided, word = _classify_by_lexicon(word)
+    if decided is not None:
+        return decided
+
+    # Use POS tagging of the word on its own to determine its type
+    try:
+        return pos_tagger().tag([word])[0][1] in FUNCTION_POS_TAGS
+    except Exception:
+        # If NLTK tagging fails, fall back to the length-based heuristic
+        return len(word) <= 3
+
+@functools.lru_cache(maxsize=4096)
+def _classify_sentence(words: Tuple[str, ...]) -> Tuple[bool, ...]:
+    decided = [_classify_by_lexicon(word) for word in words]
+    undecided = [i for i, (result, _) in enumerate(decided) if result is None]
+    flags = [result for result, _ in decided]
+    if not undecided:
+        return tuple(flags)
+
+    # Tag the whole sentence in one call so the tagger sees every word in context
+    try:
+        tags = pos_tagger().tag([cleaned for _, cleaned in decided])
+        for i in undecided:
+            flags[i] = tags[i][1] in FUNCTION_POS_TAGS
+    except Exception:
+        # If NLTK tagging fails, fall back to the length-based heuristic
+        for i in undecided:
+            flags[i] = len(decided[i][1]) <= 3
+    return tuple(flags)
+
+def classify_function_words(words: Sequence[str]) -> List[bool]:
+    """
+    Classify all words of a sentence as function (True) or content (False) words
+
+    Stopwords, punctuation and short words are decided from the lexicons; the
+    remaining words are POS tagged together in one tagger call. Results are
+    memoized per sentence.
+
+    Args:
+        words: The words of the sentence, in order
+
+    Returns:
+        One flag per word
+    """
+    return list(_classify_sentence(tuple(words)))
@@ -1,8 +1,10 @@
+import re
 import torch
 from fastapi import HTTPException
 from models import *
-from nltk import pos_tag
-from nltk.corpus import stopwords
+from result_cache import tokenization_cache
+from function_words import is_function_word, classify_function_words
+from model_loading import start_model_load
 
 # Add a helper function to clean RoBERTa tokens
 def clean_roberta_token(token: str) -> str:
@@ -201,72 +203,116 @@ def map_bert_tokens_to_words(tokens, original_text):
     
     return token_to_word_map
 
+# Helper function to align tokens to words from the tokenizer's character offsets
+def align_tokens_to_words(text, offsets, word_ids):
+    """
+    Map token indices to the indices of the whitespace-separated words of text,
+    in a single pass over the tokens and words.
+
+    Args:
+        text: The encoded text
+        offsets: (start, end) character offsets of every token (fast tokenizer offset_mapping)
+        word_ids: Word id of every token, None for special tokens
+
+    Returns:
+        Dictionary mapping token indices to word indices in text.split()
+    """
+    word_ends = [match.end() for match in re.finditer(r"\S+", text)]
+    token_to_word_map = {}
+    word_idx = 0
+    for token_idx, ((start, end), word_id) in enumerate(zip(offsets, word_ids)):
+        if word_id is None or end <= start:
+            continue
+        # Offsets only move forward, so skip the words that end before this token
+        while word_idx < len(word_ends) and word_ends[word_idx] <= start:
+            word_idx += 1
+        if word_idx == len(word_ends):
+            break
+        token_to_word_map[token_idx] = word_idx
+    return token_to_word_map
+
+# Helper function to encode texts once into model inputs and token objects
+def encode_texts(tokenizer, model_name, texts):
+    """
+    Encode texts in one tokenizer call and build the /tokenize token objects, with
+    wordIndex, from the same encoding.
+
+    Fast tokenizers align tokens to words through their offsets; slow tokenizers
+    fall back to the heuristic mappers above.
+
+    Returns:
+        One (tokens, encoding) pair per text, where encoding maps the model input
+        names (input_ids, attention_mask, ...) to lists of ints
+    """
+    is_fast = getattr(tokenizer, "is_fast", False)
+    batch = tokenizer(list(texts), return_offsets_mapping=is_fast)
+    results = []
+    for i, text in enumerate(texts):
+        encoding = {name: list(values[i]) for name, values in batch.items() if name != "offset_mapping"}
+        token_texts = tokenizer.convert_ids_to_tokens(encoding["input_ids"])
+        if "roberta" in model_name:
+            # Clean the tokens to remove the leading 'Ġ' character from RoBERTa tokens
+            token_texts = [clean_roberta_token(token) for token in token_texts]
+        tokens = [{"text": token, "index": idx} for idx, token in enumerate(token_texts)]
+        
+        if is_fast:
+            token_to_word_map = align_tokens_to_words(text, batch["offset_mapping"][i], batch.word_ids(i))
+        elif "roberta" in model_name:
+            token_to_word_map = map_roberta_tokens_to_words(tokens, text)
+        else:
+            token_to_word_map = map_bert_tokens_to_words(tokens, text)
+        for token_idx, token in enumerate(tokens):
+            if token_idx in token_to_word_map:
+                token["wordIndex"] = token_to_word_map[token_idx]
+        results.append((tokens, encoding))
+    return results
+
+# Helper function to encode texts through the shared tokenization cache
+def get_encodings(tokenizer, model_name, texts):
+    """
+    encode_texts with an LRU cache per (model, text) shared by all routes;
+    the texts that are not cached are encoded in one batch.
+    Cached tokens and encodings must not be modified.
+    """
+    results = [tokenization_cache.get((model_name, text)) for text in texts]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if missing:
+        # Texts repeated within the batch are encoded once
+        missing_texts = list(dict.fromkeys(texts[i] for i in missing))
+        encoded = dict(zip(missing_texts, encode_texts(tokenizer, model_name, missing_texts)))
+        for text, result in encoded.items():
+            tokenization_cache.put((model_name, text), result)
+        for i in missing:
+            results[i] = encoded[texts[i]]
+    return results
+
+def get_encoding(tokenizer, model_name, text):
+    """(tokens, encoding) of a single text, see get_encodings"""
+    return get_encodings(tokenizer, model_name, [text])[0]
+
+def encoding_to_tensors(encoding):
+    """Batch-of-one model input tensors for an encoding from get_encodings"""
+    return {name: torch.tensor([values], dtype=torch.long) for name, values in encoding.items()}
+
 # Helper function to load models on demand
-def get_model_and_tokenizer(model_name, debug=False):
+def get_model_and_tokenizer(model_name, debug=False, precision=None):
     if model_name not in MODEL_CONFIGS:
         raise HTTPException(status_code=400, detail=f"Model {model_name} not supported")
     
-    if model_name not in models:
-        print(f"Loading {model_name}...")
-        config = MODEL_CONFIGS[model_name]
-        
-        # Check if this is a custom model that requires special loading
-        if config["model_class"] == "custom" or model_name == "EdwinXhen/TinyBert_6Layer_MLM":
-            # Use the custom model loading function
-            tokenizers[model_name], models[model_name] = load_model(model_name, debug)
-        else:
-            # Standard model loading
-            models[model_name] = config["model_class"].from_pretrained(model_name)
-            tokenizers[model_name] = config["tokenizer_class"].from_pretrained(model_name)
-            
-        if torch.cuda.is_available():
-            models[model_name] = models[model_name].cuda()
-            
-        models[model_name].eval()
-        print(f"Model {model_name} loaded")
+    # fp32 or the int8 quantized copy, registered under its own key
+    precision = resolve_precision(model_name, precision)
+    loaded = model_registry.get(model_key(model_name, precision))
+    if loaded is not None:
+        return loaded
     
-    return models[model_name], tokenizers[model_name]
+    # Load in the background (single flight): concurrent callers wait for the same load
+    return start_model_load(model_name, debug, precision).result()
 
-# Helper function to identify function words using NLTK
-def is_function_word(word: str) -> bool:
+# Helper function to get the encoder used for attention extraction
+def get_base_model(model_name, debug=False, precision=None):
     """
-    Determine if a word is a function word using NLTK's part-of-speech tagging and stopwords.
-    Function words include determiners, prepositions, conjunctions, auxiliary verbs, etc.
+    Return the encoder (BertModel, RobertaModel, ...) inside the masked LM model.
+    It shares its weights with the masked LM model, so no second copy is loaded.
     """
-    # Basic punctuation check
-    if all(c in ".,;:!?-'\"`()[]{}" for c in word):
-        return True
-        
-    # Clean and lowercase the word
-    word = word.lower().strip()
-    
-    # Empty words are considered function words
-    if not word:
-        return True
-    
-    # Very short words (1-2 chars) are usually function words
-    if len(word) <= 2:
-        return True
-    
-    # Check if it's in NLTK's stopwords (common function words)
-    english_stopwords = set(stopwords.words('english'))
-    if word in english_stopwords:
-        return True
-    
-    # Use POS tagging to determine word type
-    try:
-        # Tag the word to determine its part of speech
-        tagged = pos_tag([word])
-        pos = tagged[0][1]
-        
-        # Function word POS tags: determiners, prepositions, conjunctions, etc.
-        function_pos_tags = {'DT', 'IN', 'CC', 'MD', 'PRP', 'PRP$', 'WDT', 'WP', 'WP$', 'WRB', 'TO', 'EX'}
-        
-        if pos in function_pos_tags:
-            return True
-    except Exception as e:
-        # If NLTK tagging fails, fall back to the length-based heuristic
-        return len(word) <= 3
-    
-    # If not identified as a function word, it's a content word
-    return False
+    model, _ = get_model_and_tokenizer(model_name, debug, precision)
+    return model.base_model
@@ -0,0 +1,191 @@
+import asyncio
+import os
+import torch
+from typing import Any, Dict, List, Optional, Set, Tuple
+from inference_executor import run_blocking
+from bucketed_inference import INFERENCE_BACKEND, INFERENCE_BACKENDS, run_forward, bucketed_forward
+
+# How long the first request of a batch waits for others to join, and the
+# largest batch that is run in one forward pass
+BATCH_WINDOW_MS = float(os.environ.get("BATCH_WINDOW_MS", "5"))
+BATCH_MAX_SIZE = int(os.environ.get("BATCH_MAX_SIZE", "16"))
+
+class BatchedOutput:
+    """The part of a model output that belongs to one request of a batch"""
+
+    def __init__(self, attentions: Optional[Tuple[torch.Tensor, ...]] = None, logits: Optional[torch.Tensor] = None):
+        self.attentions = attentions
+        self.logits = logits
+
+def pad_inputs(inputs_list: List[Dict[str, torch.Tensor]], pad_token_id: int) -> Dict[str, torch.Tensor]:
+    """
+    Right-pad single-sequence model inputs into one batch
+
+    input_ids are padded with the pad token, everything else (attention_mask,
+    token_type_ids) with zeros. Padded positions are masked out, so the real
+    tokens see exactly the keys they would see in a solo run.
+    """
+    max_length = max(inputs["input_ids"].size(-1) for inputs in inputs_list)
+    batch = {}
+    for key in inputs_list[0]:
+        pad_value = pad_token_id if key == "input_ids" else 0
+        rows = []
+        for inputs in inputs_list:
+            values = inputs[key].reshape(1, -1)
+            padding = max_length - values.size(-1)
+            if padding:
+                values = torch.nn.functional.pad(values, (0, padding), value=pad_value)
+            rows.append(values)
+        batch[key] = torch.cat(rows, dim=0)
+    if "attention_mask" not in batch:
+        lengths = [inputs["input_ids"].size(-1) for inputs in inputs_list]
+        batch["attention_mask"] = (torch.arange(max_length)[None, :] < torch.tensor(lengths)[:, None]).long()
+    return batch
+
+def split_outputs(outputs, lengths: List[int]) -> List[BatchedOutput]:
+    """Cut a batched model output back into per-request outputs without the padding"""
+    results = []
+    for i, length in enumerate(lengths):
+        attentions = None
+        if getattr(outputs, "attentions", None) is not None:
+            attentions = tuple(att[i:i + 1, :, :length, :length] for att in outputs.attentions)
+        logits = None
+        if getattr(outputs, "logits", None) is not None:
+            logits = outputs.logits[i:i + 1, :length]
+        results.append(BatchedOutput(attentions=attentions, logits=logits))
+    return results
+
+class MicroBatcher:
+    """
+    Collects concurrent inference requests per model and runs them as one padded batch.
+
+    The first request for a key opens a batch and waits up to window_ms for more
+    requests; the batch is run on the inference executor as soon as it is full
+    or the window closes, so new requests keep queueing while it runs.
+    Every caller gets back exactly its own (unpadded) attentions and logits.
+    """
+
+    def __init__(self, window_ms: float = BATCH_WINDOW_MS, max_batch_size: int = BATCH_MAX_SIZE):
+        self.window_ms = window_ms
+        self.max_batch_size = max(1, max_batch_size)
+        self._queues: Dict[str, List[Dict[str, Any]]] = {}
+        self._timers: Dict[str, asyncio.TimerHandle] = {}
+        self._running: Set[asyncio.Task] = set()
+        self.batches = 0
+        self.requests = 0
+        self.max_queue_depth = 0
+        self.batch_sizes: Dict[int, int] = {}
+
+    async def run(self, key: str, model, inputs: Dict[str, torch.Tensor], pad_token_id: int, output_attentions: bool = False,
+                  backend: Optional[str] = None, layers: Optional[Tuple[int, ...]] = None) -> BatchedOutput:
+        """
+        Run a single-sequence forward pass as part of a batch
+
+        Args:
+            key: Batching key; requests are only batched with requests of the same key
+            model: Model to run (the same model for every request of a key)
+            inputs: Tokenizer output for one sequence
+            pad_token_id: Token id used to pad input_ids
+            output_attentions: Whether the model should return attentions
+            backend: Inference backend ("eager", "traced" or "compiled"), INFERENCE_BACKEND
+                for None; requests are only batched with requests of the same backend
+            layers: Only return the attentions of these (sorted) layers and stop the forward
+                pass after the deepest one; batched with requests for the same layers
+
+        Returns:
+            BatchedOutput with the attentions and/or logits of this request
+        """
+        backend = backend or INFERENCE_BACKEND
+        if backend not in INFERENCE_BACKENDS:
+            raise ValueError(f"Unsupported inference backend {backend}, expected one of {INFERENCE_BACKENDS}")
+        if backend != "eager":
+            key = f"{key}:{backend}"
+        if layers is not None:
+            key = f"{key}:layers={','.join(map(str, layers))}"
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        queue = self._queues.setdefault(key, [])
+        queue.append({
+            "inputs": {name: value.cpu() for name, value in inputs.items()},
+            "future": future,
+            "model": model,
+            "pad_token_id": pad_token_id,
+            "output_attentions": output_attentions,
+            "backend": backend,
+            "layers": layers,
+        })
+        self.requests += 1
+        self.max_queue_depth = max(self.max_queue_depth, len(queue))
+
+        if len(queue) >= self.max_batch_size:
+            self._flush(key)
+        elif key not in self._timers:
+            self._timers[key] = loop.call_later(self.window_ms / 1000.0, self._flush, key)
+        return await future
+
+    async def run_many(self, key: str, model, inputs_list: List[Dict[str, torch.Tensor]], pad_token_id: int, output_attentions: bool = False,
+                       backend: Optional[str] = None, layers: Optional[Tuple[int, ...]] = None) -> List[BatchedOutput]:
+        """
+        Run several single-sequence forward passes that belong together (e.g. the
+        before and after texts of a comparison); they are queued at once so they
+        end up in the same batch whenever it has room.
+
+        Returns:
+            One BatchedOutput per entry of inputs_list
+        """
+        return list(await asyncio.gather(*[
+            self.run(key, model, inputs, pad_token_id, output_attentions, backend, layers) for inputs in inputs_list
+        ]))
+
+    def _flush(self, key: str) -> None:
+        timer = self._timers.pop(key, None)
+        if timer is not None:
+            timer.cancel()
+        pending = self._queues.pop(key, [])
+        if not pending:
+            return
+        self.batches += 1
+        self.batch_sizes[len(pending)] = self.batch_sizes.get(len(pending), 0) + 1
+        task = asyncio.ensure_future(self._run_batch(pending))
+        self._running.add(task)
+        task.add_done_callback(self._running.discard)
+
+    async def _run_batch(self, pending: List[Dict[str, Any]]) -> None:
+        try:
+            results = await run_blocking(self._forward, pending)
+        except Exception as e:
+            for item in pending:
+                if not item["future"].done():
+                    item["future"].set_exception(e)
+            return
+        for item, result in zip(pending, results):
+            if not item["future"].done():
+                item["future"].set_result(result)
+
+    def _forward(self, pending: List[Dict[str, Any]]) -> List[BatchedOutput]:
+        """Pad the pending requests, run one forward pass (eager or bucketed) and split the outputs"""
+        first = pending[0]
+        model = first["model"]
+        lengths = [item["inputs"]["input_ids"].size(-1) for item in pending]
+        batch = pad_inputs([item["inputs"] for item in pending], first["pad_token_id"])
+        device = next(model.parameters()).device
+        batch = {name: value.to(device) for name, value in batch.items()}
+        outputs = run_forward(model, batch, first["pad_token_id"], first["output_attentions"], first["backend"], first["layers"])
+        return split_outputs(outputs, lengths)
+
+    def stats(self) -> Dict[str, Any]:
+        """Queue depth and batch size metrics"""
+        return {
+            "window_ms": self.window_ms,
+            "max_batch_size": self.max_batch_size,
+            "queue_depth": {key: len(queue) for key, queue in self._queues.items()},
+            "max_queue_depth": self.max_queue_depth,
+            "running_batches": len(self._running),
+            "batches": self.batches,
+            "requests": self.requests,
+            "mean_batch_size": self.requests / self.batches if self.batches else 0.0,
+            "batch_sizes": dict(sorted(self.batch_sizes.items())),
+            "bucketing": bucketed_forward.stats(),
+        }
+
+inference_batcher = MicroBatcher()
@@ -0,0 +1,34 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable
+
+# Number of threads that run model inference, attention post-processing and
+# model loading. torch releases the GIL inside its kernels, so several
+# requests can make progress at once while the event loop stays free.
+INFERENCE_WORKERS = int(os.environ.get("INFERENCE_WORKERS", str(min(4, os.cpu_count() or 1))))
+
+inference_executor = ThreadPoolExecutor(max_workers=max(1, INFERENCE_WORKERS), thread_name_prefix="inference")
+
+# Streamed forward passes (/attention/stream) pause between layers until the
+# client has read them, so they run on their own STREAM_WORKERS threads and a
+# slow reader never holds one of the shared inference threads. Further streams
+# wait for a free thread.
+STREAM_WORKERS = int(os.environ.get("STREAM_WORKERS", "2"))
+
+stream_executor = ThreadPoolExecutor(max_workers=max(1, STREAM_WORKERS), thread_name_prefix="stream")
+
+async def run_blocking(func: Callable[..., Any], *args, **kwargs) -> Any:
+    """
+    Run a blocking function on the inference executor and wait for its result
+
+    Args:
+        func: Function to run (model forward, flow computation, model loading, ...)
+        *args, **kwargs: Arguments passed to func
+
+    Returns:
+        The return value of func; exceptions raised by func are re-raised here
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(inference_executor, functools.partial(func, *args, **kwargs))
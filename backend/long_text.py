@@ -0,0 +1,119 @@
+import os
+import torch
+from typing import Dict, List, Optional, Tuple
+from fastapi import HTTPException
+
+# Long-text mode: texts longer than a model accepts are split into overlapping
+# windows of LONG_TEXT_WINDOW content tokens (special tokens not counted) that
+# overlap by LONG_TEXT_OVERLAP tokens. Every window is run with the special
+# tokens of the full text around it, so its cost is fixed and a document costs
+# linearly in its length instead of quadratically.
+LONG_TEXT_WINDOW = int(os.environ.get("LONG_TEXT_WINDOW", "128"))
+LONG_TEXT_OVERLAP = int(os.environ.get("LONG_TEXT_OVERLAP", "32"))
+
+def max_sequence_length(model) -> int:
+    """Number of tokens (special tokens included) the model accepts in one sequence"""
+    max_positions = model.config.max_position_embeddings
+    if model.config.model_type in ("roberta", "xlm-roberta", "camembert"):
+        # RoBERTa position ids start after the padding index
+        max_positions -= (model.config.pad_token_id or 0) + 1
+    return max_positions
+
+def ensure_fits(model, model_name: str, num_tokens: int) -> None:
+    """Reject a sequence the model cannot take in one piece (400)"""
+    max_length = max_sequence_length(model)
+    if num_tokens > max_length:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Text has {num_tokens} tokens, more than the {max_length} that {model_name} accepts; "
+                   f"send \"long_text\": true to process it in windows"
+        )
+
+def resolve_window(model, window_size: Optional[int] = None, overlap: Optional[int] = None) -> Tuple[int, int]:
+    """
+    Validated window size and overlap in content tokens
+
+    Args:
+        model: Model the windows are run with
+        window_size: Content tokens per window, LONG_TEXT_WINDOW (capped at the model limit) for None
+        overlap: Tokens shared by consecutive windows, LONG_TEXT_OVERLAP for None
+
+    Returns:
+        (window_size, overlap)
+    """
+    max_window = max_sequence_length(model) - 2
+    if window_size is None:
+        window_size = min(LONG_TEXT_WINDOW, max_window)
+    if overlap is None:
+        overlap = min(LONG_TEXT_OVERLAP, window_size // 2)
+    if not 1 <= window_size <= max_window:
+        raise HTTPException(status_code=400, detail=f"window_size must be between 1 and {max_window} for this model")
+    if not 0 <= overlap < window_size:
+        raise HTTPException(status_code=400, detail="window_overlap must be at least 0 and smaller than window_size")
+    return window_size, overlap
+
+def plan_windows(num_tokens: int, window_size: int, overlap: int) -> List[Tuple[int, int]]:
+    """
+    Split the content tokens of a sequence into overlapping windows
+
+    The sequence starts and ends with one special token ([CLS]/[SEP], <s>/</s>);
+    the windows cover the tokens between them. Only the last window can be shorter
+    than window_size.
+
+    Returns:
+        (start, end) token index ranges (end exclusive), in order
+    """
+    first, last = 1, max(1, num_tokens - 1)
+    step = window_size - overlap
+    windows = []
+    start = first
+    while True:
+        end = min(start + window_size, last)
+        windows.append((start, end))
+        if end == last:
+            return windows
+        start += step
+
+def window_positions(start: int, end: int, num_tokens: int) -> List[int]:
+    """Token indices of a window's sequence: the leading special token, tokens start..end-1, the trailing special token"""
+    return [0] + list(range(start, end)) + [num_tokens - 1]
+
+def crop_around(inputs: Dict[str, torch.Tensor], position: int, window_size: int) -> Dict[str, torch.Tensor]:
+    """
+    Crop batch-of-one model inputs to window_size content tokens centred on a position
+
+    The leading and trailing special tokens are kept, so the cropped sequence
+    looks like a complete text to the model.
+    """
+    num_tokens = inputs["input_ids"].size(-1)
+    if num_tokens - 2 <= window_size:
+        return inputs
+    start = min(max(1, position - window_size // 2), num_tokens - 1 - window_size)
+    positions = torch.tensor(window_positions(start, start + window_size, num_tokens))
+    return {name: values[:, positions] for name, values in inputs.items()}
+
+def fit_masked_inputs(model, model_name: str, inputs: Dict[str, torch.Tensor], mask_token_id: int,
+                      long_text: bool = False, window_size: Optional[int] = None) -> Dict[str, torch.Tensor]:
+    """
+    Masked LM inputs that the model can take: unchanged when they fit, otherwise
+    (long_text only) cropped to a window around the first mask token
+
+    Args:
+        model: Masked LM model
+        model_name: Model name, for error messages
+        inputs: Batch-of-one tokenizer output containing the mask token
+        mask_token_id: Id of the mask token
+        long_text: Whether long texts are cropped instead of rejected (400)
+        window_size: Content tokens of the window, the largest the model accepts for None
+    """
+    num_tokens = inputs["input_ids"].size(-1)
+    if num_tokens <= max_sequence_length(model):
+        return inputs
+    if not long_text:
+        ensure_fits(model, model_name, num_tokens)
+    window_size = window_size or max_sequence_length(model) - 2
+    window_size, _ = resolve_window(model, window_size, 0)
+    mask_positions = torch.where(inputs["input_ids"][0] == mask_token_id)[0]
+    position = mask_positions[0].item() if len(mask_positions) else 0
+    print(f"Cropping {num_tokens} tokens to a window of {window_size} around position {position}")
+    return crop_around(inputs, position, window_size)
@@ -1,3 +1,4 @@
+from contextlib import asynccontextmanager
 from fastapi import FastAPI, Request
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.middleware.trustedhost import TrustedHostMiddleware
@@ -5,10 +6,25 @@ from starlette.responses import RedirectResponse
 from routes.tokenize import router as tokenize_router
 from routes.mask_prediction import router as mask_router
 from routes.attention import router as attention_router
+from routes.attention_stream import router as attention_stream_router
+from routes.attention_summary import router as attention_summary_router
 from routes.attention_comparison import router as attention_comparison_router
 from routes.models import router as models_router
+from routes.cache import router as cache_router
+from routes.ready import router as ready_router
+from function_words import verify_nltk_data
+from inference_executor import run_blocking
+from model_loading import PRELOAD_MODELS, preload_models
 
-app = FastAPI(title="BERT Attention Visualizer Backend")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Check (but do not download) the NLTK data; heavy libraries are imported on first use
+    await run_blocking(verify_nltk_data)
+    # Load and warm up PRELOAD_MODELS in the background; /ready reports 503 until they are hot
+    preload_models(PRELOAD_MODELS)
+    yield
+
+app = FastAPI(title="BERT Attention Visualizer Backend", lifespan=lifespan)
 
 # Ensure the server correctly identifies forwarded HTTPS requests
 @app.middleware("http")
@@ -42,8 +58,12 @@ app.add_middleware(TrustedHostMiddleware, allowed_hosts=["*"])
 app.include_router(tokenize_router, prefix="/tokenize")
 app.include_router(mask_router, prefix="/predict_masked")
 app.include_router(attention_router, prefix="/attention")
+app.include_router(attention_stream_router, prefix="/attention/stream")
+app.include_router(attention_summary_router, prefix="/attention/summary")
 app.include_router(attention_comparison_router, prefix="/attention_comparison")
 app.include_router(models_router, prefix="/models")
+app.include_router(cache_router, prefix="/cache")
+app.include_router(ready_router, prefix="/ready")
 
 if __name__ == "__main__":
     import uvicorn
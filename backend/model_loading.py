@@ -0,0 +1,303 @@
+import asyncio
+import copy
+import math
+import os
+import threading
+import time
+import warnings
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Sequence
+import torch
+from fastapi import HTTPException
+from bucketed_inference import INFERENCE_BACKEND, run_forward, bucketed_forward
+from models import MODEL_CONFIGS, model_registry, transformers_class, load_model, resolve_precision, model_key
+
+def _parse_preload_models(value: str) -> List[str]:
+    """Model ids from a comma-separated list, or every configured model for "all"""
+    if value.strip().lower() == "all":
+        return list(MODEL_CONFIGS)
+    names = [name.strip() for name in value.split(",") if name.strip()]
+    for name in names:
+        if name not in MODEL_CONFIGS:
+            print(f"Warning: PRELOAD_MODELS lists unknown model {name}, skipping it")
+    return [name for name in names if name in MODEL_CONFIGS]
+
+# Models to load and warm up at startup (comma-separated MODEL_CONFIGS ids or
+# "all"), and the sequence lengths of the warm-up forward passes
+PRELOAD_MODELS = _parse_preload_models(os.environ.get("PRELOAD_MODELS", ""))
+WARMUP_SEQ_LENGTHS = [int(length) for length in os.environ.get("WARMUP_SEQ_LENGTHS", "8,32,128").split(",") if length.strip()]
+
+# Models are loaded by background jobs on their own thread pool (MODEL_LOAD_WORKERS
+# loads at once). Requests for a model that is still loading wait up to
+# MODEL_LOAD_WAIT_SECONDS (or their X-Model-Load-Wait header) and then get a 503
+# "loading" response with the load progress.
+MODEL_LOAD_WORKERS = int(os.environ.get("MODEL_LOAD_WORKERS", "1"))
+MODEL_LOAD_WAIT_SECONDS = float(os.environ.get("MODEL_LOAD_WAIT_SECONDS", "30"))
+
+# Traced and compiled graphs hold on to their model, release them with it
+model_registry.on_evict(lambda key, model: bucketed_forward.drop_model(model))
+
+model_load_executor = ThreadPoolExecutor(max_workers=MODEL_LOAD_WORKERS, thread_name_prefix="model-load")
+
+_load_states: Dict[str, Dict[str, Any]] = {}
+_load_jobs: Dict[str, Future] = {}
+_load_locks: Dict[str, threading.Lock] = {}
+_load_states_lock = threading.Lock()
+
+def set_load_state(model_name: str, state: str, **fields) -> None:
+    """Record the load state of a model ("queued", "loading", "warming", "ready" or "failed") with extra fields"""
+    with _load_states_lock:
+        entry = _load_states.setdefault(model_name, {})
+        entry.update(fields, state=state)
+
+def _load_lock(key: str) -> threading.Lock:
+    """Lock held while a model variant is loaded, so it is never loaded twice at once"""
+    with _load_states_lock:
+        return _load_locks.setdefault(key, threading.Lock())
+
+def _registered(key: str):
+    """The registered (model, tokenizer) pair of a model variant, or None"""
+    return model_registry.get(key) if key in model_registry else None
+
+def warm_up_model(model, tokenizer, seq_lengths: Sequence[int]) -> None:
+    """
+    Run dummy forward passes at the given sequence lengths, so the first real
+    requests do not pay for lazy initialization and allocator growth
+
+    With a bucketed INFERENCE_BACKEND, this also builds the graphs of the
+    encoder (with attentions) and of the masked LM for the buckets of the
+    lengths, at batch size one.
+
+    Args:
+        model: Masked LM model (its encoder runs as part of the forward pass)
+        tokenizer: Tokenizer of the model, for the special token ids
+        seq_lengths: Sequence lengths to run, capped at the model's maximum
+    """
+    device = next(model.parameters()).device
+    max_length = getattr(model.config, "max_position_embeddings", 512) - 2
+    start_id = tokenizer.cls_token_id if tokenizer.cls_token_id is not None else tokenizer.bos_token_id
+    end_id = tokenizer.sep_token_id if tokenizer.sep_token_id is not None else tokenizer.eos_token_id
+    filler_id = tokenizer.unk_token_id or 0
+    for length in seq_lengths:
+        length = max(2, min(length, max_length))
+        input_ids = torch.tensor([[start_id] + [filler_id] * (length - 2) + [end_id]], device=device)
+        batch = {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+        if INFERENCE_BACKEND == "eager":
+            with torch.no_grad():
+                model(**batch, output_attentions=True)
+        else:
+            if "token_type_ids" in tokenizer.model_input_names:
+                batch["token_type_ids"] = torch.zeros_like(input_ids)
+            pad_token_id = tokenizer.pad_token_id or 0
+            run_forward(model.base_model, batch, pad_token_id, output_attentions=True)
+            run_forward(model, batch, pad_token_id)
+
+def quantize_model(model):
+    """
+    A copy of a model with its linear layers dynamically quantized to int8
+
+    Weights are stored as int8 and activations are quantized on the fly, which
+    speeds up the linear layers on CPU. Embeddings, layer norms and the attention
+    softmax stay in float32. The copy always runs on the CPU.
+    """
+    quantized = copy.deepcopy(model).to("cpu")
+    with warnings.catch_warnings():
+        # Recent torch versions warn that torch.ao.quantization moves to torchao
+        warnings.simplefilter("ignore", (DeprecationWarning, UserWarning))
+        return torch.ao.quantization.quantize_dynamic(quantized, {torch.nn.Linear}, dtype=torch.qint8).eval()
+
+def _load_model_and_tokenizer(model_name: str, debug: bool = False, precision: str = "fp32"):
+    """Load, register and warm up a model variant; runs as a background load job"""
+    key = model_key(model_name, precision)
+    set_load_state(key, "loading", started_at=time.time(), error=None)
+    print(f"Loading {key}...")
+    start = time.perf_counter()
+    config = MODEL_CONFIGS[model_name]
+    
+    if precision == "int8":
+        # Quantize the fp32 model, which stays registered next to the int8 copy
+        loaded = _load_fp32_dependency(model_name, debug)
+        model, tokenizer = quantize_model(loaded[0]), loaded[1]
+    # Check if this is a custom model that requires special loading
+    elif config["model_class"] == "custom" or model_name == "EdwinXhen/TinyBert_6Layer_MLM":
+        # Use the custom model loading function
+        tokenizer, model = load_model(model_name, debug)
+    else:
+        # Standard model loading; eager attention so the encoder can return attention weights
+        model = transformers_class(config["model_class"]).from_pretrained(model_name, attn_implementation="eager")
+        tokenizer = transformers_class(config["tokenizer_class"]).from_pretrained(model_name)
+        
+    if torch.cuda.is_available() and precision == "fp32":
+        model = model.cuda()
+        
+    model.eval()
+    model_registry.put(key, model, tokenizer)
+    load_seconds = time.perf_counter() - start
+    print(f"Model {key} loaded")
+
+    set_load_state(key, "warming", load_seconds=round(load_seconds, 3))
+    start = time.perf_counter()
+    warm_up_model(model, tokenizer, WARMUP_SEQ_LENGTHS)
+    set_load_state(key, "ready", warmup_seconds=round(time.perf_counter() - start, 3))
+    return model, tokenizer
+
+def _load_fp32_dependency(model_name: str, debug: bool = False):
+    """
+    The fp32 model an int8 variant is quantized from, loaded on the current load
+    worker when it is not registered yet
+
+    Waiting for a queued fp32 load job here could deadlock the load pool, so the
+    model is loaded inline under its load lock instead; a queued job finds it
+    registered when it runs. When no fp32 job exists, the inline load is recorded
+    in _load_jobs, so fp32 requests join it instead of starting another load.
+    """
+    inline = None
+    with _load_states_lock:
+        if model_name not in _load_jobs:
+            inline = Future()
+            _load_jobs[model_name] = inline
+    try:
+        with _load_lock(model_name):
+            loaded = _registered(model_name) or _load_model_and_tokenizer(model_name, debug)
+        if inline is not None:
+            inline.set_result(loaded)
+        return loaded
+    except Exception as e:
+        if inline is not None:
+            print(f"Loading {model_name} failed: {e}")
+            set_load_state(model_name, "failed", error=str(e))
+            inline.set_exception(e)
+        raise
+    finally:
+        if inline is not None:
+            with _load_states_lock:
+                _load_jobs.pop(model_name, None)
+
+def _run_load_job(model_name: str, debug: bool, precision: str):
+    key = model_key(model_name, precision)
+    try:
+        with _load_lock(key):
+            # An fp32 model may have been loaded inline for its int8 variant meanwhile
+            return _registered(key) or _load_model_and_tokenizer(model_name, debug, precision)
+    except Exception as e:
+        print(f"Loading {key} failed: {e}")
+        set_load_state(key, "failed", error=str(e))
+        raise
+    finally:
+        with _load_states_lock:
+            _load_jobs.pop(key, None)
+
+def start_model_load(model_name: str, debug: bool = False, precision: str = "fp32") -> Future:
+    """
+    Start loading a model variant in the background, or join the load already running
+
+    Every caller for the same model and precision gets the same future (single
+    flight), which resolves to the (model, tokenizer) pair or raises the load error.
+    """
+    key = model_key(model_name, precision)
+    with _load_states_lock:
+        job = _load_jobs.get(key)
+        if job is None:
+            entry = _load_states.setdefault(key, {})
+            entry.update(state="queued", queued_at=time.time(), error=None)
+            job = model_load_executor.submit(_run_load_job, model_name, debug, precision)
+            _load_jobs[key] = job
+        return job
+
+def preload_models(model_names: Sequence[str] = PRELOAD_MODELS) -> List[Future]:
+    """Queue background load jobs (with warm-up) for the given models, in their default precision"""
+    return [start_model_load(model_name, precision=resolve_precision(model_name)) for model_name in model_names]
+
+def load_progress(model_name: str) -> Dict[str, Any]:
+    """
+    State of a model load with the elapsed time and, when an earlier load of the
+    same model (or else any model) was timed, the estimated progress and seconds left
+    """
+    with _load_states_lock:
+        entry = dict(_load_states.get(model_name, {}))
+        timed = [state["load_seconds"] for state in _load_states.values() if "load_seconds" in state]
+    progress = {"model": model_name, "state": entry.get("state", "not_loaded")}
+    if entry.get("error"):
+        progress["error"] = entry["error"]
+    if progress["state"] in ("queued", "loading"):
+        expected = entry.get("load_seconds") or (sum(timed) / len(timed) if timed else None)
+        elapsed = time.time() - entry["started_at"] if progress["state"] == "loading" else 0.0
+        progress["elapsed_seconds"] = round(elapsed, 3)
+        progress["progress"] = round(min(elapsed / expected, 0.99), 3) if expected else None
+        progress["eta_seconds"] = round(max(expected - elapsed, 0.0), 3) if expected else None
+    return progress
+
+async def ensure_model_loaded(model_name: str, wait_seconds: Optional[float] = None, precision: Optional[str] = None) -> None:
+    """
+    Make sure a model is loaded before a request uses it
+
+    Starts (or joins) the background load of the model and waits for it for up
+    to wait_seconds (MODEL_LOAD_WAIT_SECONDS by default) without blocking the
+    event loop. Unknown models are left to the request handler.
+
+    Args:
+        model_name: Model the request uses
+        wait_seconds: Longest wait for the load, MODEL_LOAD_WAIT_SECONDS by default
+        precision: "fp32" or "int8", the model's default (INT8_MODELS) for None
+
+    Raises:
+        HTTPException: 503 with the load_progress when the model is still loading
+            after the wait, 500 when loading failed
+    """
+    if model_name not in MODEL_CONFIGS:
+        return
+    precision = resolve_precision(model_name, precision)
+    key = model_key(model_name, precision)
+    if key in model_registry:
+        return
+    job = start_model_load(model_name, precision=precision)
+    wait_seconds = MODEL_LOAD_WAIT_SECONDS if wait_seconds is None else wait_seconds
+    try:
+        # shield: a timed out wait must not cancel the load job shared with other requests
+        await asyncio.wait_for(asyncio.shield(asyncio.wrap_future(job)), timeout=max(wait_seconds, 0.0))
+        return
+    except asyncio.TimeoutError:
+        pass
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=f"Loading model {key} failed: {e}")
+
+    progress = load_progress(key)
+    retry_after = math.ceil(progress.get("eta_seconds") or 1)
+    raise HTTPException(status_code=503, detail=progress, headers={"Retry-After": str(max(retry_after, 1))})
+
+def model_load_states() -> Dict[str, Dict[str, Any]]:
+    """
+    Load state and resident size of every configured model, keyed by registry
+    key, plus the int8 variants that were requested
+
+    Models that were never loaded are "not_loaded" and ready models that the
+    registry has since evicted are "evicted". resident_bytes is the parameter
+    footprint of loaded models.
+    """
+    resident = {entry["key"]: entry["size_bytes"] for entry in model_registry.stats()["models"]}
+    with _load_states_lock:
+        int8_keys = [key for key in (model_key(name, "int8") for name in MODEL_CONFIGS) if key in _load_states or key in resident]
+    states = {}
+    for name in list(MODEL_CONFIGS) + int8_keys:
+        state = load_progress(name)
+        del state["model"]
+        with _load_states_lock:
+            for field in ("load_seconds", "warmup_seconds"):
+                if field in _load_states.get(name, {}):
+                    state[field] = _load_states[name][field]
+        if name in resident and state["state"] == "not_loaded":
+            state["state"] = "ready"
+        elif name not in resident and state["state"] == "ready":
+            state["state"] = "evicted"
+        state["resident_bytes"] = resident.get(name, 0)
+        states[name] = state
+    return states
+
+def readiness() -> Dict[str, Any]:
+    """Whether every model in PRELOAD_MODELS is loaded and warmed up, with the state of all models"""
+    states = model_load_states()
+    return {
+        "ready": all(states.get(model_key(name, resolve_precision(name)), {}).get("state") == "ready" for name in PRELOAD_MODELS),
+        "preload_models": PRELOAD_MODELS,
+        "models": states,
+    }
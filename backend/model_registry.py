@@ -0,0 +1,119 @@
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+def _state_tensors(value):
+    """Tensors in a state dict value; packed params of quantized layers are (weight, bias) tuples"""
+    if isinstance(value, (tuple, list)):
+        for item in value:
+            yield from _state_tensors(item)
+    elif hasattr(value, "data_ptr"):
+        yield value
+
+def model_footprint(model) -> int:
+    """Bytes held by the parameters and buffers of a torch model, including int8 quantized weights"""
+    tensors = list(model.parameters()) + list(model.buffers())
+    tensors += [tensor for value in model.state_dict().values() for tensor in _state_tensors(value)]
+    seen = set()
+    total = 0
+    for tensor in tensors:
+        # Tied weights (e.g. MLM decoder and word embeddings) are only counted once
+        if tensor.data_ptr() in seen:
+            continue
+        seen.add(tensor.data_ptr())
+        total += tensor.numel() * tensor.element_size()
+    return total
+
+class ModelRegistry:
+    """
+    Loaded models and tokenizers with a memory budget and LRU eviction.
+
+    Every entry is a (model, tokenizer) pair with its parameter footprint.
+    When a new entry would push the resident total over the budget, the least
+    recently used entries are evicted first. A budget of None means unlimited.
+    Callbacks registered with on_evict run with (key, model) for every model
+    that leaves the registry, so state kept per model can be released with it.
+    """
+
+    def __init__(self, budget_bytes: Optional[int] = None):
+        self.budget_bytes = budget_bytes
+        self._entries: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._eviction_callbacks: List[Callable[[str, Any], None]] = []
+
+    def on_evict(self, callback: Callable[[str, Any], None]) -> None:
+        """Call callback(key, model) whenever a model is evicted or replaced"""
+        self._eviction_callbacks.append(callback)
+
+    def _notify_evicted(self, evicted: List[Tuple[str, Any]]) -> None:
+        for key, model in evicted:
+            for callback in self._eviction_callbacks:
+                callback(key, model)
+
+    def __contains__(self, key: str) -> bool:
+        with self._lock:
+            return key in self._entries
+
+    def get(self, key: str) -> Optional[Tuple[Any, Any]]:
+        """Return the (model, tokenizer) pair for key and mark it as recently used, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry["model"], entry["tokenizer"]
+
+    def put(self, key: str, model, tokenizer) -> None:
+        """Register a loaded model, evicting least recently used models to stay within the budget"""
+        size = model_footprint(model)
+        evicted = []
+        with self._lock:
+            replaced = self._entries.pop(key, None)
+            if replaced is not None and replaced["model"] is not model:
+                evicted.append((key, replaced["model"]))
+            if self.budget_bytes is not None:
+                if size > self.budget_bytes:
+                    print(f"Warning: {key} needs {size / 2**20:.0f} MB, more than the model budget of {self.budget_bytes / 2**20:.0f} MB")
+                while self._entries and self.resident_bytes() + size > self.budget_bytes:
+                    evicted_key, entry = self._entries.popitem(last=False)
+                    self.evictions += 1
+                    evicted.append((evicted_key, entry["model"]))
+                    print(f"Evicting {evicted_key} ({entry['size_bytes'] / 2**20:.0f} MB) from the model registry")
+            self._entries[key] = {"model": model, "tokenizer": tokenizer, "size_bytes": size}
+        self._notify_evicted(evicted)
+
+    def evict(self, key: str) -> bool:
+        """Remove a model from the registry; returns whether it was loaded"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                return False
+            self.evictions += 1
+        self._notify_evicted([(key, entry["model"])])
+        return True
+
+    def resident_bytes(self) -> int:
+        with self._lock:
+            return sum(entry["size_bytes"] for entry in self._entries.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit, miss and eviction counts plus the resident models (least recently used first)"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "budget_bytes": self.budget_bytes,
+                "resident_bytes": self.resident_bytes(),
+                "models": [
+                    {"key": key, "size_bytes": entry["size_bytes"]}
+                    for key, entry in self._entries.items()
+                ],
+            }
@@ -1,46 +1,62 @@
-from transformers import BertForMaskedLM, RobertaForMaskedLM, AutoTokenizer, BertModel, RobertaModel, DistilBertForMaskedLM, DistilBertModel, AutoModelForMaskedLM
-import nltk
+import importlib
+import os
+from model_registry import ModelRegistry
 
 
-# Download necessary NLTK data
-try:
-    nltk.data.find('tokenizers/punkt')
-    nltk.data.find('taggers/averaged_perceptron_tagger')
-    nltk.data.find('corpora/stopwords')
-except LookupError:
-    nltk.download('punkt')
-    nltk.download('averaged_perceptron_tagger')
-    nltk.download('stopwords')
-
+# Model and tokenizer classes are referenced by name: transformers and the
+# modeling code of a model are only imported when that model is first loaded
 MODEL_CONFIGS = {
     "bert-base-uncased": {
         "name": "BERT Base Uncased",
-        "model_class": BertForMaskedLM,
-        "tokenizer_class": AutoTokenizer,
-        "base_model_class": BertModel
+        "model_class": "BertForMaskedLM",
+        "tokenizer_class": "AutoTokenizer"
     },
     "roberta-base": {
         "name": "RoBERTa Base",
-        "model_class": RobertaForMaskedLM,
-        "tokenizer_class": AutoTokenizer,
-        "base_model_class": RobertaModel
+        "model_class": "RobertaForMaskedLM",
+        "tokenizer_class": "AutoTokenizer"
     },
     "distilbert-base-uncased": {
         "name": "DistilBERT Base Uncased",
-        "model_class": DistilBertForMaskedLM,
-        "tokenizer_class": AutoTokenizer,
-        "base_model_class": DistilBertModel
+        "model_class": "DistilBertForMaskedLM",
+        "tokenizer_class": "AutoTokenizer"
     },
     "EdwinXhen/TinyBert_6Layer_MLM": {
         "name": "TinyBERT 6 Layer",
         "model_class": "custom",
-        "tokenizer_class": AutoTokenizer,
-        "base_model_class": BertModel
+        "tokenizer_class": "AutoTokenizer"
     }
 }
 
-models = {}
-tokenizers = {}
+def transformers_class(name):
+    """Import a transformers class by name on first use"""
+    return getattr(importlib.import_module("transformers"), name)
+
+# Loaded models and tokenizers. Set MODEL_MEMORY_BUDGET_MB to cap the memory
+# used by resident models; least recently used models are evicted first.
+MODEL_MEMORY_BUDGET_MB = os.environ.get("MODEL_MEMORY_BUDGET_MB")
+model_registry = ModelRegistry(
+    budget_bytes=int(float(MODEL_MEMORY_BUDGET_MB) * 2**20) if MODEL_MEMORY_BUDGET_MB else None
+)
+
+# Inference precisions: "fp32", or "int8" for a copy of the model with dynamically
+# quantized linear layers (CPU). INT8_MODELS lists the models (comma-separated ids
+# or "all") served in int8 by default; requests can pick a precision explicitly.
+PRECISIONS = ("fp32", "int8")
+INT8_MODELS = os.environ.get("INT8_MODELS", "")
+INT8_MODELS = list(MODEL_CONFIGS) if INT8_MODELS.strip().lower() == "all" else [name.strip() for name in INT8_MODELS.split(",") if name.strip()]
+
+def resolve_precision(model_name, precision=None):
+    """The precision to run a model in: the requested one, or the model's default"""
+    if precision is None:
+        return "int8" if model_name in INT8_MODELS else "fp32"
+    if precision not in PRECISIONS:
+        raise ValueError(f"Unsupported precision {precision}, expected one of {PRECISIONS}")
+    return precision
+
+def model_key(model_name, precision="fp32"):
+    """Registry key of a model variant: the model id for fp32, "<id>@int8" for the quantized copy"""
+    return model_name if precision == "fp32" else f"{model_name}@{precision}"
 
 def load_model(model_type, debug=False):
     if model_type.lower() == "custom" or model_type == "EdwinXhen/TinyBert_6Layer_MLM":
@@ -48,8 +64,8 @@ def load_model(model_type, debug=False):
         custom_repo = "EdwinXhen/TinyBert_6Layer_MLM"
         if debug:
             print(f"[DEBUG] Loading custom model from HuggingFace repository: {custom_repo}")
-        tokenizer = AutoTokenizer.from_pretrained(custom_repo)
-        model = AutoModelForMaskedLM.from_pretrained(custom_repo, output_attentions=True)
+        tokenizer = transformers_class("AutoTokenizer").from_pretrained(custom_repo)
+        model = transformers_class("AutoModelForMaskedLM").from_pretrained(custom_repo, attn_implementation="eager", output_attentions=True)
         return tokenizer, model
     # Handle other models with existing logic
     # This is a placeholder for the existing model loading logic
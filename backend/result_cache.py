@@ -0,0 +1,121 @@
+import os
+import sys
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional
+import numpy as np
+
+def result_size(value: Any) -> int:
+    """Approximate number of bytes held by a cached result (arrays, dicts, lists and scalars)"""
+    if hasattr(value, "element_size"):
+        # torch tensor
+        return value.numel() * value.element_size()
+    if isinstance(value, np.ndarray):
+        # Broadcast arrays (zero strides) only hold one copy of the repeated axis
+        stored = [size for size, stride in zip(value.shape, value.strides) if stride != 0]
+        return int(np.prod(stored, dtype=np.int64)) * value.itemsize
+    if isinstance(value, dict):
+        return sys.getsizeof(value) + sum(result_size(k) + result_size(v) for k, v in value.items())
+    if isinstance(value, (list, tuple)):
+        return sys.getsizeof(value) + sum(result_size(item) for item in value)
+    if hasattr(value, "model_dump"):
+        return result_size(value.model_dump())
+    return sys.getsizeof(value)
+
+class ResultCache:
+    """
+    Finished results keyed by request parameters, with a memory budget, LRU eviction and optional TTL.
+
+    Cached values are shared between requests and must not be modified by callers.
+    A ttl_seconds of None keeps entries until they are evicted.
+    """
+
+    def __init__(self, budget_bytes: int, ttl_seconds: Optional[float] = None):
+        self.budget_bytes = budget_bytes
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[Hashable, Dict[str, Any]]" = OrderedDict()
+        self._lock = threading.RLock()
+        self._resident_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        """Return the cached value for key and mark it as recently used, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry["expires_at"] is not None and entry["expires_at"] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._entries.move_to_end(key)
+            return entry["value"]
+
+    def put(self, key: Hashable, value: Any) -> None:
+        """Cache a value, evicting least recently used entries to stay within the budget"""
+        size = result_size(value)
+        if size > self.budget_bytes:
+            return
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds else None
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            while self._entries and self._resident_bytes + size > self.budget_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self.evictions += 1
+            self._entries[key] = {"value": value, "size_bytes": size, "expires_at": expires_at}
+            self._resident_bytes += size
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+            self._resident_bytes = 0
+
+    def _remove(self, key: Hashable) -> None:
+        entry = self._entries.pop(key)
+        self._resident_bytes -= entry["size_bytes"]
+
+    def stats(self) -> Dict[str, Any]:
+        """Hit, miss, eviction and expiration counts plus the number and size of cached entries"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "entries": len(self._entries),
+                "budget_bytes": self.budget_bytes,
+                "resident_bytes": self._resident_bytes,
+                "ttl_seconds": self.ttl_seconds,
+            }
+
+# Cache of finished /attention, /attention_comparison and /predict_masked results.
+# RESULT_CACHE_MB sets the memory budget, RESULT_CACHE_TTL_SECONDS an optional expiry.
+RESULT_CACHE_MB = float(os.environ.get("RESULT_CACHE_MB", "256"))
+RESULT_CACHE_TTL_SECONDS = float(os.environ["RESULT_CACHE_TTL_SECONDS"]) if os.environ.get("RESULT_CACHE_TTL_SECONDS") else None
+
+result_cache = ResultCache(budget_bytes=int(RESULT_CACHE_MB * 2**20), ttl_seconds=RESULT_CACHE_TTL_SECONDS)
+
+# Cache of the raw model attentions per (model, text), so every visualization
+# method can be computed without running the model again. The stacked
+# attentions are kept as ATTENTION_CACHE_DTYPE ("float32" or "float16").
+ATTENTION_CACHE_MB = float(os.environ.get("ATTENTION_CACHE_MB", "256"))
+ATTENTION_CACHE_DTYPE = os.environ.get("ATTENTION_CACHE_DTYPE", "float32")
+
+attention_tensor_cache = ResultCache(budget_bytes=int(ATTENTION_CACHE_MB * 2**20), ttl_seconds=RESULT_CACHE_TTL_SECONDS)
+
+# Cache of tokenizations (tokens with wordIndex and model input ids) per
+# (model, text), shared by /tokenize, /attention, /attention_comparison and
+# /predict_masked. TOKENIZATION_CACHE_MB sets the memory budget.
+TOKENIZATION_CACHE_MB = float(os.environ.get("TOKENIZATION_CACHE_MB", "32"))
+
+tokenization_cache = ResultCache(budget_bytes=int(TOKENIZATION_CACHE_MB * 2**20))
@@ -1,164 +1,392 @@
-from fastapi import APIRouter, HTTPException
+from typing import Any, Callable, Dict, List, Optional, Sequence, Tuple, Union
+import numpy as np
+from fastapi import APIRouter, HTTPException, Header
 from classes import *
 from helpers import *
-from routes.tokenize import tokenize_text
-from attention_processing import process_attention_with_method
+from attention_processing import compute_attention_with_method, build_layers
+from attention_flow import ensure_flow_fits
+from attention_encoding import negotiate_attention_format, attention_binary_response
+from inference_batching import inference_batcher
+from inference_executor import run_blocking
+from model_loading import ensure_model_loaded
+from long_text import ensure_fits, resolve_window, plan_windows, window_positions
+from attention_sparse import validate_sparse_options
+from result_cache import result_cache, attention_tensor_cache, ATTENTION_CACHE_DTYPE
 router = APIRouter()
 
-@router.post("", response_model=AttentionResponse)
-async def get_attention_matrices(request: AttentionRequest):
-    """Get attention matrices for the input text using the specified model"""
-    try:
-        debug = request.debug if hasattr(request, 'debug') else False
-        print(f"Processing attention request: text='{request.text}', model={request.model_name}, method={request.visualization_method}, debug={debug}")
-        
-        # First tokenize the text using the same function that the /tokenize endpoint uses
-        # to ensure consistency
-        tokenizer_response = await tokenize_text(TokenizeRequest(text=request.text, model_name=request.model_name, debug=debug))
-        tokens = tokenizer_response["tokens"]
-        print(f"Tokenized into {len(tokens)} tokens")
-        
-        # Load base model (not masked LM) to access attention matrices
-        model_name = request.model_name
-        
-        if model_name not in MODEL_CONFIGS:
-            raise HTTPException(status_code=400, detail=f"Model {model_name} not supported")
-            
-        config = MODEL_CONFIGS[model_name]
-        
-        # Handle custom model differently if needed
-        if config["model_class"] == "custom":
-            # For custom models, we need special handling
-            base_model_key = f"{model_name}_base"
-            if base_model_key not in models:
-                # For TinyBERT, we use the same model with different configuration
-                _, tokenizer = get_model_and_tokenizer(model_name, debug)
-                custom_repo = "EdwinXhen/TinyBert_6Layer_MLM"
-                print(f"Loading base model from {custom_repo} for attention visualization...")
-                from transformers import AutoModel
-                models[base_model_key] = AutoModel.from_pretrained(custom_repo, attn_implementation="eager", output_attentions=True)
-                if torch.cuda.is_available():
-                    models[base_model_key] = models[base_model_key].cuda()
-                models[base_model_key].eval()
-                print(f"Base model {model_name} loaded")
+# Input of the attention pipeline: a text, or a sequence of token ids (including
+# special tokens) that is run as is, e.g. for token-level substitutions
+AttentionInput = Union[str, Tuple[int, ...]]
+
+def tokens_from_ids(tokenizer, model_name: str, input_ids: Sequence[int]) -> List[Dict[str, Any]]:
+    """Token objects for a sequence of token ids, in the format of the /tokenize endpoint"""
+    tokens = tokenizer.convert_ids_to_tokens(list(input_ids))
+    if "roberta" in model_name:
+        tokens = [clean_roberta_token(token) for token in tokens]
+    return [{"text": token, "index": idx} for idx, token in enumerate(tokens)]
+
+def encode_ids(tokenizer, input_ids: Sequence[int]) -> Dict[str, torch.Tensor]:
+    """Model inputs for an already encoded sequence of token ids"""
+    ids = torch.tensor([list(input_ids)], dtype=torch.long)
+    encoding = {"input_ids": ids, "attention_mask": torch.ones_like(ids)}
+    if "token_type_ids" in tokenizer.model_input_names:
+        encoding["token_type_ids"] = torch.zeros_like(ids)
+    return encoding
+
+async def get_raw_attentions(model_name: str, inputs: List[AttentionInput], debug: bool = False,
+                             known_tokens: Optional[Dict[AttentionInput, List[Dict[str, Any]]]] = None,
+                             precision: Optional[str] = None, backend: Optional[str] = None,
+                             layers: Optional[Tuple[int, ...]] = None,
+                             check_length: Optional[Callable[[int], None]] = None) -> List[Dict[str, Any]]:
+    """
+    Run the encoder to get the attention matrices of texts or token id sequences, cached per (model, input)
+
+    All inputs that are not cached yet are run as one padded batch. With layers,
+    only those layers are captured and the forward pass stops after the deepest
+    one; cached full attentions are sliced instead.
+
+    Args:
+        model_name: Model to run
+        inputs: Texts or tuples of token ids
+        debug: Whether to print debug information
+        known_tokens: Tokens (with wordIndex) for token id inputs; texts get
+            their tokens from the same encode call as the model inputs
+        precision: "fp32" or "int8" (quantized copy), the model's default for None
+        backend: Inference backend ("eager", or bucketed "traced"/"compiled"), INFERENCE_BACKEND for None
+        layers: Sorted layer indices to capture, all layers for None
+        check_length: Called with the token count of every input before the model
+            runs, e.g. ensure_flow_fits to reject inputs that are too long
+
+    Returns:
+        One dictionary per input with the tokens (with wordIndex) and "attentions",
+        the stacked attention tensor of shape (num_layers, num_heads, seq_len, seq_len)
+        in ATTENTION_CACHE_DTYPE (only the requested layers, listed in "layer_indices",
+        when layers is given). Cached values must not be modified.
+    """
+    precision = resolve_precision(model_name, precision)
+    variant = model_key(model_name, precision)
+    raws = [attention_tensor_cache.get((variant, item)) for item in inputs]
+    if layers is not None:
+        for i, item in enumerate(inputs):
+            if raws[i] is not None:
+                raws[i] = {"tokens": raws[i]["tokens"], "attentions": raws[i]["attentions"][list(layers)], "layer_indices": layers}
+            else:
+                raws[i] = attention_tensor_cache.get((variant, item, layers))
+    missing = [i for i, raw in enumerate(raws) if raw is None]
+    if check_length is not None:
+        for raw in raws:
+            if raw is not None:
+                check_length(len(raw["tokens"]))
+    if len(missing) < len(inputs):
+        print(f"Raw attention cache hit for {len(inputs) - len(missing)} of {len(inputs)} inputs: model={model_name}")
+    if not missing:
+        return raws
+    
+    # Run the encoder of the already loaded masked LM model to access attention matrices
+    model = await run_blocking(get_base_model, model_name, debug, precision)
+    _, tokenizer = await run_blocking(get_model_and_tokenizer, model_name, debug, precision)
+    
+    token_lists, encodings = [], []
+    for i in missing:
+        item = inputs[i]
+        if isinstance(item, str):
+            # Same encoding as the /tokenize endpoint, with the token-to-word mapping
+            tokens, encoding = get_encoding(tokenizer, model_name, item)
+            encoding = encoding_to_tensors(encoding)
         else:
-            # Standard model loading
-            base_model_class = config["base_model_class"]
-            
-            # Check if we already have a base model cached
-            base_model_key = f"{model_name}_base"
-            if base_model_key not in models:
-                print(f"Loading base model {model_name}...")
-                models[base_model_key] = base_model_class.from_pretrained(model_name, attn_implementation="eager")
-                if torch.cuda.is_available():
-                    models[base_model_key] = models[base_model_key].cuda()
-                models[base_model_key].eval()
-                print(f"Base model {model_name} loaded")
-        
-        model = models[base_model_key]
-        tokenizer = tokenizers[request.model_name]
-        
-        # Get input tokens - use the same encoding approach as the tokenize endpoint
-        if "roberta" in request.model_name.lower():
-            encoding = tokenizer.encode_plus(
-                request.text, 
-                add_special_tokens=True, 
-                return_tensors="pt",
-                return_attention_mask=True
-            )
-            
-            # Map RoBERTa tokens to words for better visualization
-            token_to_word_map = map_roberta_tokens_to_words(tokens, request.text)
+            if known_tokens and item in known_tokens:
+                tokens = [dict(token) for token in known_tokens[item]]
+            else:
+                tokens = tokens_from_ids(tokenizer, model_name, item)
+            encoding = encode_ids(tokenizer, item)
+        print(f"Tokenized into {len(tokens)} tokens")
+        if check_length is not None:
+            check_length(len(tokens))
+        token_lists.append(tokens)
+        encodings.append(encoding)
+    
+    # Run the model; these inputs and concurrent requests for the same model share one padded forward pass
+    print(f"Running model inference on {len(encodings)} input(s) to get attention matrices...")
+    outputs = await inference_batcher.run_many(
+        f"{variant}:encoder",
+        model,
+        encodings,
+        pad_token_id=tokenizer.pad_token_id or 0,
+        output_attentions=True,
+        backend=backend,
+        layers=layers
+    )
+    
+    for i, tokens, output in zip(missing, token_lists, outputs):
+        # output.attentions is a tuple of tensors with shape (1, num_heads, seq_len, seq_len)
+        # One tensor per layer
+        attentions = torch.cat(output.attentions, dim=0).to(device="cpu", dtype=getattr(torch, ATTENTION_CACHE_DTYPE))
+        print(f"Got attention matrices for {attentions.shape[0]} layers")
+        if layers is None:
+            raws[i] = {"tokens": tokens, "attentions": attentions}
+            attention_tensor_cache.put((variant, inputs[i]), raws[i])
         else:
-            # For BERT and DistilBERT
-            text = f"[CLS] {request.text} [SEP]"
-            encoding = tokenizer(text, return_tensors="pt")
-            
-            # Map BERT/DistilBERT tokens to words for better visualization
-            token_to_word_map = map_bert_tokens_to_words(tokens, request.text)
-        
-        if torch.cuda.is_available():
-            encoding = {k: v.cuda() for k, v in encoding.items()}
+            raws[i] = {"tokens": tokens, "attentions": attentions, "layer_indices": layers}
+            attention_tensor_cache.put((variant, inputs[i], layers), raws[i])
+    return raws
+
+async def get_raw_attention(model_name: str, text: str, debug: bool = False) -> Dict[str, Any]:
+    """Raw attention of a single text, see get_raw_attentions"""
+    return (await get_raw_attentions(model_name, [text], debug))[0]
+
+def attention_cache_key(variant: str, item: AttentionInput, method: str, layers: Optional[Tuple[int, ...]] = None,
+                        heads: Optional[Tuple[int, ...]] = None) -> tuple:
+    """result_cache key of a post-processed attention result (variant: model_key of model and precision)"""
+    selection = () if layers is None and heads is None else ((layers, heads),)
+    return ("attention", variant, item, method) + selection
+
+def _process_raw_attentions(raws: List[Dict[str, Any]], method: str, layers: Optional[Tuple[int, ...]] = None,
+                            heads: Optional[Tuple[int, ...]] = None) -> List[Dict[str, Any]]:
+    """
+    Post-process raw attentions with the given method (runs on the inference executor)
+
+    With layers and/or heads, only those layers and heads of the result are kept;
+    the raw attentions must hold every layer the method needs up to them.
+    """
+    results = []
+    for raw in raws:
+        # Per-layer (1, num_heads, seq_len, seq_len) tensors, as returned by the model
+        attention_matrices = tuple(layer.float() for layer in raw["attentions"].split(1))
+        attention = compute_attention_with_method(attention_matrices, method=method, debug=False)
+        num_heads = attention_matrices[0].shape[1]
+        if layers is not None:
+            captured = list(raw.get("layer_indices") or range(len(attention_matrices)))
+            positions = [captured.index(layer) for layer in layers]
+            if attention.strides[0] == 0:
+                # Flow is the same matrix on every layer, keep it broadcast
+                attention = np.broadcast_to(attention[0], (len(positions),) + attention.shape[1:])
+            else:
+                attention = attention[positions]
+        if heads is not None:
+            if attention.ndim == 4:
+                attention = attention[:, list(heads)]
+            num_heads = len(heads)
+        print(f"Processed {len(attention)} layers with {num_heads} heads each")
+        # The result is shared through the cache, so freeze the array
+        attention.setflags(write=False)
+        result = {
+            "tokens": raw["tokens"],
+            "attention": attention,
+            "num_heads": num_heads
+        }
+        if layers is not None:
+            result["layer_indices"] = list(layers)
+        if heads is not None:
+            result["head_indices"] = list(heads)
+        results.append(result)
+    return results
+
+async def compute_attentions(model_name: str, method: str, inputs: List[AttentionInput], debug: bool = False,
+                             known_tokens: Optional[Dict[AttentionInput, List[Dict[str, Any]]]] = None,
+                             precision: Optional[str] = None, backend: Optional[str] = None,
+                             layers: Optional[Tuple[int, ...]] = None, heads: Optional[Tuple[int, ...]] = None) -> List[Dict[str, Any]]:
+    """
+    Get the attention of several texts or token id sequences, post-processed together
+
+    The model only runs for inputs whose raw attention is not cached, in one batched
+    forward pass, so switching between methods only pays for the post-processing.
+    With a layer selection the forward pass stops after the deepest selected layer
+    (raw and rollout; flow needs every layer).
+
+    Args:
+        model_name: Model to run
+        method: Visualization method (raw, rollout, flow)
+        inputs: Texts or tuples of token ids
+        debug: Whether to print debug information
+        known_tokens: Already computed tokens for some of the inputs, see get_raw_attentions
+        precision: "fp32" or "int8" (quantized copy), the model's default for None
+        backend: Inference backend ("eager", or bucketed "traced"/"compiled"), INFERENCE_BACKEND for None
+        layers: Sorted layer indices to return, all layers for None
+        heads: Sorted head indices to return, all heads for None
+
+    Returns:
+        One dictionary per input with the tokens, the attention array from
+        compute_attention_with_method and the number of heads per layer, plus
+        "layer_indices" and "head_indices" for selections.
+        Results are cached and must not be modified.
+    """
+    variant = model_key(model_name, resolve_precision(model_name, precision))
+    cache_keys = [attention_cache_key(variant, item, method, layers, heads) for item in inputs]
+    results = [result_cache.get(key) for key in cache_keys]
+    missing = [i for i, result in enumerate(results) if result is None]
+    if len(missing) < len(inputs):
+        print(f"Attention cache hit for {len(inputs) - len(missing)} of {len(inputs)} inputs: model={model_name}, method={method}")
+    if not missing:
+        return results
+    
+    try:
+        for i in missing:
+            print(f"Processing attention request: input={inputs[i]!r}, model={model_name}, method={method}, debug={debug}")
         
-        # Configure the model to return attention
-        print("Running model inference to get attention matrices...")
-        with torch.no_grad():
-            try:
-                # Try without attn_implementation first (for older transformers versions)
-                outputs = model(**encoding, output_attentions=True)
-            except TypeError as e:
-                if "attn_implementation" in str(e):
-                    # Fall back to newer syntax for newer transformers versions
-                    print("Using older transformers version without attn_implementation")
-                else:
-                    # Re-raise if it's not about attn_implementation
-                    raise
-            
-        # Extract attention from outputs
-        # outputs.attentions is a tuple of tensors with shape (batch_size, num_heads, seq_len, seq_len)
-        # One tensor per layer
-        attention_matrices = outputs.attentions
-        print(f"Got attention matrices for {len(attention_matrices)} layers")
+        # Layers the method needs: raw only the selected ones, rollout every layer up to the
+        # deepest selected one, flow all of them
+        capture = None
+        if layers is not None and method == "raw":
+            capture = layers
+        elif layers is not None and method == "rollout":
+            capture = tuple(range(max(layers) + 1))
+        raws = await get_raw_attentions(model_name, [inputs[i] for i in missing], debug, known_tokens, precision, backend, capture,
+                                        ensure_flow_fits if method == "flow" else None)
         
         # Process attention using the specified method
-        if request.visualization_method != "raw":
-            print(f"Processing attention with method: {request.visualization_method}")
-
-        # Convert attention matrices to the expected response format
-        layers = []
-        for layer_idx, layer_attention in enumerate(attention_matrices):
-            # Convert from torch tensor to Python list
-            layer_attention = layer_attention.cpu().numpy()
-            
-            # Extract heads
-            heads = []
-            num_heads = layer_attention.shape[1]  # Dimension 1 is the number of heads
-            for head_idx in range(num_heads):
-                # Convert attention matrix for this head to list format
-                # Shape is [batch_size=1, seq_len, seq_len]
-                attention_matrix = layer_attention[0, head_idx].tolist()
-                
-                heads.append({
-                    "headIndex": head_idx,
-                    "attention": attention_matrix
-                })
-            
-            layers.append({
-                "layerIndex": layer_idx,
-                "heads": heads
-            })
-            
-        print(f"Processed {len(layers)} layers with {num_heads} heads each")
-        
-        # Process with selected visualization method
-        if request.visualization_method != "raw":
-            processed_layers = process_attention_with_method(
-                attention_matrices, 
-                method=request.visualization_method,
-                debug=False
-            )
-            # Replace the layers with the processed ones
-            layers = processed_layers
-            
-        # Add token-to-word mapping to the response
-        for i, token in enumerate(tokens):
-            if i in token_to_word_map:
-                token["wordIndex"] = token_to_word_map[i]
-            
-        # Return complete attention data
-        attention_data = {
-            "tokens": tokens,
-            "layers": layers
-        }
-        
-        # Log the structure of the response for debugging
-        response = {"attention_data": attention_data}
-        print(f"Sending response with {len(response['attention_data']['tokens'])} tokens and {len(response['attention_data']['layers'])} layers")
+        if method != "raw":
+            print(f"Processing attention with method: {method}")
+        processed = await run_blocking(_process_raw_attentions, raws, method, layers, heads)
         
-        return response
+        for i, result in zip(missing, processed):
+            results[i] = result
+            result_cache.put(cache_keys[i], result)
+        return results
     
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Attention extraction error: {str(e)}")
         import traceback
         traceback.print_exc()
         raise HTTPException(status_code=500, detail=str(e))
+
+def normalize_selection(indices: Optional[List[int]], count: int, name: str) -> Optional[Tuple[int, ...]]:
+    """
+    Validate layer or head indices against the model and sort them
+
+    Args:
+        indices: Requested indices, negative ones count from the end; None selects all
+        count: Number of layers or heads of the model
+        name: "layer" or "head", for error messages
+
+    Returns:
+        Sorted unique indices, or None for all
+    """
+    if indices is None:
+        return None
+    if not indices:
+        raise HTTPException(status_code=400, detail=f"Empty {name} selection, omit it to get every {name}")
+    invalid = [index for index in indices if not -count <= index < count]
+    if invalid:
+        raise HTTPException(status_code=400, detail=f"Invalid {name} indices {invalid}, the model has {count} {name}s")
+    return tuple(sorted({index % count for index in indices}))
+
+async def attention_selection(request: AttentionRequest) -> Tuple[Optional[Tuple[int, ...]], Optional[Tuple[int, ...]]]:
+    """The validated (layers, heads) selection of a request; the model must be loaded"""
+    if request.layers is None and request.heads is None:
+        return None, None
+    model, _ = await run_blocking(get_model_and_tokenizer, request.model_name, False, request.precision)
+    return (normalize_selection(request.layers, model.config.num_hidden_layers, "layer"),
+            normalize_selection(request.heads, model.config.num_attention_heads, "head"))
+
+async def compute_attention(request: AttentionRequest, layers: Optional[Tuple[int, ...]] = None,
+                            heads: Optional[Tuple[int, ...]] = None) -> Dict[str, Any]:
+    """Attention of a single request, see compute_attentions"""
+    debug = request.debug if hasattr(request, 'debug') else False
+    return (await compute_attentions(request.model_name, request.visualization_method, [request.text], bool(debug),
+                                     precision=request.precision, backend=request.inference_backend,
+                                     layers=layers, heads=heads))[0]
+
+async def compute_long_attention(request: AttentionRequest, layers: Optional[Tuple[int, ...]] = None,
+                                 heads: Optional[Tuple[int, ...]] = None) -> Dict[str, Any]:
+    """
+    Attention of a long text in overlapping windows (long-text mode)
+
+    The windows are token id sequences, so they run as one batch through
+    compute_attentions and are cached like any other input.
+
+    Returns:
+        Dictionary with the tokens of the whole text and "windows": per window its
+        index, start, end, token_indices and the compute_attentions "result"
+    """
+    debug = bool(request.debug)
+    _, tokenizer = await run_blocking(get_model_and_tokenizer, request.model_name, debug, request.precision)
+    model = await run_blocking(get_base_model, request.model_name, debug, request.precision)
+    window_size, overlap = resolve_window(model, request.window_size, request.window_overlap)
+    tokens, encoding = await run_blocking(get_encoding, tokenizer, request.model_name, request.text)
+    input_ids = encoding["input_ids"]
+
+    windows, inputs, known_tokens = [], [], {}
+    for index, (start, end) in enumerate(plan_windows(len(tokens), window_size, overlap)):
+        positions = window_positions(start, end, len(tokens))
+        item = tuple(input_ids[position] for position in positions)
+        windows.append({"index": index, "start": start, "end": end, "token_indices": positions})
+        inputs.append(item)
+        known_tokens[item] = [tokens[position] for position in positions]
+    print(f"Long text: {len(tokens)} tokens in {len(windows)} windows of {window_size} (overlap {overlap})")
+
+    results = await compute_attentions(request.model_name, request.visualization_method, inputs, debug, known_tokens,
+                                       request.precision, request.inference_backend, layers, heads)
+    for window, result in zip(windows, results):
+        window["result"] = result
+    return {"tokens": tokens, "windows": windows}
+
+def long_attention_data(long_result: Dict[str, Any], share_heads: bool = False, sparse_top_k: Optional[int] = None,
+                        sparse_mass: Optional[float] = None) -> Dict[str, Any]:
+    """Convert a compute_long_attention result to the JSON attention data format"""
+    windows = []
+    for window in long_result["windows"]:
+        result = window["result"]
+        windows.append({
+            "index": window["index"],
+            "start": window["start"],
+            "end": window["end"],
+            "token_indices": window["token_indices"],
+            "layers": build_layers(result["attention"], result["num_heads"], share_heads=share_heads,
+                                   layer_indices=result.get("layer_indices"), head_indices=result.get("head_indices"),
+                                   sparse_top_k=sparse_top_k, sparse_mass=sparse_mass)
+        })
+    return {"tokens": long_result["tokens"], "layers": [], "windows": windows}
+
+def attention_data_from_result(result: Dict[str, Any], share_heads: bool = False, sparse_top_k: Optional[int] = None,
+                               sparse_mass: Optional[float] = None) -> Dict[str, Any]:
+    """Convert a compute_attention result to the JSON attention data format (sparse rows for sparse_top_k/sparse_mass)"""
+    return {
+        "tokens": result["tokens"],
+        "layers": build_layers(result["attention"], result["num_heads"], share_heads=share_heads,
+                               layer_indices=result.get("layer_indices"), head_indices=result.get("head_indices"),
+                               sparse_top_k=sparse_top_k, sparse_mass=sparse_mass)
+    }
+
+@router.post("", response_model=AttentionResponse, response_model_exclude_none=True)
+async def get_attention_matrices(request: AttentionRequest, accept: Optional[str] = Header(None),
+                                 x_model_load_wait: Optional[float] = Header(None)):
+    """
+    Get attention matrices for the input text using the specified model
+
+    Responds with JSON by default, or with the packed binary attention payload
+    when the Accept header asks for application/x-attention-f16 or application/x-attention-u8.
+    """
+    validate_sparse_options(request.sparse_top_k, request.sparse_mass)
+    await ensure_model_loaded(request.model_name, x_model_load_wait, request.precision)
+    layers, heads = await attention_selection(request)
+    binary_format = negotiate_attention_format(accept)
+    sparse = {"sparse_top_k": request.sparse_top_k, "sparse_mass": request.sparse_mass}
+    
+    if request.long_text:
+        long_result = await compute_long_attention(request, layers, heads)
+        if binary_format:
+            sections = {f"window_{window['index']}": window["result"] for window in long_result["windows"]}
+            metadata = {"windows": [{key: window[key] for key in ("index", "start", "end", "token_indices")}
+                                    for window in long_result["windows"]]}
+            return await run_blocking(attention_binary_response, sections, binary_format, metadata, **sparse)
+        response = {"attention_data": await run_blocking(long_attention_data, long_result, share_heads=bool(request.share_heads), **sparse)}
+        print(f"Sending long text response with {len(long_result['tokens'])} tokens in {len(long_result['windows'])} windows")
+        return response
+    
+    # Without long_text, texts longer than the model accepts are rejected up front
+    model, tokenizer = await run_blocking(get_model_and_tokenizer, request.model_name, bool(request.debug), request.precision)
+    tokens, _ = await run_blocking(get_encoding, tokenizer, request.model_name, request.text)
+    ensure_fits(model, request.model_name, len(tokens))
+    result = await compute_attention(request, layers, heads)
+    
+    if binary_format:
+        print(f"Sending binary ({binary_format}) response with {len(result['tokens'])} tokens")
+        return await run_blocking(attention_binary_response, {"attention": result}, binary_format, **sparse)
+    
+    # Log the structure of the response for debugging
+    response = {"attention_data": await run_blocking(attention_data_from_result, result, share_heads=bool(request.share_heads), **sparse)}
+    print(f"Sending response with {len(response['attention_data']['tokens'])} tokens and {len(response['attention_data']['layers'])} layers")
+    
+    return response
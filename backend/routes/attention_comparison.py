@@ -1,14 +1,23 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Header
 from classes import *
 from helpers import *
 from attention_comparison_helpers import *
+from routes.attention import attention_data_from_result
+from attention_encoding import negotiate_attention_format, attention_binary_response
+from inference_executor import run_blocking
+from model_loading import ensure_model_loaded
+from result_cache import result_cache
 router = APIRouter()
 
 
-@router.post("", response_model=AttentionComparisonResponse)
-async def get_attention_comparison(request: ComparisonRequest):
+@router.post("", response_model=AttentionComparisonResponse, response_model_exclude_none=True)
+async def get_attention_comparison(request: ComparisonRequest, accept: Optional[str] = Header(None),
+                                   x_model_load_wait: Optional[float] = Header(None)):
     """
     Dispatcher for attention comparison - routes to the appropriate model-specific implementation
+
+    Responds with JSON by default, or with the packed binary attention payload
+    (sections "before_attention" and "after_attention") when the Accept header asks for it.
     """
     # Log request details
     print(f"\n\n=== ATTENTION COMPARISON REQUEST ===")
@@ -17,13 +26,37 @@ async def get_attention_comparison(request: ComparisonRequest):
     print(f"Replacement word: '{request.replacement_word}'")
     print(f"Model: {request.model_name}")
     print(f"Visualization method: {request.visualization_method}")
+    print(f"Substitution: {request.substitution}")
     
-    # Dispatch based on model type
-    if "roberta" in request.model_name.lower():
-        return await get_attention_comparison_roberta(request)
+    cache_key = ("attention_comparison", request.model_name, request.text, request.masked_index,
+                 request.replacement_word, request.visualization_method, request.substitution)
+    comparison = result_cache.get(cache_key)
+    if comparison is None:
+        await ensure_model_loaded(request.model_name, x_model_load_wait)
+        # Dispatch based on substitution mode and model type
+        if request.substitution == "token":
+            comparison = await get_attention_comparison_tokens(request)
+        elif "roberta" in request.model_name.lower():
+            comparison = await get_attention_comparison_roberta(request)
+        else:
+            # Both BERT and DistilBERT use the same tokenization approach (WordPiece)
+            # and can use the same comparison implementation
+            comparison = await get_attention_comparison_bert(request)
+        result_cache.put(cache_key, comparison)
     else:
-        # Both BERT and DistilBERT use the same tokenization approach (WordPiece)
-        # and can use the same comparison implementation
-        return await get_attention_comparison_bert(request)
+        print("Attention comparison cache hit")
+    
+    sections = {key: comparison[key] for key in ("before_attention", "after_attention")}
+    metadata = {"alignment": comparison["alignment"]} if "alignment" in comparison else None
+    binary_format = negotiate_attention_format(accept)
+    if binary_format:
+        return await run_blocking(attention_binary_response, sections, binary_format, metadata)
+    
+    response = {
+        key: await run_blocking(attention_data_from_result, result, share_heads=bool(request.share_heads))
+        for key, result in sections.items()
+    }
+    response["alignment"] = comparison.get("alignment")
+    return response
 
 
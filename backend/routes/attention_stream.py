@@ -0,0 +1,204 @@
+import asyncio
+import concurrent.futures
+import json
+import os
+import threading
+import time
+import numpy as np
+from typing import Any, Dict, List, Optional, Tuple
+from fastapi import APIRouter, HTTPException, Header
+from fastapi.responses import StreamingResponse
+from classes import *
+from helpers import *
+from attention_capture import stream_forward
+from attention_processing import compute_attention_with_method, build_layers, rollout_step
+from inference_executor import run_blocking, stream_executor
+from model_loading import ensure_model_loaded
+from result_cache import result_cache, ATTENTION_CACHE_DTYPE
+from routes.attention import attention_selection, attention_cache_key
+from long_text import ensure_fits
+from attention_flow import ensure_flow_fits
+from attention_sparse import validate_sparse_options
+router = APIRouter()
+
+# Streamed /attention: one message per line (NDJSON), or server-sent events when
+# the Accept header asks for text/event-stream. Messages, in order:
+#   {"event": "tokens", "tokens": [...], "num_layers": ..., "num_heads": ..., "method": ...}
+#   {"event": "layer", "layer": {"layerIndex": ..., "heads": [...]}}   once per layer
+#   {"event": "done"}, or {"event": "error", "detail": ...} when the forward pass fails
+# Layers are sent while the forward pass is still running (flow needs every layer
+# first). At most STREAM_BUFFER_LAYERS converted layers wait for a slow client;
+# the forward pass (on the stream executor) pauses until they are sent and stops
+# when the client goes away, or when it has not read a layer for
+# STREAM_SEND_TIMEOUT seconds. The stream then ends with an error message.
+STREAM_BUFFER_LAYERS = int(os.environ.get("STREAM_BUFFER_LAYERS", "2"))
+STREAM_SEND_TIMEOUT = float(os.environ.get("STREAM_SEND_TIMEOUT", "30"))
+STREAM_METHODS = ("raw", "rollout", "flow")
+STREAM_HEADERS = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+
+def format_message(message: Dict[str, Any], sse: bool) -> str:
+    """One stream message as an NDJSON line or a server-sent event"""
+    data = json.dumps(message, separators=(",", ":"))
+    return f"event: {message['event']}\ndata: {data}\n\n" if sse else data + "\n"
+
+def _produce_layers(model, batch: Dict[str, torch.Tensor], method: str, layer_indices: List[int],
+                    heads: Optional[Tuple[int, ...]], num_heads: int, share_heads: bool, sparse: Dict[str, Any], send) -> None:
+    """
+    Run the forward pass and send every requested layer as soon as it is available (runs on the stream executor)
+
+    Only the current layer (plus the running rollout product, or every layer for
+    flow) is held in memory. send(message) returns True once the client is gone,
+    which stops the forward pass. A forward pass that ends without capturing
+    every requested layer is reported as an error, not as done.
+    """
+    wanted = set(layer_indices)
+    rollout = {"product": None}
+    collected = []
+    seen = set()
+    client_gone = {"value": False}
+
+    def send_layer(layer_idx, attention):
+        layer = build_layers(attention[None], num_heads, share_heads, [layer_idx], heads, **sparse)[0]
+        client_gone["value"] = send({"event": "layer", "layer": layer})
+        return client_gone["value"]
+
+    def on_layer(layer_idx, attention):
+        seen.add(layer_idx)
+        # Same precision as the cached attentions of the non-streamed endpoint
+        attention = attention.to(device="cpu", dtype=getattr(torch, ATTENTION_CACHE_DTYPE)).float()
+        if method == "flow":
+            collected.append(attention)
+            return False
+        if method == "rollout":
+            rollout["product"], layer_rollout = rollout_step(rollout["product"], attention)
+            return send_layer(layer_idx, layer_rollout.numpy()) if layer_idx in wanted else False
+        if layer_idx not in wanted:
+            return False
+        layer_attention = attention[0].numpy()
+        return send_layer(layer_idx, layer_attention[list(heads)] if heads is not None else layer_attention)
+
+    try:
+        stream_forward(model, batch, on_layer, None if method == "flow" else max(layer_indices))
+        if client_gone["value"]:
+            return
+        needed = set(range(model.config.num_hidden_layers)) if method == "flow" else wanted
+        if not needed <= seen:
+            raise RuntimeError(f"The forward pass captured no attention for layers {sorted(needed - seen)}")
+        if method == "flow":
+            flow = compute_attention_with_method(tuple(collected), method="flow")
+            flow = np.broadcast_to(flow[0], (len(layer_indices),) + flow.shape[1:])
+            for layer in build_layers(flow, num_heads, share_heads, layer_indices, heads, **sparse):
+                if send({"event": "layer", "layer": layer}):
+                    break
+        send({"event": "done"})
+    except Exception as e:
+        print(f"Attention stream error: {str(e)}")
+        import traceback
+        traceback.print_exc()
+        send({"event": "error", "detail": str(e)})
+
+async def _forward_stream(model, batch, tokens, method, layer_indices, heads, num_heads, share_heads, sparse, sse):
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue(maxsize=max(1, STREAM_BUFFER_LAYERS))
+    closed = threading.Event()
+    timed_out = threading.Event()
+
+    def emit(chunk):
+        # Called from the stream thread: wait for room in the queue, give up once
+        # the client is gone or has not read anything for STREAM_SEND_TIMEOUT seconds
+        if closed.is_set():
+            return True
+        future = asyncio.run_coroutine_threadsafe(queue.put(chunk), loop)
+        deadline = time.monotonic() + STREAM_SEND_TIMEOUT
+        while True:
+            try:
+                future.result(timeout=0.5)
+                return closed.is_set()
+            except concurrent.futures.TimeoutError:
+                if time.monotonic() >= deadline:
+                    timed_out.set()
+                    closed.set()
+                if closed.is_set():
+                    future.cancel()
+                    return True
+
+    def produce():
+        try:
+            _produce_layers(model, batch, method, layer_indices, heads, num_heads, share_heads, sparse,
+                            lambda message: emit(format_message(message, sse)))
+        finally:
+            emit(None)
+
+    yield format_message({"event": "tokens", "tokens": tokens, "num_layers": len(layer_indices),
+                          "num_heads": num_heads, "method": method}, sse)
+    producer = loop.run_in_executor(stream_executor, produce)
+    try:
+        while True:
+            if timed_out.is_set() and queue.empty():
+                # The forward pass gave up on this client, nothing else is queued
+                print(f"Attention stream aborted: client did not read for {STREAM_SEND_TIMEOUT}s")
+                yield format_message({"event": "error", "detail": f"Client did not read the stream for {STREAM_SEND_TIMEOUT} seconds"}, sse)
+                break
+            chunk = await queue.get()
+            if chunk is None:
+                break
+            yield chunk
+        await producer
+    finally:
+        closed.set()
+
+async def _cached_stream(result, method, share_heads, sparse, sse):
+    """Stream an already computed /attention result layer by layer"""
+    attention = result["attention"]
+    layer_indices = result.get("layer_indices") or list(range(len(attention)))
+    yield format_message({"event": "tokens", "tokens": result["tokens"], "num_layers": len(layer_indices),
+                          "num_heads": result["num_heads"], "method": method}, sse)
+    for position, layer_idx in enumerate(layer_indices):
+        layer = (await run_blocking(build_layers, attention[position:position + 1], result["num_heads"], share_heads,
+                                    [layer_idx], result.get("head_indices"), **sparse))[0]
+        yield format_message({"event": "layer", "layer": layer}, sse)
+    yield format_message({"event": "done"}, sse)
+
+@router.post("")
+async def stream_attention_matrices(request: AttentionRequest, accept: Optional[str] = Header(None),
+                                    x_model_load_wait: Optional[float] = Header(None)):
+    """
+    Stream the attention of /attention layer by layer while the model runs
+
+    Sends the tokens first and then every layer as soon as its attention is
+    computed, as NDJSON, or as server-sent events for Accept: text/event-stream.
+    Accepts the same request as /attention, including layer and head selections.
+    """
+    method = request.visualization_method
+    if method not in STREAM_METHODS:
+        raise HTTPException(status_code=400, detail=f"Unknown attention processing method: {method}")
+    if request.long_text:
+        raise HTTPException(status_code=400, detail="long_text is not supported when streaming, use /attention")
+    validate_sparse_options(request.sparse_top_k, request.sparse_mass)
+    await ensure_model_loaded(request.model_name, x_model_load_wait, request.precision)
+    layers, heads = await attention_selection(request)
+    sse = accept is not None and "text/event-stream" in accept
+    media_type = "text/event-stream" if sse else "application/x-ndjson"
+    share_heads = bool(request.share_heads)
+    sparse = {"sparse_top_k": request.sparse_top_k, "sparse_mass": request.sparse_mass}
+
+    # A result computed by /attention is streamed as is
+    variant = model_key(request.model_name, resolve_precision(request.model_name, request.precision))
+    cached = result_cache.get(attention_cache_key(variant, request.text, method, layers, heads))
+    if cached is not None:
+        print(f"Streaming cached attention: model={request.model_name}, method={method}")
+        return StreamingResponse(_cached_stream(cached, method, share_heads, sparse, sse), media_type=media_type, headers=STREAM_HEADERS)
+
+    model = await run_blocking(get_base_model, request.model_name, bool(request.debug), request.precision)
+    _, tokenizer = await run_blocking(get_model_and_tokenizer, request.model_name, bool(request.debug), request.precision)
+    tokens, encoding = await run_blocking(get_encoding, tokenizer, request.model_name, request.text)
+    ensure_fits(model, request.model_name, len(tokens))
+    if method == "flow":
+        ensure_flow_fits(len(tokens))
+    device = next(model.parameters()).device
+    batch = {name: value.to(device) for name, value in encoding_to_tensors(encoding).items()}
+    layer_indices = list(layers) if layers is not None else list(range(model.config.num_hidden_layers))
+    num_heads = len(heads) if heads is not None else model.config.num_attention_heads
+    print(f"Streaming attention: model={request.model_name}, method={method}, {len(tokens)} tokens, {len(layer_indices)} layers")
+    return StreamingResponse(_forward_stream(model, batch, tokens, method, layer_indices, heads, num_heads, share_heads, sparse, sse),
+                             media_type=media_type, headers=STREAM_HEADERS)
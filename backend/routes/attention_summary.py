@@ -0,0 +1,48 @@
+import numpy as np
+from fastapi import APIRouter, Header
+from classes import *
+from helpers import *
+from attention_processing import HEAD_METRICS, compute_head_statistics
+from inference_executor import run_blocking
+from long_text import ensure_fits
+from model_loading import ensure_model_loaded
+from result_cache import result_cache
+from routes.attention import get_raw_attentions
+router = APIRouter()
+
+
+@router.post("", response_model=AttentionSummaryResponse)
+async def get_attention_summary(request: AttentionSummaryRequest, x_model_load_wait: Optional[float] = Header(None)):
+    """
+    Per-head summary statistics of the raw attention (entropy, distance, mass on special
+    and neighbouring tokens, ...) as a compact layers x heads x metrics table, so heads
+    can be ranked without downloading the attention matrices
+    """
+    variant = model_key(request.model_name, resolve_precision(request.model_name, request.precision))
+    cache_key = ("attention_summary", variant, request.text)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        print(f"Attention summary cache hit: model={request.model_name}")
+        return cached
+
+    await ensure_model_loaded(request.model_name, x_model_load_wait, request.precision)
+    debug = bool(request.debug)
+    model, tokenizer = await run_blocking(get_model_and_tokenizer, request.model_name, debug, request.precision)
+    tokens, _ = await run_blocking(get_encoding, tokenizer, request.model_name, request.text)
+    ensure_fits(model, request.model_name, len(tokens))
+
+    # The same cached raw attention as /attention, summarized in one pass over all heads
+    raw = (await get_raw_attentions(request.model_name, [request.text], debug, precision=request.precision,
+                                    backend=request.inference_backend))[0]
+    statistics = await run_blocking(compute_head_statistics, raw["attentions"])
+    num_layers, num_heads, _ = statistics.shape
+    print(f"Summarized {num_layers} layers x {num_heads} heads over {len(tokens)} tokens")
+    result = {
+        "num_tokens": len(tokens),
+        "num_layers": num_layers,
+        "num_heads": num_heads,
+        "metrics": list(HEAD_METRICS),
+        "values": np.round(statistics.double().numpy(), 5).tolist(),
+    }
+    result_cache.put(cache_key, result)
+    return result
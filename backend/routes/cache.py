@@ -0,0 +1,33 @@
+import hmac
+import os
+from typing import Optional
+from fastapi import APIRouter, HTTPException, Header
+from result_cache import result_cache, attention_tensor_cache, tokenization_cache
+router = APIRouter()
+
+# Clearing the caches is an admin operation: DELETE /cache is disabled unless
+# CACHE_ADMIN_TOKEN is set, and then requires it in the X-Admin-Token header
+CACHE_ADMIN_TOKEN = os.environ.get("CACHE_ADMIN_TOKEN", "")
+
+
+@router.get("")
+async def get_result_cache_stats():
+    """Get statistics of the result, raw attention and tokenization caches: hits, misses, hit rate, evictions and resident size"""
+    return {
+        "results": result_cache.stats(),
+        "attention_tensors": attention_tensor_cache.stats(),
+        "tokenization": tokenization_cache.stats(),
+    }
+
+
+@router.delete("")
+async def clear_result_cache(x_admin_token: Optional[str] = Header(None)):
+    """Drop all cached results, raw attentions and tokenizations (requires CACHE_ADMIN_TOKEN)"""
+    if not CACHE_ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Clearing the caches is disabled, set CACHE_ADMIN_TOKEN to enable it")
+    if not x_admin_token or not hmac.compare_digest(x_admin_token.encode(), CACHE_ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=401, detail="Missing or wrong X-Admin-Token")
+    result_cache.clear()
+    attention_tensor_cache.clear()
+    tokenization_cache.clear()
+    return await get_result_cache_stats()
@@ -1,15 +1,36 @@
 from fastapi import APIRouter, HTTPException, Header
-from routes.tokenize import tokenize_text
 from classes import *
 from helpers import *
+from inference_batching import inference_batcher
+from inference_executor import run_blocking
+from model_loading import ensure_model_loaded
+from long_text import fit_masked_inputs
+from result_cache import result_cache
 
 router = APIRouter()
 
 
 
 @router.post("", response_model=MaskPredictionResponse)
-async def predict_masked_token(request: MaskPredictionRequest, x_token_to_mask: str = Header(None), x_explicit_masked_text: str = Header(None)):
-    """Predict masked token using the specified model"""
+async def predict_masked_token(request: MaskPredictionRequest, x_token_to_mask: str = Header(None), x_explicit_masked_text: str = Header(None),
+                               x_model_load_wait: Optional[float] = Header(None)):
+    """Predict masked token using the specified model (cached per request and masking headers)"""
+    variant = model_key(request.model_name, resolve_precision(request.model_name, request.precision))
+    cache_key = ("predict_masked", variant, request.text, request.mask_index, request.top_k,
+                 x_token_to_mask, x_explicit_masked_text, bool(request.long_text), request.window_size)
+    cached = result_cache.get(cache_key)
+    if cached is not None:
+        print(f"Mask prediction cache hit: model={request.model_name}, mask_index={request.mask_index}")
+        return cached
+    
+    await ensure_model_loaded(request.model_name, x_model_load_wait, request.precision)
+    result = await compute_mask_predictions(request, x_token_to_mask, x_explicit_masked_text)
+    result_cache.put(cache_key, result)
+    return result
+
+
+async def compute_mask_predictions(request: MaskPredictionRequest, x_token_to_mask: Optional[str] = None, x_explicit_masked_text: Optional[str] = None):
+    """Run the masking logic and the masked LM for a mask prediction request"""
     try:
         print(f"\n=== MASK PREDICTION REQUEST ===")
         print(f"Input text: '{request.text}'")
@@ -19,7 +40,8 @@ async def predict_masked_token(request: MaskPredictionRequest, x_token_to_mask:
         print(f"Explicit masked text header: '{x_explicit_masked_text}'")
         
         debug = request.debug if hasattr(request, 'debug') else False
-        model, tokenizer = get_model_and_tokenizer(request.model_name, debug)
+        model, tokenizer = await run_blocking(get_model_and_tokenizer, request.model_name, debug, request.precision)
+        variant = model_key(request.model_name, resolve_precision(request.model_name, request.precision))
         
         # For RoBERTa, use explicit masked text if provided
         if "roberta" in request.model_name and x_explicit_masked_text:
@@ -32,8 +54,7 @@ async def predict_masked_token(request: MaskPredictionRequest, x_token_to_mask:
             
             # Skip all other masking logic and go straight to prediction
             inputs = tokenizer(text_with_mask, return_tensors="pt")
-            if torch.cuda.is_available():
-                inputs = {k: v.cuda() for k, v in inputs.items()}
+            inputs = fit_masked_inputs(model, request.model_name, inputs, tokenizer.mask_token_id, bool(request.long_text), request.window_size)
             
             # Find the mask token position
             mask_token_index = torch.where(inputs["input_ids"][0] == tokenizer.mask_token_id)[0]
@@ -42,9 +63,9 @@ async def predict_masked_token(request: MaskPredictionRequest, x_token_to_mask:
             mask_token_index = mask_token_index[0].item()
             
             # Get predictions
-            with torch.no_grad():
-                outputs = model(**inputs)
-                predictions = outputs.logits[0, mask_token_index, :].softmax(dim=-1)
+            outputs = await inference_batcher.run(f"{variant}:mlm", model, inputs, pad_token_id=tokenizer.pad_token_id or 0,
+                                                  backend=request.inference_backend)
+            predictions = outputs.logits[0, mask_token_index, :].softmax(dim=-1)
             
             # Get top k predictions
             topk_values, topk_indices = torch.topk(predictions, k=request.top_k, dim=-1)
@@ -78,9 +99,8 @@ async def predict_masked_token(request: MaskPredictionRequest, x_token_to_mask:
             
             return MaskPredictionResponse(predictions=predictions_list)
 
-        # Get tokens from the original text using the tokenize endpoint for consistency
-        tokenizer_response = await tokenize_text(TokenizeRequest(text=request.text, model_name=request.model_name, debug=debug))
-        tokens = tokenizer_response["tokens"]
+        # Get tokens from the original text with the same encoding as the tokenize endpoint
+        tokens, _ = await run_blocking(get_encoding, tokenizer, request.model_name, request.text)
         
         print(f"Tokenizer response: {len(tokens)} tokens")
         for i, t in enumerate(tokens):
@@ -249,8 +269,9 @@ async def predict_masked_token(request: MaskPredictionRequest, x_token_to_mask:
                 if word_found:
                     # Continue with predictions using text_with_mask
                     inputs = tokenizer(text_with_mask, return_tensors="pt")
-                    with torch.no_grad():
-                        outputs = model(**inputs)
+                    inputs = fit_masked_inputs(model, request.model_name, inputs, tokenizer.mask_token_id, bool(request.long_text), request.window_size)
+                    outputs = await inference_batcher.run(f"{variant}:mlm", model, inputs, pad_token_id=tokenizer.pad_token_id or 0,
+                                                          backend=request.inference_backend)
                         
                     mask_token_index = torch.where(inputs["input_ids"][0] == tokenizer.mask_token_id)[0]
                     if len(mask_token_index) == 0:
@@ -313,10 +334,8 @@ async def predict_masked_token(request: MaskPredictionRequest, x_token_to_mask:
                     
                     if not content_word_found:
                         # If not found directly, check for any content words in positions near the request index
-                        potential_content_positions = []
-                        for i, word in enumerate(original_words):
-                            if not is_function_word(word):
-                                potential_content_positions.append(i)
+                        function_word_flags = classify_function_words(original_words)
+                        potential_content_positions = [i for i, is_function in enumerate(function_word_flags) if not is_function]
                         
                         if potential_content_positions:
                             # Find closest content word to the requested position
@@ -394,8 +413,7 @@ async def predict_masked_token(request: MaskPredictionRequest, x_token_to_mask:
         print(f"Final text with mask: '{text_with_mask}'")
         
         inputs = tokenizer(text_with_mask, return_tensors="pt")
-        if torch.cuda.is_available():
-            inputs = {k: v.cuda() for k, v in inputs.items()}
+        inputs = fit_masked_inputs(model, request.model_name, inputs, tokenizer.mask_token_id, bool(request.long_text), request.window_size)
         
         # Print input IDs and tokens for debugging
         input_tokens = tokenizer.convert_ids_to_tokens(inputs["input_ids"][0])
@@ -408,9 +426,9 @@ async def predict_masked_token(request: MaskPredictionRequest, x_token_to_mask:
         
         print(f"Mask token position in input_ids: {mask_token_index.tolist()}")
         
-        with torch.no_grad():
-            outputs = model(**inputs)
-            predictions = outputs.logits[0, mask_token_index, :].softmax(dim=-1)
+        outputs = await inference_batcher.run(f"{variant}:mlm", model, inputs, pad_token_id=tokenizer.pad_token_id or 0,
+                                              backend=request.inference_backend)
+        predictions = outputs.logits[0, mask_token_index, :].softmax(dim=-1)
         
         # Get top k predictions
         topk_values, topk_indices = torch.topk(predictions, k=request.top_k, dim=-1)
@@ -450,6 +468,8 @@ async def predict_masked_token(request: MaskPredictionRequest, x_token_to_mask:
         
         return {"predictions": predictions_list}
     
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Prediction error: {str(e)}")
         import traceback
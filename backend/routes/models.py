@@ -1,16 +1,30 @@
 from fastapi import APIRouter
-from models import MODEL_CONFIGS
+from models import MODEL_CONFIGS, model_registry, resolve_precision, model_key
+from inference_batching import inference_batcher
+from model_loading import model_load_states
 router = APIRouter()
 
 
 @router.get("")
 async def get_available_models():
-    """Get list of available models"""
-    return {
-        "models": [
-            {
-                "id": model_id,
-                "name": config["name"],
-            } for model_id, config in MODEL_CONFIGS.items()
-        ]
-    }
\ No newline at end of file
+    """Get list of available models with their load state and resident size (and those of their int8 copy, once requested)"""
+    states = model_load_states()
+    models = []
+    for model_id, config in MODEL_CONFIGS.items():
+        entry = {"id": model_id, "name": config["name"], "default_precision": resolve_precision(model_id), **states[model_id]}
+        if model_key(model_id, "int8") in states:
+            entry["int8"] = states[model_key(model_id, "int8")]
+        models.append(entry)
+    return {"models": models}
+
+
+@router.get("/registry")
+async def get_model_registry_stats():
+    """Get model registry statistics: hits, misses, evictions and resident models"""
+    return model_registry.stats()
+
+
+@router.get("/batching")
+async def get_batching_stats():
+    """Get inference batching statistics: queue depth and batch sizes"""
+    return inference_batcher.stats()
@@ -0,0 +1,11 @@
+from fastapi import APIRouter
+from fastapi.responses import JSONResponse
+from model_loading import readiness
+router = APIRouter()
+
+
+@router.get("")
+async def get_readiness():
+    """Report whether the preloaded models are loaded and warmed up (200) or not yet (503), with per-model load state"""
+    report = readiness()
+    return JSONResponse(report, status_code=200 if report["ready"] else 503)
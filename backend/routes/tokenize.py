@@ -1,45 +1,55 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Header
 from classes import *
 from helpers import *
+from inference_executor import run_blocking
+from model_loading import ensure_model_loaded
+from long_text import resolve_window, plan_windows, window_positions
 
 router = APIRouter()
 
-@router.post("", response_model=TokenizeResponse)
-async def tokenize_text(request: TokenizeRequest):
+@router.post("", response_model=TokenizeResponse, response_model_exclude_none=True)
+async def tokenize_text(request: TokenizeRequest, x_model_load_wait: Optional[float] = Header(None)):
     """Tokenize input text using the specified model's tokenizer"""
+    await ensure_model_loaded(request.model_name, x_model_load_wait)
     try:
         debug = request.debug if hasattr(request, 'debug') else False
-        _, tokenizer = get_model_and_tokenizer(request.model_name, debug)
+        model, tokenizer = await run_blocking(get_model_and_tokenizer, request.model_name, debug)
         
-        # The text might include punctuation - let the tokenizer handle it properly
-        if "roberta" in request.model_name:
-            # For RoBERTa, we'll encode with the tokenizer and decode to get the individual tokens
-            # Remove return_offsets_mapping which causes issues with Python tokenizers
-            encoding = tokenizer.encode_plus(
-                request.text, 
-                add_special_tokens=True, 
-                return_tensors="pt",
-                return_attention_mask=True
-            )
-            
-            # Get tokens from encoding
-            tokens = tokenizer.convert_ids_to_tokens(encoding["input_ids"][0])
-            
-            # Clean the tokens to remove the leading 'Ġ' character from RoBERTa tokens
-            tokens = [clean_roberta_token(token) for token in tokens]
-        else:
-            # For BERT, DistilBERT, and TinyBERT, add special tokens and tokenize
-            text = f"[CLS] {request.text} [SEP]"
-            tokens = tokenizer.tokenize(text)
+        # The tokenizer adds the special tokens ([CLS]/[SEP] or <s>/</s>) and handles punctuation;
+        # the same encoding gives the word each token belongs to
+        tokens, _ = get_encoding(tokenizer, request.model_name, request.text)
         
-        # Create token objects with indices
-        token_objects = [
-            {"text": token, "index": idx}
-            for idx, token in enumerate(tokens)
-        ]
+        if getattr(request, "long_text", False):
+            # The windows /attention uses for this text in long-text mode
+            window_size, overlap = resolve_window(model, request.window_size, request.window_overlap)
+            windows = [
+                {"index": index, "start": start, "end": end, "token_indices": window_positions(start, end, len(tokens))}
+                for index, (start, end) in enumerate(plan_windows(len(tokens), window_size, overlap))
+            ]
+            return {"tokens": tokens, "windows": windows}
         
-        return {"tokens": token_objects}
+        return {"tokens": tokens}
     
+    except HTTPException:
+        raise
+    except Exception as e:
+        print(f"Tokenization error: {str(e)}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+@router.post("/batch", response_model=TokenizeBatchResponse, response_model_exclude_none=True)
+async def tokenize_texts(request: TokenizeBatchRequest, x_model_load_wait: Optional[float] = Header(None)):
+    """Tokenize a list of texts with one batch call of the model's tokenizer"""
+    await ensure_model_loaded(request.model_name, x_model_load_wait)
+    try:
+        debug = request.debug if hasattr(request, 'debug') else False
+        _, tokenizer = await run_blocking(get_model_and_tokenizer, request.model_name, debug)
+        
+        encodings = await run_blocking(get_encodings, tokenizer, request.model_name, request.texts)
+        
+        return {"results": [{"tokens": tokens} for tokens, _ in encodings]}
+    
+    except HTTPException:
+        raise
     except Exception as e:
         print(f"Tokenization error: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,62 @@
+"""
+Layer capture on a model and on its int8 copy.
+
+Run from the backend directory:
+    python -m pytest tests
+"""
+import os
+import sys
+
+import torch
+from transformers import BertConfig, BertForMaskedLM
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from attention_capture import early_exit_forward, stream_forward
+from model_loading import quantize_model
+
+
+def tiny_bert():
+    torch.manual_seed(0)
+    config = BertConfig(vocab_size=64, hidden_size=16, num_hidden_layers=3, num_attention_heads=2,
+                        intermediate_size=32, max_position_embeddings=32)
+    config._attn_implementation = "eager"
+    return BertForMaskedLM(config).eval()
+
+
+def tiny_batch():
+    input_ids = torch.tensor([[2, 10, 11, 12, 3]])
+    return {"input_ids": input_ids, "attention_mask": torch.ones_like(input_ids)}
+
+
+def full_attentions(model, batch):
+    with torch.no_grad():
+        return model(**batch, output_attentions=True).attentions
+
+
+def test_early_exit_matches_full_forward():
+    model = tiny_bert()
+    batch = tiny_batch()
+    output = early_exit_forward(model.base_model, batch, (0, 2))
+    expected = full_attentions(model.base_model, batch)
+    assert len(output.attentions) == 2
+    assert torch.allclose(output.attentions[0], expected[0])
+    assert torch.allclose(output.attentions[1], expected[2])
+
+
+def test_int8_copy_captures_after_fp32_capture():
+    # The fp32 capture installs hooks before the int8 copy is made, so the copy inherits them
+    model = tiny_bert()
+    batch = tiny_batch()
+    early_exit_forward(model.base_model, batch, (1,))
+    quantized = quantize_model(model)
+
+    output = early_exit_forward(quantized.base_model, batch, (0, 1))
+    expected = full_attentions(quantized.base_model, batch)
+    assert len(output.attentions) == 2
+    assert torch.allclose(output.attentions[0], expected[0])
+    assert torch.allclose(output.attentions[1], expected[1])
+
+    captured = []
+    stream_forward(quantized.base_model, batch, lambda layer_idx, attention: captured.append(layer_idx))
+    assert captured == [0, 1, 2]